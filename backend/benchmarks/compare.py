@@ -0,0 +1,79 @@
+"""
+Compare two benchmark result files from benchmarks.run.
+
+Usage (from the backend directory):
+    python -m benchmarks.compare baseline.json candidate.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+from typing import Any
+
+# (section, metric, True if higher is better)
+METRICS = [
+    ("parse", "mb_per_second", True),
+    ("parse", "conversations_per_second", True),
+    ("parse", "peak_rss_mb", False),
+    ("parse_simple_json", "mb_per_second", True),
+    ("ingest", "messages_per_second", True),
+    ("ingest", "peak_rss_mb", False),
+    ("search", "p50_ms", False),
+    ("search", "p95_ms", False),
+    ("search", "p99_ms", False),
+    ("list_first_page", "p50_ms", False),
+    ("list_first_page", "p95_ms", False),
+    ("list_20_pages", "p50_ms", False),
+    ("detail", "p50_ms", False),
+    ("detail", "p95_ms", False),
+    (None, "database_bytes", False),
+    (None, "peak_rss_mb", False),
+]
+
+
+def _value(scale: dict[str, Any], section: str | None, metric: str) -> float | None:
+    container = scale if section is None else scale.get(section, {})
+    return container.get(metric)
+
+
+def compare(baseline: dict[str, Any], candidate: dict[str, Any]) -> list[str]:
+    lines = [
+        f"baseline:  {baseline['meta'].get('commit')} ({baseline['meta'].get('started_at')})",
+        f"candidate: {candidate['meta'].get('commit')} ({candidate['meta'].get('started_at')})",
+    ]
+    baseline_scales = {scale["messages"]: scale for scale in baseline["scales"]}
+
+    for scale in candidate["scales"]:
+        before = baseline_scales.get(scale["messages"])
+        if before is None:
+            continue
+        lines.append("")
+        lines.append(f"{scale['messages']} messages")
+        for section, metric, higher_is_better in METRICS:
+            old, new = _value(before, section, metric), _value(scale, section, metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old * 100 if old else 0.0
+            improved = change > 0 if higher_is_better else change < 0
+            marker = "+" if improved else "-" if change else " "
+            name = f"{section}.{metric}" if section else metric
+            lines.append(f"  {marker} {name:<38} {old:>14.3f} -> {new:>14.3f}  ({change:+.1f}%)")
+
+    return lines
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("candidate", type=Path)
+    args = parser.parse_args(argv)
+
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    candidate = json.loads(args.candidate.read_text(encoding="utf-8"))
+    print("\n".join(compare(baseline, candidate)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Measure /api/conversations latency while imports run.
+
+Usage (from the backend directory):
+    python -m benchmarks.mixed_load --messages 100000 --readers 8 --output mixed.json
+
+Starts the API with uvicorn on a temporary database, loads one export, then samples the
+first conversation page from several reader threads twice: once with the server idle and
+once while further exports are uploaded and ingested. Browsing latency should be about
+the same in both phases.
+"""
+
+from __future__ import annotations
+
+import argparse
+from dataclasses import replace
+import http.client
+import json
+import multiprocessing
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Any
+import uuid
+
+from benchmarks.run import _latencies
+from benchmarks.synthetic import ExportSpec, write_chatgpt_export
+
+
+def _serve(workdir: str, port: int) -> None:
+    import uvicorn
+
+    import db
+
+    db.DB_PATH = Path(workdir) / "bench.db"
+    db.MEDIA_DIR = Path(workdir) / "media"
+    import main
+
+    main.MEDIA_DIR = db.MEDIA_DIR
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def _request(port: int, method: str, path: str, body: bytes | None = None, headers: dict | None = None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def _wait_until_up(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _request(port, "GET", "/api/jobs")
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _upload(port: int, export_path: Path) -> tuple[int, dict[str, Any]]:
+    boundary = uuid.uuid4().hex
+    body = b"".join(
+        [
+            f"--{boundary}\r\n".encode(),
+            f'Content-Disposition: form-data; name="files"; filename="{export_path.name}"\r\n'.encode(),
+            b"Content-Type: application/zip\r\n\r\n",
+            export_path.read_bytes(),
+            f"\r\n--{boundary}--\r\n".encode(),
+        ]
+    )
+    status, payload = _request(
+        port, "POST", "/api/upload", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    )
+    return status, json.loads(payload)
+
+
+def _wait_for_jobs(port: int) -> None:
+    while True:
+        _, payload = _request(port, "GET", "/api/jobs")
+        if all(job["status"] in ("completed", "failed", "cancelled") for job in json.loads(payload)):
+            return
+        time.sleep(0.2)
+
+
+def _sample_pages(port: int, readers: int, stop: threading.Event) -> list[float]:
+    samples: list[float] = []
+    lock = threading.Lock()
+
+    def read() -> None:
+        while not stop.is_set():
+            started = time.perf_counter()
+            status, _ = _request(port, "GET", "/api/conversations?limit=50")
+            elapsed = time.perf_counter() - started
+            if status == 200:
+                with lock:
+                    samples.append(elapsed)
+
+    threads = [threading.Thread(target=read) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    stop.wait()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Browse latency while imports run")
+    parser.add_argument("--messages", type=int, default=100_000, help="Messages per uploaded export")
+    parser.add_argument("--uploads", type=int, default=3, help="Exports uploaded during the busy phase")
+    parser.add_argument("--readers", type=int, default=8, help="Concurrent browsing clients")
+    parser.add_argument("--idle-seconds", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", type=Path, default=Path("mixed-load-results.json"))
+    args = parser.parse_args(argv)
+
+    base_spec = ExportSpec()
+    base_spec = replace(base_spec, conversations=max(1, args.messages // base_spec.messages_per_conversation))
+
+    with tempfile.TemporaryDirectory(prefix="chat-archive-load-") as workdir:
+        exports = [
+            write_chatgpt_export(Path(workdir) / f"export-{seed}.zip", replace(base_spec, seed=seed))
+            for seed in range(args.uploads + 1)
+        ]
+
+        server = multiprocessing.get_context("spawn").Process(target=_serve, args=(workdir, args.port))
+        server.start()
+        try:
+            _wait_until_up(args.port)
+            _upload(args.port, exports[0])
+            _wait_for_jobs(args.port)
+
+            stop = threading.Event()
+            threading.Timer(args.idle_seconds, stop.set).start()
+            idle = _sample_pages(args.port, args.readers, stop)
+
+            statuses: list[int] = []
+            stop = threading.Event()
+
+            def import_all() -> None:
+                started = time.perf_counter()
+                for export_path in exports[1:]:
+                    statuses.append(_upload(args.port, export_path)[0])
+                _wait_for_jobs(args.port)
+                busy_seconds.append(time.perf_counter() - started)
+                stop.set()
+
+            busy_seconds: list[float] = []
+            importer = threading.Thread(target=import_all)
+            importer.start()
+            busy = _sample_pages(args.port, args.readers, stop)
+            importer.join()
+        finally:
+            server.terminate()
+            server.join()
+
+    results = {
+        "messages_per_export": base_spec.total_messages,
+        "readers": args.readers,
+        "upload_statuses": statuses,
+        "import_seconds": round(busy_seconds[0], 3),
+        "idle": _latencies(idle),
+        "importing": _latencies(busy),
+    }
+    print(json.dumps(results, indent=2))
+    args.output.write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Benchmark parsing, ingestion, search and browsing at several archive sizes.
+
+Usage (from the backend directory):
+    python -m benchmarks.run --scales 10000 100000 1000000 --output bench.json
+
+Each scale runs in a fresh process against its own temporary database, so peak RSS is
+per scale. Results are written as JSON; compare two runs with benchmarks.compare.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, replace
+from datetime import datetime, timezone
+import json
+import multiprocessing
+from pathlib import Path
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable
+import zipfile
+
+from benchmarks.synthetic import ExportSpec, search_terms, write_chatgpt_export, write_simple_json_export
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _percentile(sorted_values: list[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def _latencies(samples: list[float]) -> dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(_percentile(ordered, 0.50) * 1000, 3),
+        "p95_ms": round(_percentile(ordered, 0.95) * 1000, 3),
+        "p99_ms": round(_percentile(ordered, 0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def _time_calls(calls: list[Callable[[], Any]]) -> dict[str, float]:
+    samples: list[float] = []
+    for call in calls:
+        started = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - started)
+    return _latencies(samples)
+
+
+def _bench_parse(export_path: Path, workers: int = 1) -> dict[str, float]:
+    from parsers import iter_chatgpt_conversations
+
+    with zipfile.ZipFile(export_path) as archive:
+        info = archive.getinfo("conversations.json")
+        started = time.perf_counter()
+        conversations = messages = 0
+        with archive.open(info) as member:
+            for parsed in iter_chatgpt_conversations(member, workers=workers):
+                conversations += 1
+                messages += len(parsed.messages)
+        elapsed = time.perf_counter() - started
+
+    return {
+        "seconds": round(elapsed, 3),
+        "conversations": conversations,
+        "messages": messages,
+        "mb_per_second": round(info.file_size / (1024 * 1024) / elapsed, 2),
+        "conversations_per_second": round(conversations / elapsed, 1),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _bench_simple_json(workdir: Path, messages: int, seed: int) -> dict[str, float]:
+    from parsers import parse_chat_export
+
+    raw = write_simple_json_export(workdir / "simple.json", messages, seed).read_bytes()
+    started = time.perf_counter()
+    parsed = parse_chat_export(raw, fallback_title="simple")
+    elapsed = time.perf_counter() - started
+    return {
+        "seconds": round(elapsed, 3),
+        "messages": len(parsed.messages),
+        "mb_per_second": round(len(raw) / (1024 * 1024) / elapsed, 2),
+    }
+
+
+def _bench_ingest(export_path: Path, media_dir: Path) -> dict[str, float]:
+    from db import get_write_db
+    from ingest import import_export
+
+    started = time.perf_counter()
+    with get_write_db() as conn:
+        conversation_ids = import_export(conn, export_path, export_path.name, media_dir)
+        messages = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    elapsed = time.perf_counter() - started
+
+    return {
+        "seconds": round(elapsed, 3),
+        "conversations": len(conversation_ids),
+        "messages": messages,
+        "messages_per_second": round(messages / elapsed, 1),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _bench_reads(queries: int, seed: int) -> dict[str, Any]:
+    import main
+    from db import get_db
+    from shards import shard_set
+
+    rng = random.Random(seed)
+    with get_db() as conn:
+        max_id = conn.execute("SELECT MAX(id) FROM conversations").fetchone()[0]
+    conversation_ids = [rng.randint(1, max_id) for _ in range(queries)]
+    # Queries run on the endpoints' reader executor, but list and detail skip their response
+    # cache so every sample hits SQLite. One loop for all calls keeps loop setup out of the timings.
+    loop = asyncio.new_event_loop()
+    call = loop.run_until_complete
+
+    def list_pages(pages: int) -> None:
+        after = None
+        for _ in range(pages):
+            page = call(main.run_read(main._list_conversations, after, 50, None, None))
+            page.model_dump_json()
+            after = page.next_after
+            if not after:
+                break
+
+    def detail(conversation_id: int) -> None:
+        shard = shard_set.for_id(conversation_id)
+        call(main.run_read(main._get_conversation, shard, conversation_id, True)).model_dump_json()
+
+    def search(term: str) -> None:
+        page = call(
+            main.search_messages(
+                query=term,
+                mode="keyword",
+                role=None,
+                source=None,
+                conversation_id=None,
+                start=None,
+                end=None,
+                order="relevance",
+                after=None,
+                limit=main.SEARCH_PAGE_LIMIT,
+            )
+        )
+        page.model_dump_json()
+
+    try:
+        return {
+            "search": _time_calls([lambda term=term: search(term) for term in search_terms(queries, seed)]),
+            "list_first_page": _time_calls([lambda: list_pages(1) for _ in range(queries)]),
+            "list_20_pages": _time_calls([lambda: list_pages(20) for _ in range(max(1, queries // 10))]),
+            "detail": _time_calls([lambda cid=cid: detail(cid) for cid in conversation_ids]),
+        }
+    finally:
+        loop.close()
+
+
+def run_scale(spec: ExportSpec, queries: int, workdir: Path, parse_workers: int = 1) -> dict[str, Any]:
+    import db
+
+    db.DB_PATH = workdir / "bench.db"
+    db.MEDIA_DIR = workdir / "media"
+    db.init_db()
+
+    started = time.perf_counter()
+    export_path = write_chatgpt_export(workdir / "export.zip", spec)
+    generate_seconds = time.perf_counter() - started
+
+    result: dict[str, Any] = {
+        "messages": spec.total_messages,
+        "conversations": spec.conversations,
+        "export_bytes": export_path.stat().st_size,
+        "generate_seconds": round(generate_seconds, 3),
+    }
+    result["parse"] = _bench_parse(export_path)
+    if parse_workers > 1:
+        result["parse_parallel"] = {"workers": parse_workers, **_bench_parse(export_path, parse_workers)}
+    result["parse_simple_json"] = _bench_simple_json(workdir, min(spec.total_messages, 10000), spec.seed)
+    result["ingest"] = _bench_ingest(export_path, db.MEDIA_DIR)
+    result["database_bytes"] = db.DB_PATH.stat().st_size
+    result.update(_bench_reads(queries, spec.seed))
+    result["peak_rss_mb"] = _peak_rss_mb()
+    return result
+
+
+def _run_scale_in_tempdir(spec: ExportSpec, queries: int, parse_workers: int) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="chat-archive-bench-") as workdir:
+        return run_scale(spec, queries, Path(workdir), parse_workers)
+
+
+def _git_revision() -> dict[str, Any]:
+    def git(*args: str) -> str:
+        return subprocess.run(["git", *args], capture_output=True, text=True, check=True).stdout.strip()
+
+    try:
+        return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def main(argv: list[str] | None = None) -> None:
+    defaults = ExportSpec()
+    parser = argparse.ArgumentParser(description="Benchmark the chat archive backend on synthetic exports")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="Total message counts to benchmark")
+    parser.add_argument("--messages-per-conversation", type=int, default=defaults.messages_per_conversation)
+    parser.add_argument("--branches", type=int, default=defaults.branches_per_conversation)
+    parser.add_argument("--branch-depth", type=int, default=defaults.branch_depth)
+    parser.add_argument("--min-words", type=int, default=defaults.min_words)
+    parser.add_argument("--max-words", type=int, default=defaults.max_words)
+    parser.add_argument("--attachments", type=int, default=defaults.attachments_per_conversation,
+                        help="Attachments per conversation")
+    parser.add_argument("--attachment-bytes", type=int, default=defaults.attachment_bytes)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--queries", type=int, default=200, help="Samples per latency measurement")
+    parser.add_argument("--parse-workers", type=int, default=1,
+                        help="Also time parsing conversations.json with this many processes")
+    parser.add_argument("--output", type=Path, default=Path("benchmark-results.json"))
+    args = parser.parse_args(argv)
+
+    base_spec = ExportSpec(
+        messages_per_conversation=args.messages_per_conversation,
+        branches_per_conversation=args.branches,
+        branch_depth=args.branch_depth,
+        min_words=args.min_words,
+        max_words=args.max_words,
+        attachments_per_conversation=args.attachments,
+        attachment_bytes=args.attachment_bytes,
+        seed=args.seed,
+    )
+
+    results: dict[str, Any] = {
+        "meta": {
+            **_git_revision(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "spec": asdict(base_spec),
+            "queries": args.queries,
+            "parse_workers": args.parse_workers,
+        },
+        "scales": [],
+    }
+
+    context = multiprocessing.get_context("spawn")
+    for messages in args.scales:
+        spec = replace(base_spec, conversations=max(1, messages // base_spec.messages_per_conversation))
+        print(f"Benchmarking {spec.total_messages} messages in {spec.conversations} conversations...", flush=True)
+        # Not a multiprocessing.Pool: its daemonic workers can't start the parse pool.
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            scale = pool.submit(_run_scale_in_tempdir, spec, args.queries, args.parse_workers).result()
+        results["scales"].append(scale)
+        print(json.dumps(scale, indent=2), flush=True)
+
+    args.output.write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Deterministic synthetic exports for benchmarks.
+
+The same ExportSpec always produces byte-identical files. ChatGPT exports mirror the real
+layout: a conversations.json list of mapping/current_node graphs, where abandoned
+branches (regenerated answers, edited prompts) hang off the active path, plus attachment
+files referenced from message metadata.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import json
+from pathlib import Path
+import random
+from typing import Any
+import zipfile
+
+# Small fixed vocabulary with a long tail, so search terms have realistic selectivity.
+_COMMON_WORDS = (
+    "the a to of and in is that for it with as on this be are you can use we if or by not "
+    "function data value return error file code python sqlite query index table message"
+).split()
+_RARE_WORDS = [f"term{index:05d}" for index in range(20000)]
+_EPOCH_START = 1_672_531_200  # 2023-01-01T00:00:00Z
+
+
+@dataclass
+class ExportSpec:
+    conversations: int = 1000
+    messages_per_conversation: int = 20
+    # Abandoned branches per conversation and how many nodes each one has.
+    branches_per_conversation: int = 2
+    branch_depth: int = 3
+    # Message body length in words, drawn uniformly from this range.
+    min_words: int = 20
+    max_words: int = 400
+    attachments_per_conversation: int = 0
+    attachment_bytes: int = 64 * 1024
+    seed: int = 1234
+
+    @property
+    def total_messages(self) -> int:
+        return self.conversations * self.messages_per_conversation
+
+
+def _text(rng: random.Random, spec: ExportSpec) -> str:
+    words = rng.randint(spec.min_words, spec.max_words)
+    return " ".join(
+        rng.choice(_RARE_WORDS) if rng.random() < 0.05 else rng.choice(_COMMON_WORDS) for _ in range(words)
+    )
+
+
+def _node(node_id: str, parent: str | None, role: str, text: str, create_time: float) -> dict[str, Any]:
+    return {
+        "id": node_id,
+        "parent": parent,
+        "children": [],
+        "message": {
+            "id": node_id,
+            "author": {"role": role},
+            "create_time": create_time,
+            "content": {"content_type": "text", "parts": [text]},
+            "metadata": {},
+        },
+    }
+
+
+def _conversation(rng: random.Random, spec: ExportSpec, index: int) -> tuple[dict[str, Any], list[str]]:
+    created = _EPOCH_START + index * 3600 + rng.randint(0, 3599)
+    mapping: dict[str, Any] = {
+        f"c{index}-root": {"id": f"c{index}-root", "parent": None, "children": [], "message": None}
+    }
+
+    path = [f"c{index}-root"]
+    for position in range(spec.messages_per_conversation):
+        node_id = f"c{index}-m{position}"
+        role = "user" if position % 2 == 0 else "assistant"
+        mapping[node_id] = _node(node_id, path[-1], role, _text(rng, spec), created + position * 30)
+        mapping[path[-1]]["children"].append(node_id)
+        path.append(node_id)
+
+    for branch in range(spec.branches_per_conversation):
+        parent = rng.choice(path[:-1])
+        for depth in range(spec.branch_depth):
+            node_id = f"c{index}-b{branch}-{depth}"
+            role = "assistant" if depth % 2 == 0 else "user"
+            mapping[node_id] = _node(node_id, parent, role, _text(rng, spec), created + depth)
+            mapping[parent]["children"].append(node_id)
+            parent = node_id
+
+    attachment_files: list[str] = []
+    for number in range(spec.attachments_per_conversation):
+        file_id = f"file-{index:07d}{number:02d}"
+        file_name = f"{file_id}-image.png"
+        message = mapping[path[1 + (number * 2) % max(1, len(path) - 1)]]["message"]
+        message["metadata"].setdefault("attachments", []).append(
+            {"id": file_id, "name": file_name, "mime_type": "image/png"}
+        )
+        attachment_files.append(file_name)
+
+    conversation = {
+        "id": f"conv-{index:07d}",
+        "title": f"Conversation {index} about {rng.choice(_RARE_WORDS)}",
+        "create_time": created,
+        "update_time": created + spec.messages_per_conversation * 30,
+        "mapping": mapping,
+        "current_node": path[-1],
+    }
+    return conversation, attachment_files
+
+
+def write_chatgpt_export(path: Path, spec: ExportSpec) -> Path:
+    """Write a ChatGPT-style ZIP export, streaming conversations.json so size isn't bounded by RAM."""
+    rng = random.Random(spec.seed)
+    attachment_files: list[str] = []
+
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open("conversations.json", "w") as output:
+            output.write(b"[")
+            for index in range(spec.conversations):
+                conversation, files = _conversation(rng, spec, index)
+                attachment_files.extend(files)
+                if index:
+                    output.write(b",")
+                output.write(json.dumps(conversation).encode("utf-8"))
+            output.write(b"]")
+
+        # Random bytes don't compress, which keeps extraction cost honest.
+        payload = rng.randbytes(spec.attachment_bytes) if attachment_files else b""
+        for file_name in attachment_files:
+            archive.writestr(zipfile.ZipInfo(file_name, date_time=(2023, 1, 1, 0, 0, 0)), payload)
+        archive.writestr(zipfile.ZipInfo("chat.html", date_time=(2023, 1, 1, 0, 0, 0)), "<html></html>")
+
+    return path
+
+
+def write_simple_json_export(path: Path, messages: int, seed: int = 1234) -> Path:
+    """Write a {"title", "messages"} upload with the given number of messages."""
+    rng = random.Random(seed)
+    spec = ExportSpec(seed=seed)
+    payload = {
+        "title": "Synthetic conversation",
+        "messages": [
+            {
+                "role": "user" if index % 2 == 0 else "assistant",
+                "content": _text(rng, spec),
+                "timestamp": f"2023-01-01T00:{index // 60 % 60:02d}:{index % 60:02d}Z",
+            }
+            for index in range(messages)
+        ],
+    }
+    path.write_text(json.dumps(payload), encoding="utf-8")
+    return path
+
+
+def search_terms(count: int, seed: int = 1234) -> list[str]:
+    """Queries mixing common words, rare terms, prefixes and phrases."""
+    rng = random.Random(seed)
+    terms: list[str] = []
+    for index in range(count):
+        kind = index % 4
+        if kind == 0:
+            terms.append(rng.choice(_COMMON_WORDS))
+        elif kind == 1:
+            terms.append(rng.choice(_RARE_WORDS))
+        elif kind == 2:
+            terms.append(rng.choice(_RARE_WORDS)[:7] + "*")
+        else:
+            terms.append(f'"{rng.choice(_COMMON_WORDS)} {rng.choice(_COMMON_WORDS)}"')
+    return terms
@@ -0,0 +1,75 @@
+"""
+In-process cache of serialized read responses.
+
+Bodies are keyed by request URL and stamped with the archive (id, generation) they were
+built at. Any import or delete may change them, so seeing a newer generation of an archive
+drops that archive's bodies. Responses merged from several shards are stamped with a
+combined archive of their own, and those of a sealed shard with the shard's, which never
+changes, so they stay until evicted. The least recently used bodies are evicted to stay
+within a byte budget.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+import os
+import threading
+
+RESPONSE_CACHE_BYTES = int(os.environ.get("CHAT_ARCHIVE_RESPONSE_CACHE_MB", "64")) * 1024 * 1024
+# Bodies larger than this share of the budget are served but not kept, so one huge
+# conversation can't push out everything else.
+MAX_ENTRY_SHARE = 4
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Keyed by (archive id, URL).
+        self._entries: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+        self._size = 0
+        self._generations: dict[str, int] = {}
+
+    def _current(self, stamp: tuple[str, int]) -> bool:
+        """Whether stamp is the latest seen for its archive, dropping the archive's bodies if it is newer."""
+        archive_id, generation = stamp
+        latest = self._generations.get(archive_id)
+        if latest is not None and generation <= latest:
+            return generation == latest
+        if latest is not None:
+            for entry in [entry for entry in self._entries if entry[0] == archive_id]:
+                self._size -= len(self._entries.pop(entry))
+        self._generations[archive_id] = generation
+        return True
+
+    def get(self, key: str, stamp: tuple[str, int]) -> bytes | None:
+        with self._lock:
+            if not self._current(stamp):
+                return None
+            entry = (stamp[0], key)
+            body = self._entries.get(entry)
+            if body is not None:
+                self._entries.move_to_end(entry)
+            return body
+
+    def put(self, key: str, stamp: tuple[str, int], body: bytes) -> None:
+        with self._lock:
+            # An older stamp means the body was built before a change committed since.
+            if not self._current(stamp) or len(body) > self.max_bytes // MAX_ENTRY_SHARE:
+                return
+            entry = (stamp[0], key)
+            previous = self._entries.pop(entry, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[entry] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes}
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,249 @@
+"""
+Optional compressed storage for message content.
+
+messages.content holds either the text itself or, once compressed, a BLOB: a two-byte
+dictionary id followed by the UTF-8 text as a raw deflate stream primed with that
+dictionary. zlib uses up to 32 KiB of preset dictionary, which is what lets messages of a
+few hundred bytes compress well: the boilerplate they share with the rest of the archive
+is already in the window. Dictionaries are trained on a sample of the archive and kept in
+content_dictionaries; they never change, so rows stay readable after retraining.
+
+Every connection gets a content_text() SQL function returning the text either way, and
+everything that reads messages goes through it, including the full-text index (through
+the messages_text view).
+"""
+
+from __future__ import annotations
+
+from contextlib import closing
+from datetime import datetime
+import heapq
+import os
+from pathlib import Path
+import sqlite3
+import struct
+import threading
+from typing import Any, Iterable
+import zlib
+
+import numpy as np
+
+# New imports are stored compressed when this is set; `manage.py compress-content`
+# converts what is already stored either way.
+COMPRESS_CONTENT = os.environ.get("CHAT_ARCHIVE_COMPRESS_CONTENT", "0") == "1"
+# Level 3 compresses a typical message about three times faster than the default level 6,
+# for a few percent more space.
+COMPRESS_LEVEL = int(os.environ.get("CHAT_ARCHIVE_CONTENT_COMPRESS_LEVEL", "3"))
+# Shorter texts are left as they are: the header and deflate framing would eat the saving.
+MIN_COMPRESS_BYTES = 64
+DICTIONARY_BYTES = 32 * 1024
+# Messages sampled to train a dictionary.
+DICTIONARY_SAMPLE = 5000
+# Messages rewritten per transaction by recompress().
+RECOMPRESS_BATCH = 1000
+# Id of "compressed without a dictionary", for rows written before any was trained.
+NO_DICTIONARY = 0
+
+# Substring and segment lengths for train_dictionary().
+TRAIN_KMER = 8
+TRAIN_SEGMENT = 256
+
+_HEADER = struct.Struct(">H")
+
+
+def train_dictionary(texts: Iterable[str], size: int = DICTIONARY_BYTES) -> bytes:
+    """A preset dictionary of the sample's passages that share the most substrings with the rest.
+
+    A simplified version of zstd's COVER trainer: every TRAIN_KMER-byte substring is
+    counted across the sample, the sample is cut into TRAIN_SEGMENT-byte segments, and the
+    segments whose substrings are most frequent are picked greedily, each pick zeroing
+    the counts of what it covers. The best are placed last, since deflate codes nearer
+    matches in fewer bits.
+    """
+    data = "\n".join(texts).encode()
+    if len(data) < TRAIN_KMER:
+        return b""
+    windows = np.lib.stride_tricks.sliding_window_view(np.frombuffer(data, dtype=np.uint8), TRAIN_KMER)
+    kmers = np.ascontiguousarray(windows).view("<u8").ravel()
+    _, kmer_ids, counts = np.unique(kmers, return_inverse=True, return_counts=True)
+    counts = counts.astype(np.int64)
+    counts[counts < 2] = 0
+
+    starts = np.arange(0, len(kmer_ids), TRAIN_SEGMENT)
+    scores = np.add.reduceat(counts[kmer_ids], starts)
+    # Scores only fall as counts are zeroed, so a stale score is an upper bound: pop the
+    # best, rescore it, and take it if it still beats the next one (lazy greedy).
+    heap = [(-int(score), int(start)) for score, start in zip(scores, starts) if score > 0]
+    heapq.heapify(heap)
+    chosen: list[bytes] = []
+    while heap and len(chosen) * TRAIN_SEGMENT < size:
+        _, start = heapq.heappop(heap)
+        covered = kmer_ids[start : start + TRAIN_SEGMENT]
+        score = int(counts[covered].sum())
+        if heap and score < -heap[0][0]:
+            if score > 0:
+                heapq.heappush(heap, (-score, start))
+            continue
+        if score == 0:
+            break
+        chosen.append(data[start : start + TRAIN_SEGMENT])
+        counts[covered] = 0
+    return b"".join(reversed(chosen))[-size:]
+
+
+class ContentCodec:
+    """Compresses and decompresses message content for one database file."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._dictionaries: dict[int, bytes] = {NO_DICTIONARY: b""}
+        # Compressors primed with each dictionary; copying one is much cheaper than priming.
+        self._primed: dict[int, Any] = {}
+
+    def dictionary(self, dictionary_id: int) -> bytes:
+        dictionary = self._dictionaries.get(dictionary_id)
+        if dictionary is not None:
+            return dictionary
+        # Dictionaries are immutable once committed, so any connection may load them.
+        with closing(sqlite3.connect(f"{self.path.as_uri()}?mode=ro", uri=True)) as conn:
+            row = conn.execute("SELECT dictionary FROM content_dictionaries WHERE id = ?", (dictionary_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"Unknown content dictionary {dictionary_id}")
+        with self._lock:
+            self._dictionaries[dictionary_id] = row[0]
+        return row[0]
+
+    def compress(self, text: str, dictionary_id: int) -> str | bytes:
+        """The stored form of text: compressed if that is smaller, the text otherwise."""
+        data = text.encode()
+        if len(data) < MIN_COMPRESS_BYTES:
+            return text
+        primed = self._primed.get(dictionary_id)
+        if primed is None:
+            dictionary = self.dictionary(dictionary_id)
+            if dictionary:
+                primed = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=dictionary)
+            else:
+                primed = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+            with self._lock:
+                self._primed[dictionary_id] = primed
+        compressor = primed.copy()
+        compressed = _HEADER.pack(dictionary_id) + compressor.compress(data) + compressor.flush()
+        return compressed if len(compressed) < len(data) else text
+
+    def text(self, value: str | bytes | None) -> str | None:
+        """The text of a stored content value; the content_text() SQL function."""
+        if not isinstance(value, bytes):
+            return value
+        (dictionary_id,) = _HEADER.unpack_from(value)
+        dictionary = self.dictionary(dictionary_id)
+        if dictionary:
+            decompressor = zlib.decompressobj(-15, zdict=dictionary)
+        else:
+            decompressor = zlib.decompressobj(-15)
+        return (decompressor.decompress(value[_HEADER.size :]) + decompressor.flush()).decode()
+
+
+_codecs: dict[Path, ContentCodec] = {}
+_codecs_lock = threading.Lock()
+
+
+def get_codec(path: Path) -> ContentCodec:
+    with _codecs_lock:
+        codec = _codecs.get(path)
+        if codec is None:
+            codec = _codecs[path] = ContentCodec(path)
+        return codec
+
+
+def register_functions(conn: sqlite3.Connection, path: Path) -> None:
+    conn.create_function("content_text", 1, get_codec(path).text, deterministic=True)
+
+
+def current_dictionary(conn: sqlite3.Connection) -> int:
+    """Id of the newest trained dictionary, which new rows are compressed with."""
+    return conn.execute("SELECT COALESCE(MAX(id), ?) FROM content_dictionaries", (NO_DICTIONARY,)).fetchone()[0]
+
+
+def train_archive_dictionary(conn: sqlite3.Connection, sample_size: int = DICTIONARY_SAMPLE) -> int:
+    """Train a dictionary on a random sample of messages, store it and return its id."""
+    texts = [
+        row[0]
+        for row in conn.execute(
+            "SELECT content_text(content) FROM messages WHERE id IN (SELECT id FROM messages ORDER BY random() LIMIT ?)",
+            (sample_size,),
+        )
+    ]
+    dictionary_id = conn.execute(
+        "INSERT INTO content_dictionaries (dictionary, sample_size, created_at) VALUES (?, ?, ?) RETURNING id",
+        (train_dictionary(texts), len(texts), datetime.utcnow().isoformat()),
+    ).fetchone()[0]
+    conn.commit()
+    return dictionary_id
+
+
+def recompress(conn: sqlite3.Connection, path: Path, dictionary_id: int | None) -> tuple[int, int]:
+    """Store every message compressed with dictionary_id, or as text if it is None.
+
+    Messages are rewritten in id order and committed batch by batch, so imports can
+    run in between and an interrupted run just picks up again. The text never changes,
+    so the search index isn't touched. Returns (messages scanned, messages rewritten).
+    """
+    codec = get_codec(path)
+    last_id = scanned = rewritten = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, content FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, RECOMPRESS_BATCH),
+        ).fetchall()
+        if not rows:
+            return scanned, rewritten
+
+        updates = []
+        for message_id, content in rows:
+            if dictionary_id is None:
+                stored = codec.text(content)
+            elif isinstance(content, bytes) and _HEADER.unpack_from(content)[0] == dictionary_id:
+                continue
+            else:
+                stored = codec.compress(codec.text(content), dictionary_id)
+            if stored != content:
+                updates.append((stored, message_id))
+        conn.executemany("UPDATE messages SET content = ? WHERE id = ?", updates)
+        conn.commit()
+        scanned += len(rows)
+        rewritten += len(updates)
+        last_id = rows[-1][0]
+
+
+def space_report(conn: sqlite3.Connection) -> dict[str, int | None]:
+    """Message counts and sizes: text bytes against stored bytes, and on-disk table sizes."""
+    messages, compressed, text_bytes, stored_bytes = conn.execute(
+        """
+        SELECT
+            COUNT(*),
+            COALESCE(SUM(typeof(content) = 'blob'), 0),
+            COALESCE(SUM(length(CAST(content_text(content) AS BLOB))), 0),
+            COALESCE(SUM(length(CAST(content AS BLOB))), 0)
+        FROM messages
+        """
+    ).fetchone()
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    report = {
+        "messages": messages,
+        "compressed": compressed,
+        "text_bytes": text_bytes,
+        "stored_bytes": stored_bytes,
+        "file_bytes": conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+        "free_bytes": conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+        "messages_table_bytes": None,
+    }
+    try:
+        report["messages_table_bytes"] = conn.execute(
+            "SELECT SUM(pgsize) FROM dbstat WHERE name = 'messages'"
+        ).fetchone()[0]
+    except sqlite3.OperationalError:
+        # SQLite built without the dbstat table.
+        pass
+    return report
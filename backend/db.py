@@ -1,67 +1,885 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
 import sqlite3
-from contextlib import contextmanager
+import threading
+import time
+import uuid
+from contextlib import closing, contextmanager
 from pathlib import Path
+from typing import Any, Callable, TypeVar
+
+from codec import register_functions
+from metrics import connection_factory
+from migrations import Backfill, Migration, batch_end, complete, migrate, pending, schedule
+from parsers import epoch_ms
+import stats
 
 DB_PATH = Path(__file__).resolve().parent.parent / "chat_archive.db"
 MEDIA_DIR = Path(__file__).resolve().parent.parent / "media"
 
+# Per-connection pragmas for pooled connections. Each can be overridden with an
+# environment variable such as CHAT_ARCHIVE_SQLITE_CACHE_SIZE=-131072.
+CONNECTION_PRAGMAS = {
+    "foreign_keys": "ON",
+    "busy_timeout": 5000,
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+# Pooled connections live for the whole process, so each statement is prepared once
+# per connection as long as it stays in this cache.
+STATEMENT_CACHE_SIZE = 256
+
+# Sealed shards are opened with immutable=1 and mapped whole; SQLite caps this at its
+# compile-time maximum (2 GB by default).
+SEALED_MMAP_SIZE = 64 * 1024 * 1024 * 1024
+
+# Threads that run request queries off the event loop. Each holds its own reader
+# connection, so this also caps the number of open readers.
+READ_WORKERS = int(os.environ.get("CHAT_ARCHIVE_DB_READ_WORKERS", "8"))
+
+# Applied to the ingestion connection on top of CONNECTION_PRAGMAS. synchronous=NORMAL
+# is durable in WAL mode apart from the last commits on power loss.
+BULK_LOAD_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "cache_size": -256 * 1024,
+}
 
-def init_db() -> None:
-    MEDIA_DIR.mkdir(parents=True, exist_ok=True)
 
+def init_db(path: Path | None = None) -> None:
+    """Bring the archive database at path, by default DB_PATH, up to the current schema.
 
+    Only migrations it hasn't had are applied. Backfills they start that have rows to go
+    through are left to backfill_runner (see shards.py).
+    """
+    path = path or DB_PATH
+    MEDIA_DIR.mkdir(parents=True, exist_ok=True)
 
-def init_db() -> None:
-    with sqlite3.connect(DB_PATH) as conn:
+    # Closed explicitly: the functions registered on it keep it alive until the next
+    # garbage collection, and sealing a shard needs no other connection to it.
+    with closing(sqlite3.connect(path)) as conn, conn:
+        # WAL is persistent, so setting it once here covers every later connection.
+        conn.execute("PRAGMA journal_mode = WAL;")
         conn.execute("PRAGMA foreign_keys = ON;")
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                source TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            );
-            """
+        register_functions(conn, path)
+        migrate(conn, MIGRATIONS, BACKFILLS)
+
+        # A bulk load that never resumed its deferred indexes left them and the search
+        # triggers dropped: build both again, unless that load is still going.
+        row = conn.execute("SELECT value FROM archive_meta WHERE key = 'indexes_suspended'").fetchone()
+        if row and not _process_running(row[0]):
+            schedule(conn, BACKFILLS["indexes"])
+            schedule(conn, BACKFILLS["search_index"])
+            conn.execute("DELETE FROM archive_meta WHERE key = 'indexes_suspended'")
+
+
+def _process_running(pid: int) -> bool:
+    # Suspensions don't outlive the process that made them, so one by this process
+    # (or an earlier one given the same pid) is left over from a crash.
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _create_schema(conn: sqlite3.Connection) -> None:
+    """The schema as it was when schema_version was introduced.
+
+    Every statement is idempotent, so it also brings databases created before then up
+    to date.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            source TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            message_id INTEGER,
+            file_id TEXT,
+            file_name TEXT NOT NULL,
+            mime_type TEXT,
+            local_path TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE,
+            FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE SET NULL
+        );
+        """
+    )
+    _add_column(conn, "attachments", "blob_sha256", "TEXT")
+    _add_column(conn, "conversations", "archive_sha256", "TEXT")
+    _add_column(conn, "conversations", "external_id", "TEXT")
+    _add_column(conn, "messages", "external_id", "TEXT")
+    _add_column(conn, "conversations", "created_at_ms", "INTEGER")
+    _add_column(conn, "conversations", "updated_at_ms", "INTEGER")
+    _add_column(conn, "messages", "timestamp_ms", "INTEGER")
+    _add_column(conn, "conversations", "message_count", "INTEGER NOT NULL DEFAULT 0")
+    _init_media_store(conn)
+    _init_archive_meta(conn)
+    _init_shard_registry(conn)
+    _init_content_store(conn)
+    stats.init_rollups(conn)
+    # Replaced by the epoch-millisecond indexes in INDEXES.
+    for name in (
+        "idx_messages_conversation_timestamp",
+        "idx_messages_role_timestamp",
+        "idx_messages_timestamp",
+        "idx_conversations_created",
+        "idx_conversations_source_created",
+    ):
+        conn.execute(f"DROP INDEX IF EXISTS {name};")
+    _init_search_table(conn)
+
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> None:
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+
+
+def _init_media_store(conn: sqlite3.Connection) -> None:
+    # One row per stored file; ref_count is the number of attachments (or, for stored
+    # export archives, conversations) pointing at it.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            sha256 TEXT PRIMARY KEY,
+            local_path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mime_type TEXT,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS attachments_blob_insert AFTER INSERT ON attachments
+        WHEN new.blob_sha256 IS NOT NULL BEGIN
+            UPDATE media_blobs SET ref_count = ref_count + 1 WHERE sha256 = new.blob_sha256;
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS attachments_blob_delete AFTER DELETE ON attachments
+        WHEN old.blob_sha256 IS NOT NULL BEGIN
+            UPDATE media_blobs SET ref_count = ref_count - 1 WHERE sha256 = old.blob_sha256;
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS attachments_blob_update AFTER UPDATE OF blob_sha256 ON attachments BEGIN
+            UPDATE media_blobs SET ref_count = ref_count - 1 WHERE sha256 = old.blob_sha256;
+            UPDATE media_blobs SET ref_count = ref_count + 1 WHERE sha256 = new.blob_sha256;
+        END;
+        """
+    )
+    # Conversations imported from a ZIP keep the stored archive alive, so its other
+    # members can still be served after import.
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS conversations_archive_insert AFTER INSERT ON conversations
+        WHEN new.archive_sha256 IS NOT NULL BEGIN
+            UPDATE media_blobs SET ref_count = ref_count + 1 WHERE sha256 = new.archive_sha256;
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS conversations_archive_update AFTER UPDATE OF archive_sha256 ON conversations
+        BEGIN
+            UPDATE media_blobs SET ref_count = ref_count - 1 WHERE sha256 = old.archive_sha256;
+            UPDATE media_blobs SET ref_count = ref_count + 1 WHERE sha256 = new.archive_sha256;
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS conversations_archive_delete AFTER DELETE ON conversations
+        WHEN old.archive_sha256 IS NOT NULL BEGIN
+            UPDATE media_blobs SET ref_count = ref_count - 1 WHERE sha256 = old.archive_sha256;
+        END;
+        """
+    )
+
+
+def _init_archive_meta(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archive_meta (
+            key TEXT PRIMARY KEY,
+            value NOT NULL
+        );
+        """
+    )
+    conn.execute("INSERT OR IGNORE INTO archive_meta (key, value) VALUES ('archive_id', ?)", (uuid.uuid4().hex,))
+    conn.execute("INSERT OR IGNORE INTO archive_meta (key, value) VALUES ('generation', 0)")
+
+
+def _init_shard_registry(conn: sqlite3.Connection) -> None:
+    # Further archive databases federated with this one (see shards.py); only the main
+    # database's registry is read. number is the shard's id block, 0 being the main database.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archive_shards (
+            number INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            path TEXT NOT NULL,
+            route TEXT,
+            read_only INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        );
+        """
+    )
+
+
+def _init_content_store(conn: sqlite3.Connection) -> None:
+    # Preset dictionaries for compressed message content (see codec.py). Rows refer to
+    # them by id, so they are only ever added.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS content_dictionaries (
+            id INTEGER PRIMARY KEY,
+            dictionary BLOB NOT NULL,
+            sample_size INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        """
+    )
+    # Message text whether or not it is stored compressed.
+    conn.execute(
+        """
+        CREATE VIEW IF NOT EXISTS messages_text AS
+        SELECT id, content_text(content) AS content FROM messages;
+        """
+    )
+
+
+# Built by the "indexes" backfill, one statement per batch, cheapest first.
+INDEXES = [
+    # Export ids of ChatGPT conversations and message nodes, so re-imports update
+    # conversations in place. Re-imports look these up per batch, so bulk loads keep them.
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_conversations_external
+    ON conversations (external_id) WHERE external_id IS NOT NULL;
+    """,
+    # Conversations imported before export ids were stored, which imports match by
+    # creation time and title (ingest._adopt_legacy_conversation).
+    """
+    CREATE INDEX IF NOT EXISTS idx_conversations_legacy
+    ON conversations (created_at, title) WHERE external_id IS NULL;
+    """,
+    # Conversation listing pages by (created_at_ms, id) descending, optionally within one
+    # source or a title prefix; each index matches one of those access paths.
+    """
+    CREATE INDEX IF NOT EXISTS idx_conversations_created_time
+    ON conversations (created_at_ms DESC, id DESC);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_conversations_source_time
+    ON conversations (source, created_at_ms DESC, id DESC);
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_conversations_title ON conversations (title COLLATE NOCASE, id);",
+    # Deleting a conversation cascades to its attachments and nulls message_id for
+    # each deleted message; both lookups need an index to avoid a scan per row.
+    "CREATE INDEX IF NOT EXISTS idx_attachments_conversation ON attachments (conversation_id);",
+    "CREATE INDEX IF NOT EXISTS idx_attachments_message ON attachments (message_id);",
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_external
+    ON messages (conversation_id, external_id) WHERE external_id IS NOT NULL;
+    """,
+    # Messages are always read per conversation in (timestamp_ms, id) order.
+    """
+    CREATE INDEX IF NOT EXISTS idx_messages_conversation_time
+    ON messages (conversation_id, timestamp_ms, id);
+    """,
+    # Filtered searches and the timeline scan messages in (timestamp_ms, id) order, either
+    # for one role or across all of them; per-conversation filters use the index above.
+    "CREATE INDEX IF NOT EXISTS idx_messages_role_time ON messages (role, timestamp_ms, id);",
+    "CREATE INDEX IF NOT EXISTS idx_messages_time ON messages (timestamp_ms, id);",
+]
+
+
+def _start_indexes(conn: sqlite3.Connection) -> int:
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    missing = [sql for sql in INDEXES if _index_name(sql) not in existing]
+    if not missing:
+        return 0
+    # Indexes on empty tables are built in no time.
+    if not conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+        for sql in missing:
+            conn.execute(sql)
+        return 0
+    return len(INDEXES)
+
+
+def _index_name(sql: str) -> str:
+    return sql.split("EXISTS", 1)[1].split()[0]
+
+
+def _step_indexes(conn: sqlite3.Connection, cursor: int, bound: int) -> int:
+    # SQLite builds an index in one statement. Readers carry on meanwhile in WAL mode;
+    # writers wait for that one index.
+    conn.execute(INDEXES[cursor])
+    return cursor + 1
+
+
+def _start_epochs(conn: sqlite3.Connection) -> int:
+    """Fill the epoch-millisecond columns of conversations stored before they existed.
+
+    Messages are filled in batches by _step_epochs. New rows always get both.
+    """
+    if not conn.execute("SELECT 1 FROM messages WHERE timestamp_ms IS NULL LIMIT 1").fetchone():
+        if not conn.execute("SELECT 1 FROM conversations WHERE created_at_ms IS NULL LIMIT 1").fetchone():
+            return 0
+
+    conn.create_function("epoch_ms", 1, epoch_ms, deterministic=True)
+    # Text nothing can read falls back to the import time, as it does for new imports.
+    now_ms = int(time.time() * 1000)
+    conn.execute(
+        """
+        UPDATE conversations
+        SET created_at_ms = COALESCE(epoch_ms(created_at), ?),
+            updated_at_ms = COALESCE(epoch_ms(updated_at), epoch_ms(created_at), ?)
+        WHERE created_at_ms IS NULL
+        """,
+        (now_ms, now_ms),
+    )
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+
+def _step_epochs(conn: sqlite3.Connection, cursor: int, bound: int) -> int:
+    end = batch_end(conn, "messages", cursor, bound)
+    conn.create_function("epoch_ms", 1, epoch_ms, deterministic=True)
+    conn.execute(
+        """
+        UPDATE messages
+        SET timestamp_ms = COALESCE(
+            epoch_ms(timestamp),
+            (SELECT created_at_ms FROM conversations WHERE conversations.id = messages.conversation_id)
         )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                conversation_id INTEGER NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
-            );
+        WHERE id > ? AND id <= ? AND timestamp_ms IS NULL
+        """,
+        (cursor, end),
+    )
+    return end
+
+
+def message_time(conn: sqlite3.Connection, table: str = "messages") -> str:
+    """SQL for the timestamp_ms of table's messages, also before the epochs backfill has filled it.
+
+    Until then, rows it hasn't reached get the value it will give them. The expression
+    can't use the indexes on timestamp_ms, which are built after it anyway.
+    """
+    if not pending(conn, "epochs"):
+        return f"{table}.timestamp_ms"
+    return (
+        f"COALESCE({table}.timestamp_ms, epoch_ms({table}.timestamp), "
+        f"(SELECT created_at_ms FROM conversations WHERE conversations.id = {table}.conversation_id))"
+    )
+
+
+def message_count(conn: sqlite3.Connection, table: str = "conversations") -> str:
+    """SQL for the message_count of table's conversations, counted until the rollups backfill fills it."""
+    if not pending(conn, "rollups"):
+        return f"{table}.message_count"
+    return f"(SELECT COUNT(*) FROM messages WHERE messages.conversation_id = {table}.id)"
+
+
+def rollup_tables(conn: sqlite3.Connection) -> tuple[str, str]:
+    """What to read source_rollups and daily_rollups from: the tables, or until the
+    rollups backfill has built them, the same rows aggregated from the archive."""
+    if not pending(conn, "rollups"):
+        return "source_rollups", "daily_rollups"
+    return f"({stats.SOURCE_COUNTS})", f"({stats.daily_counts(message_time(conn, 'm'))})"
+
+
+def _start_rollups(conn: sqlite3.Connection) -> int:
+    # Versions before schema_version built them once and left this marker.
+    if conn.execute("SELECT 1 FROM archive_meta WHERE key = 'rollups_built'").fetchone():
+        return 0
+    return 1 if conn.execute("SELECT 1 FROM conversations LIMIT 1").fetchone() else 0
+
+
+def _step_rollups(conn: sqlite3.Connection, cursor: int, bound: int) -> int:
+    # A single pass: ingestion keeps adding to the rollups meanwhile, so counting part of
+    # the rows now and the rest later would count what it adds in between twice.
+    stats.rebuild(conn, message_time(conn, "m"))
+    return bound
+
+
+def _init_search_table(conn: sqlite3.Connection) -> None:
+    # Indexes built before content could be compressed read the text straight from
+    # messages; they are dropped along with their triggers and rebuilt from the view.
+    existing = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+    if existing and "messages_text" not in existing[0]:
+        for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger};")
+        conn.execute("DROP TABLE messages_fts;")
+
+    # messages_fts is an external-content FTS5 table: it stores only the inverted
+    # index and reads the text back (for snippets and rebuilds) from messages_text,
+    # kept in sync by triggers.
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content,
+            content = 'messages_text',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        );
+        """
+    )
+
+
+# While the search index is being built, rows between the cursor and the bound aren't in
+# it yet; removing one that isn't would corrupt the index.
+_SEARCH_BACKFILL_INDEXED = """
+    (old.id <= (SELECT cursor FROM schema_backfills WHERE name = 'search_index')
+     OR old.id > (SELECT bound FROM schema_backfills WHERE name = 'search_index'))
+"""
+
+
+def _create_search_triggers(conn: sqlite3.Connection, building: bool = False) -> None:
+    indexed = _SEARCH_BACKFILL_INDEXED if building else None
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, content_text(new.content));
+        END;
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        {f"WHEN {indexed}" if indexed else ""} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content)
+            VALUES ('delete', old.id, content_text(old.content));
+        END;
+        """
+    )
+    # Compressing or decompressing a row rewrites content without changing its text.
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages
+        WHEN content_text(old.content) IS NOT content_text(new.content) {f"AND {indexed}" if indexed else ""} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content)
+            VALUES ('delete', old.id, content_text(old.content));
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, content_text(new.content));
+        END;
+        """
+    )
+
+
+def _start_search_index(conn: sqlite3.Connection) -> int:
+    triggers = dict(
+        conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'messages_fts_%'")
+    )
+    # A missing trigger means the index was never built, or a deferred bulk load was
+    # interrupted before it caught the index up; either way it is built again.
+    if "messages_fts_insert" in triggers and "schema_backfills" not in triggers.get("messages_fts_delete", ""):
+        return 0
+
+    for name in triggers:
+        conn.execute(f"DROP TRIGGER {name};")
+    bound = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    if bound:
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all');")
+        # Messages inserted from now on are indexed as they are written.
+        _create_search_triggers(conn, building=True)
+    return bound
+
+
+def _step_search_index(conn: sqlite3.Connection, cursor: int, bound: int) -> int:
+    end = batch_end(conn, "messages", cursor, bound)
+    conn.execute(
+        "INSERT INTO messages_fts (rowid, content) SELECT id, content FROM messages_text WHERE id > ? AND id <= ?",
+        (cursor, end),
+    )
+    return end
+
+
+def _finish_search_index(conn: sqlite3.Connection) -> None:
+    conn.execute("DROP TRIGGER IF EXISTS messages_fts_delete;")
+    conn.execute("DROP TRIGGER IF EXISTS messages_fts_update;")
+    _create_search_triggers(conn)
+
+
+def _no_ddl(conn: sqlite3.Connection) -> None:
+    """For migrations whose only work is their backfills."""
+
+
+# In the order they run.
+BACKFILLS = {
+    backfill.name: backfill
+    for backfill in (
+        # Until these two are done, readers compute what they fill in (message_time(),
+        # message_count(), rollup_tables()). The rollups go first, being a single pass.
+        Backfill("rollups", _start_rollups, _step_rollups),
+        Backfill("epochs", _start_epochs, _step_epochs),
+        Backfill("indexes", _start_indexes, _step_indexes),
+        Backfill("search_index", _start_search_index, _step_search_index, _finish_search_index),
+    )
+}
+
+# Append new migrations with the next version; never change one that has shipped.
+MIGRATIONS = [
+    Migration(1, "baseline", _create_schema, backfills=("epochs", "indexes", "rollups", "search_index")),
+    Migration(2, "legacy_conversation_index", _no_ddl, backfills=("indexes",)),
+]
+
+
+def rebuild_search_index(conn: sqlite3.Connection) -> None:
+    # Indexes every row in one go, which also completes a backfill of it in progress.
+    _finish_search_index(conn)
+    complete(conn, "search_index")
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');")
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize');")
+
+
+def apply_bulk_load_pragmas(conn: sqlite3.Connection) -> None:
+    for name, value in BULK_LOAD_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value};")
+
+
+class DeferredIndexes:
+    """Drops secondary indexes and search triggers for the duration of bulk loads.
+
+    Suspensions nest, so overlapping imports share one window. When the last one
+    resumes, the saved DDL is replayed and messages inserted meanwhile are added to
+    the search index in one pass. Only inserted messages are caught up, so the window
+    must not be used to update or delete messages.
+    """
+
+    # Needed by the bulk load itself to match re-imported conversations.
+    KEEP = ("idx_conversations_external", "idx_conversations_legacy", "idx_messages_external")
+
+    def __init__(self) -> None:
+        self._depth = 0
+        self._statements: list[str] = []
+        self._watermark = 0
+
+    @property
+    def active(self) -> bool:
+        return self._depth > 0
+
+    def suspend(self, conn: sqlite3.Connection) -> None:
+        self._depth += 1
+        if self._depth > 1:
+            return
+
+        rows = conn.execute(
             """
-        )
+            SELECT type, name, sql
+            FROM sqlite_master
+            WHERE sql IS NOT NULL
+              AND (
+                (type = 'index' AND tbl_name IN ('conversations', 'messages', 'attachments'))
+                OR (type = 'trigger' AND tbl_name = 'messages' AND name LIKE 'messages_fts_%')
+              )
+              AND name NOT IN ({})
+            """.format(", ".join("?" * len(self.KEEP))),
+            self.KEEP,
+        ).fetchall()
+        self._watermark = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        self._statements = [row[2] for row in rows]
+        for object_type, name, _ in rows:
+            conn.execute(f'DROP {object_type.upper()} IF EXISTS "{name}"')
+        # Left behind if the process dies before resume(), so init_db() rebuilds them.
+        conn.execute("INSERT OR REPLACE INTO archive_meta (key, value) VALUES ('indexes_suspended', ?)", (os.getpid(),))
+        conn.commit()
+
+    def resume(self, conn: sqlite3.Connection) -> None:
+        self._depth -= 1
+        if self._depth > 0:
+            return
+
         conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS attachments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                conversation_id INTEGER NOT NULL,
-                message_id INTEGER,
-                file_id TEXT,
-                file_name TEXT NOT NULL,
-                mime_type TEXT,
-                local_path TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE,
-                FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE SET NULL
-            );
-            """
+            "INSERT INTO messages_fts (rowid, content) SELECT id, content FROM messages_text WHERE id > ?",
+            (self._watermark,),
         )
+        for statement in self._statements:
+            conn.execute(statement)
+        conn.execute("DELETE FROM archive_meta WHERE key = 'indexes_suspended'")
+        conn.commit()
+        self._statements = []
+
+
+deferred_indexes = DeferredIndexes()
+
+
+def _connection_pragmas() -> dict[str, str | int]:
+    return {
+        name: os.environ.get(f"CHAT_ARCHIVE_SQLITE_{name.upper()}", default)
+        for name, default in CONNECTION_PRAGMAS.items()
+    }
+
+
+class ConnectionPool:
+    """Per-thread read-only connections plus one writer connection shared under a lock.
+
+    In WAL mode readers see the last committed state and never wait for the writer,
+    so browsing and search keep working while an import is writing. An immutable pool
+    serves a sealed shard: its readers open the file with immutable=1, so SQLite takes no
+    locks and never checks it for changes, and it has no writer.
+    """
+
+    def __init__(self, path: Path, immutable: bool = False) -> None:
+        self.path = path
+        self.immutable = immutable
+        self._local = threading.local()
+        self._writer: sqlite3.Connection | None = None
+        self._writer_lock = threading.RLock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "readers_opened": 0,
+            "reader_checkouts": 0,
+            "writer_checkouts": 0,
+            "writer_wait_seconds": 0.0,
+            "writer_rollbacks": 0,
+        }
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        if read_only:
+            conn = sqlite3.connect(
+                f"{self.path.as_uri()}?mode=ro{'&immutable=1' if self.immutable else ''}",
+                uri=True,
+                check_same_thread=False,
+                cached_statements=STATEMENT_CACHE_SIZE,
+                factory=connection_factory(),
+            )
+        else:
+            conn = sqlite3.connect(
+                self.path,
+                check_same_thread=False,
+                cached_statements=STATEMENT_CACHE_SIZE,
+                factory=connection_factory(),
+            )
+        conn.row_factory = sqlite3.Row
+        register_functions(conn, self.path)
+        # For message_time() while the epochs backfill runs.
+        conn.create_function("epoch_ms", 1, epoch_ms, deterministic=True)
+        pragmas = _connection_pragmas()
+        if self.immutable:
+            pragmas["mmap_size"] = SEALED_MMAP_SIZE
+        for name, value in pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        return conn
+
+    def _count(self, name: str, amount: float = 1) -> None:
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    @contextmanager
+    def reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(read_only=True)
+            self._count("readers_opened")
+        self._count("reader_checkouts")
+        yield conn
+
+    @contextmanager
+    def writer(self):
+        if self.immutable:
+            raise sqlite3.OperationalError(f"{self.path.name} is sealed read-only")
+        started = time.perf_counter()
+        with self._writer_lock:
+            self._count("writer_wait_seconds", time.perf_counter() - started)
+            self._count("writer_checkouts")
+            if self._writer is None:
+                self._writer = self._connect(read_only=False)
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                self._count("writer_rollbacks")
+                raise
+
+    def stats(self) -> dict[str, int | float | bool]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["writer_open"] = self._writer is not None
+        return stats
+
+    def close(self) -> None:
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+
+class ArchiveGeneration:
+    """Counts committed changes to conversations, messages and attachments.
+
+    Writers bump it after each commit that changes them; read endpoints put it in their
+    ETags and cache keys. It is stored in archive_meta so it survives restarts, and kept
+    in memory so checking it needs no query. The archive id tells apart databases whose
+    counters happen to be equal. Each database file (see shards.py) has its own.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stamps: dict[Path, tuple[str, int]] = {}
+
+    def current(self, path: Path | None = None) -> tuple[str, int]:
+        path = path or DB_PATH
+        with self._lock:
+            stamp = self._stamps.get(path)
+            if stamp is None:
+                with closing(sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True)) as conn:
+                    stored = dict(conn.execute("SELECT key, value FROM archive_meta").fetchall())
+                stamp = self._stamps[path] = (stored["archive_id"], stored["generation"])
+            return stamp
+
+    def bump(self, conn: sqlite3.Connection, path: Path | None = None) -> int:
+        """Advance the counter of the database conn writes to (path); call after committing the change itself.
+
+        Bumping afterwards means a response built in between is cached under the old
+        generation at worst, never stale data under the new one.
+        """
+        value = conn.execute(
+            "UPDATE archive_meta SET value = value + 1 WHERE key = 'generation' RETURNING value"
+        ).fetchone()[0]
+        conn.commit()
+        path = path or DB_PATH
+        with self._lock:
+            stamp = self._stamps.get(path)
+            if stamp is not None:
+                self._stamps[path] = (stamp[0], max(stamp[1], value))
+        return value
+
+
+archive_generation = ArchiveGeneration()
+
+_pools: dict[Path, ConnectionPool] = {}
+_pool_lock = threading.Lock()
+
+
+def get_pool(path: Path | None = None, immutable: bool = False) -> ConnectionPool:
+    """The pool of the database at path, by default DB_PATH."""
+    path = path or DB_PATH
+    with _pool_lock:
+        pool = _pools.get(path)
+        if pool is None or pool.immutable != immutable:
+            if pool is not None:
+                pool.close()
+            pool = _pools[path] = ConnectionPool(path, immutable)
+        return pool
+
+
+def close_pools() -> None:
+    with _pool_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
 
 
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
+    with get_pool().reader() as conn:
+        yield conn
+
+
+@contextmanager
+def get_write_db():
+    with get_pool().writer() as conn:
+        yield conn
+
+
+@contextmanager
+def snapshot_db(pool: ConnectionPool | None = None):
+    """A dedicated read-only connection inside one read transaction.
+
+    Everything read through it sees the database (of pool, by default DB_PATH's) as of
+    the first query, however long the caller takes, and it may be used from one thread
+    after another. Pooled readers are shared between requests and can't be held that long.
+    """
+    conn = (pool or get_pool())._connect(read_only=True)
     try:
+        conn.execute("BEGIN")
         yield conn
-        conn.commit()
     finally:
         conn.close()
+
+
+T = TypeVar("T")
+
+_executors: dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def _executor(kind: str) -> ThreadPoolExecutor:
+    with _executors_lock:
+        executor = _executors.get(kind)
+        if executor is None:
+            workers = 1 if kind == "write" else READ_WORKERS
+            executor = _executors[kind] = ThreadPoolExecutor(workers, thread_name_prefix=f"db-{kind}")
+        return executor
+
+
+async def run_read(fn: Callable[..., T], *args: Any) -> T:
+    """Run fn(*args) on a database reader thread; fn opens its own get_db() connection."""
+    return await asyncio.get_running_loop().run_in_executor(_executor("read"), functools.partial(fn, *args))
+
+
+async def run_write(fn: Callable[..., T], *args: Any) -> T:
+    """Like run_read, for functions that use get_write_db().
+
+    Writes go through a single thread, so a request waiting on the writer lock ties up
+    that thread rather than one of the readers.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_executor("write"), functools.partial(fn, *args))
+
+
+def run_parallel(calls: list[Callable[[], T]]) -> list[T]:
+    """Run the calls concurrently and return their results in order.
+
+    Used from reader threads to query several shards at once. The calls run on a pool of
+    their own, never on the reader pool their caller may be holding a thread of, and
+    must not fan out further.
+    """
+    if len(calls) <= 1:
+        return [call() for call in calls]
+    futures = [_executor("fan-out").submit(call) for call in calls]
+    return [future.result() for future in futures]
+
+
+def shutdown_executors() -> None:
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
@@ -0,0 +1,206 @@
+"""
+Streaming export of the whole archive, for backups and moving it between machines.
+
+The archive is written as newline-delimited JSON: an "archive" header record, then each
+conversation followed by its messages (in timestamp order) and its attachments. Every
+record has a "type" and all columns of its row. The ZIP format puts these records in
+archive.ndjson next to the media files, stored under the attachments' local_path.
+
+Exports read from one snapshot connection, so they are consistent even while imports
+run, and fetch rows in batches; SQLite renders each record with json_object(). Output is
+produced, and compressed, in chunks of about EXPORT_CHUNK_BYTES, so memory use doesn't
+depend on the size of the archive. Shards (see shards.py) are exported one at a time, each
+from its own pool.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, timezone
+import io
+import json
+import os
+import sqlite3
+from typing import Iterator
+import zipfile
+import zlib
+
+import db
+from ingest import COPY_CHUNK_SIZE
+from media import blob_file
+
+FORMAT_VERSION = 1
+EXPORT_BATCH = 2000
+EXPORT_CHUNK_BYTES = 1024 * 1024
+# Level 1 deflates text several times faster than the default at a slightly larger size.
+EXPORT_COMPRESS_LEVEL = int(os.environ.get("CHAT_ARCHIVE_EXPORT_COMPRESS_LEVEL", "1"))
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "ndjson.gz": ("application/gzip", "ndjson.gz"),
+    "zip": ("application/zip", "zip"),
+}
+
+CONVERSATION_RECORDS = """
+    SELECT id, json_object(
+        'type', 'conversation', 'id', id, 'title', title, 'source', source,
+        'created_at', created_at, 'created_at_ms', created_at_ms,
+        'updated_at', updated_at, 'updated_at_ms', updated_at_ms,
+        'external_id', external_id, 'archive_sha256', archive_sha256
+    )
+    FROM conversations
+    ORDER BY id
+"""
+MESSAGE_RECORDS = """
+    SELECT conversation_id, json_object(
+        'type', 'message', 'id', id, 'conversation_id', conversation_id, 'role', role,
+        'content', content_text(content), 'timestamp', timestamp, 'timestamp_ms', {time},
+        'external_id', external_id
+    )
+    FROM messages
+    ORDER BY conversation_id, {time}, id
+"""
+ATTACHMENT_RECORDS = """
+    SELECT conversation_id, json_object(
+        'type', 'attachment', 'id', id, 'conversation_id', conversation_id,
+        'message_id', message_id, 'file_id', file_id, 'file_name', file_name,
+        'mime_type', mime_type, 'local_path', local_path, 'created_at', created_at,
+        'blob_sha256', blob_sha256
+    )
+    FROM attachments
+    ORDER BY conversation_id, id
+"""
+
+
+def export_filename(format: str) -> str:
+    return f"chat-archive-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.{FORMATS[format][1]}"
+
+
+def _rows(conn: sqlite3.Connection, sql: str) -> Iterator[tuple]:
+    # A dedicated cursor per table, so the three stay open side by side.
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(sql)
+    while rows := cursor.fetchmany(EXPORT_BATCH):
+        yield from rows
+
+
+def _records(conn: sqlite3.Connection) -> Iterator[str]:
+    """Each conversation's record, then its messages' and attachments' records."""
+    meta = dict(conn.execute("SELECT key, value FROM archive_meta").fetchall())
+    yield json.dumps(
+        {
+            "type": "archive",
+            "format_version": FORMAT_VERSION,
+            "archive_id": meta["archive_id"],
+            "generation": meta["generation"],
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+        },
+        separators=(",", ":"),
+    )
+
+    # Child rows come sorted by conversation id, so each list is merged with the
+    # conversations in a single pass.
+    message_records = MESSAGE_RECORDS.format(time=db.message_time(conn))
+    children = [_rows(conn, message_records), _rows(conn, ATTACHMENT_RECORDS)]
+    pending = [next(rows, None) for rows in children]
+    for conversation_id, record in _rows(conn, CONVERSATION_RECORDS):
+        yield record
+        for index, rows in enumerate(children):
+            row = pending[index]
+            while row is not None and row[0] <= conversation_id:
+                if row[0] == conversation_id:
+                    yield row[1]
+                row = next(rows, None)
+            pending[index] = row
+
+
+def _chunks(records: Iterator[str]) -> Iterator[bytes]:
+    lines: list[str] = []
+    size = 0
+    for record in records:
+        lines.append(record)
+        size += len(record)
+        if size >= EXPORT_CHUNK_BYTES:
+            lines.append("")
+            yield "\n".join(lines).encode()
+            lines, size = [], 0
+    if lines:
+        lines.append("")
+        yield "\n".join(lines).encode()
+
+
+def _media_paths(conn: sqlite3.Connection, include_archives: bool) -> Iterator[str]:
+    """local_path of every stored file the archive references, each once."""
+    blobs = "SELECT local_path FROM media_blobs WHERE ref_count > 0"
+    if not include_archives:
+        blobs += " AND sha256 NOT IN (SELECT archive_sha256 FROM conversations WHERE archive_sha256 IS NOT NULL)"
+    for (local_path,) in _rows(conn, blobs):
+        yield local_path
+    # Files from before the media store, until migrate-media moves them.
+    for (local_path,) in _rows(conn, "SELECT DISTINCT local_path FROM attachments WHERE blob_sha256 IS NULL"):
+        yield local_path
+
+
+def stream_ndjson(compress: bool = False, pool: db.ConnectionPool | None = None) -> Iterator[bytes]:
+    with db.snapshot_db(pool) as conn:
+        if not compress:
+            yield from _chunks(_records(conn))
+            return
+
+        # wbits=31 writes a gzip header and trailer around the deflate stream.
+        compressor = zlib.compressobj(EXPORT_COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        for chunk in _chunks(_records(conn)):
+            if compressed := compressor.compress(chunk):
+                yield compressed
+        yield compressor.flush()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Unseekable file that collects what ZipFile writes until it is drained."""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> Iterator[bytes]:
+        if self._chunks:
+            yield b"".join(self._chunks)
+            self._chunks = []
+
+
+def stream_zip(include_archives: bool = False, pool: db.ConnectionPool | None = None) -> Iterator[bytes]:
+    # ZipFile can't seek back in the sink, so it writes each member's sizes and CRC after
+    # its data; the archive.ndjson member may exceed 4 GiB, hence ZIP64 for it.
+    sink = _ChunkSink()
+    with (
+        db.snapshot_db(pool) as conn,
+        zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, compresslevel=EXPORT_COMPRESS_LEVEL) as archive,
+    ):
+        with archive.open("archive.ndjson", "w", force_zip64=True) as member:
+            for chunk in _chunks(_records(conn)):
+                member.write(chunk)
+                yield from sink.drain()
+
+        # Attachments are mostly images and documents that are compressed already, so they
+        # are stored as they are (ZipInfo.from_file defaults to ZIP_STORED).
+        for local_path in _media_paths(conn, include_archives):
+            path = blob_file(db.MEDIA_DIR, local_path)
+            try:
+                source = path.open("rb")
+            except FileNotFoundError:
+                # Deleted by a garbage collection that committed after the snapshot.
+                continue
+            with source:
+                info = zipfile.ZipInfo.from_file(path, local_path)
+                with archive.open(info, "w") as member:
+                    while data := source.read(COPY_CHUNK_SIZE):
+                        member.write(data)
+                        yield from sink.drain()
+    # The central directory is written when the archive closes.
+    yield from sink.drain()
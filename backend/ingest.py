@@ -0,0 +1,549 @@
+"""
+Turns uploaded export files into rows.
+
+read_export() parses a spooled upload into ExportBatch objects without writing to the
+database, so it can run in a worker process; insert_conversations() writes a batch
+and is only ever called from the ingestion writer. ChatGPT conversations are matched
+to earlier imports by their export id, so re-importing a cumulative export only adds
+what changed.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import datetime
+import json
+import mimetypes
+import os
+from pathlib import Path, PurePosixPath
+import re
+from typing import BinaryIO, Callable, Iterator
+import zipfile
+
+from codec import COMPRESS_CONTENT, current_dictionary, get_codec
+import db
+from db import MEDIA_DIR, apply_bulk_load_pragmas, archive_generation, deferred_indexes
+from media import collect_garbage, register_blobs, store_blob
+from metrics import INGEST_BYTES, record_ingest
+from parsers import ParsedConversation, iter_chatgpt_conversations, parse_chat_export
+from stats import RollupDelta
+
+# ZIP members are copied in chunks of this size so peak memory stays flat
+# regardless of export size.
+COPY_CHUNK_SIZE = 1024 * 1024
+# Conversations are handed to the writer, and committed, in batches of this size.
+INGEST_BATCH_SIZE = 500
+# Processes parsing one export's conversations.json. Each ingest worker runs its own
+# pool, so an import box uses up to INGEST_WORKERS * PARSE_WORKERS cores; 1 parses inline.
+PARSE_WORKERS = int(os.environ.get("CHAT_ARCHIVE_PARSE_WORKERS", "1"))
+
+MediaRecord = dict[str, str | int | None]
+MediaIndex = dict[str, MediaRecord]
+
+ChangeFilter = Callable[[list[ParsedConversation]], list[ParsedConversation]]
+
+_FILE_ID_RE = re.compile(r"^(file[-_][a-z0-9]+)")
+
+
+@dataclass
+class ExportBatch:
+    file_name: str
+    conversations: list[ParsedConversation] = field(default_factory=list)
+    media_index: MediaIndex | None = None
+    # The stored ZIP this batch came from, if any.
+    archive: MediaRecord | None = None
+    bytes_read: int = 0
+    total_bytes: int = 0
+    # Conversations left out because the archive already has them up to date.
+    unchanged: int = 0
+    # Worker time spent producing this batch.
+    seconds: float = 0.0
+
+
+class _CountingReader:
+    def __init__(self, stream: BinaryIO) -> None:
+        self._stream = stream
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self.count += len(data)
+        return data
+
+
+def _safe_media_name(file_name: str) -> str:
+    return PurePosixPath(file_name).name or "attachment.bin"
+
+
+def _find_conversations_member(archive: zipfile.ZipFile) -> str:
+    conversations_member = next(
+        (name for name in archive.namelist() if PurePosixPath(name).name == "conversations.json"),
+        None,
+    )
+    if not conversations_member:
+        raise ValueError("ZIP export is missing conversations.json")
+    return conversations_member
+
+
+def _member_lookup(archive: zipfile.ZipFile, conversations_member: str) -> dict[str, zipfile.ZipInfo]:
+    # ChatGPT stores uploads as "file-<id>-<original name>", while messages reference them
+    # by name or by file id, so index members under both.
+    lookup: dict[str, zipfile.ZipInfo] = {}
+    for info in archive.infolist():
+        if info.is_dir() or info.filename == conversations_member:
+            continue
+        safe_name = _safe_media_name(info.filename).lower()
+        lookup.setdefault(safe_name, info)
+        file_id = _FILE_ID_RE.match(safe_name)
+        if file_id:
+            lookup.setdefault(file_id.group(1), info)
+    return lookup
+
+
+def _media_record(file_name: str, sha256: str, relative_path: PurePosixPath, size: int) -> MediaRecord:
+    mime_type, _ = mimetypes.guess_type(file_name)
+    return {
+        "file_name": file_name,
+        "local_path": str(PurePosixPath("media") / relative_path),
+        "mime_type": mime_type,
+        "sha256": sha256,
+        "size": size,
+    }
+
+
+def extract_referenced_files(
+    archive: zipfile.ZipFile,
+    members: dict[str, zipfile.ZipInfo],
+    conversations: list[ParsedConversation],
+    extracted: dict[str, MediaRecord],
+    media_dir: Path = MEDIA_DIR,
+) -> MediaIndex:
+    """Copy the members these conversations reference into the media store.
+
+    Returns the index entries added for this batch, keyed by the names and file ids the
+    references use; `extracted` tracks members already copied so each is stored once.
+    """
+    added: MediaIndex = {}
+    for parsed in conversations:
+        for ref in parsed.attachment_refs:
+            if not ref.file_name:
+                continue
+            keys = [key.lower() for key in (ref.file_name, _safe_media_name(ref.file_name), ref.file_id) if key]
+            info = next((members[key] for key in keys if key in members), None)
+            if info is None:
+                continue
+
+            record = extracted.get(info.filename)
+            if record is None:
+                safe_name = _safe_media_name(info.filename)
+                with archive.open(info) as member:
+                    sha256, relative_path, size = store_blob(
+                        member, media_dir, PurePosixPath(safe_name).suffix, chunk_size=COPY_CHUNK_SIZE
+                    )
+                record = extracted[info.filename] = _media_record(safe_name, sha256, relative_path, size)
+            for key in keys:
+                added[key] = record
+    return added
+
+
+def _read_simple_json(path: Path, file_name: str) -> Iterator[ExportBatch]:
+    raw = path.read_bytes()
+    yield ExportBatch(file_name=file_name, total_bytes=len(raw))
+
+    parsed = parse_chat_export(raw, fallback_title=Path(file_name).stem)
+    yield ExportBatch(file_name=file_name, conversations=[parsed], bytes_read=len(raw))
+
+
+def _read_zip_export(
+    path: Path,
+    file_name: str,
+    media_dir: Path,
+    batch_size: int,
+    change_filter: ChangeFilter | None,
+    parse_workers: int,
+) -> Iterator[ExportBatch]:
+    with zipfile.ZipFile(path) as archive:
+        conversations_member = _find_conversations_member(archive)
+        # The archive itself is kept so members no conversation references can still be read
+        # on demand; its conversations hold a reference to it like attachments do to media.
+        # It is stored only once it is known to be an export, as nothing would reference it
+        # otherwise.
+        with path.open("rb") as source:
+            sha256, relative_path, size = store_blob(source, media_dir, ".zip", chunk_size=COPY_CHUNK_SIZE)
+        archive_record = _media_record(_safe_media_name(file_name), sha256, relative_path, size)
+
+        members = _member_lookup(archive, conversations_member)
+        conversations_size = archive.getinfo(conversations_member).file_size
+        yield ExportBatch(
+            file_name=file_name, archive=archive_record, bytes_read=size, total_bytes=size + conversations_size
+        )
+
+        extracted: dict[str, MediaRecord] = {}
+        with archive.open(conversations_member) as member:
+            stream = _CountingReader(member)
+            reported = 0
+
+            def conversation_batch(parsed_batch: list[ParsedConversation]) -> ExportBatch:
+                nonlocal reported
+                # Dropping unchanged conversations here also skips extracting their media.
+                conversations = change_filter(parsed_batch) if change_filter else parsed_batch
+                known = len(extracted)
+                media_index = extract_referenced_files(archive, members, conversations, extracted, media_dir)
+                media_bytes = sum(int(record["size"]) for record in list(extracted.values())[known:])
+                parsed_bytes, reported = stream.count - reported, stream.count
+                return ExportBatch(
+                    file_name=file_name,
+                    conversations=conversations,
+                    media_index=media_index,
+                    archive=archive_record,
+                    bytes_read=parsed_bytes + media_bytes,
+                    total_bytes=media_bytes,
+                    unchanged=len(parsed_batch) - len(conversations),
+                )
+
+            batch: list[ParsedConversation] = []
+            shipped = 0
+            try:
+                for parsed in iter_chatgpt_conversations(stream, workers=parse_workers):
+                    batch.append(parsed)
+                    if len(batch) >= batch_size:
+                        yield conversation_batch(batch)
+                        shipped = len(extracted)
+                        batch = []
+
+                yield conversation_batch(batch)
+            except Exception:
+                # Members stored for a batch that failed part way are still handed over, so
+                # they are registered and garbage collection can remove them.
+                unshipped = list(extracted.values())[shipped:]
+                if unshipped:
+                    yield ExportBatch(
+                        file_name=file_name,
+                        media_index={str(record["local_path"]): record for record in unshipped},
+                        archive=archive_record,
+                    )
+                raise
+
+
+def read_export(
+    path: Path,
+    file_name: str,
+    media_dir: Path = MEDIA_DIR,
+    batch_size: int = INGEST_BATCH_SIZE,
+    change_filter: ChangeFilter | None = None,
+    parse_workers: int = PARSE_WORKERS,
+) -> Iterator[ExportBatch]:
+    """Yield a file's batches: first one carrying total_bytes, then conversations with their media.
+
+    change_filter, if given, drops conversations that don't need importing (see
+    drop_unchanged); the writer re-checks, so it only needs to be a good guess.
+    parse_workers > 1 parses conversations.json in a process pool, in the same order.
+    """
+    if file_name.lower().endswith(".json"):
+        return _read_simple_json(path, file_name)
+    if file_name.lower().endswith(".zip"):
+        return _read_zip_export(path, file_name, media_dir, batch_size, change_filter, parse_workers)
+    raise ValueError("Only JSON and ZIP files are supported")
+
+
+def register_media(conn, media_index: MediaIndex, archive: MediaRecord | None = None) -> None:
+    """Record stored blobs before rows reference them; triggers then keep their reference counts."""
+    records = [*media_index.values(), archive] if archive else media_index.values()
+    now = datetime.utcnow().isoformat()
+    register_blobs(
+        conn,
+        [
+            (str(media["sha256"]), str(media["local_path"]), int(media["size"]), media["mime_type"], now)
+            for media in records
+        ],
+    )
+
+
+def _next_id(conn, table: str) -> int:
+    # AUTOINCREMENT never reuses ids, so respect sqlite_sequence as well as MAX(id).
+    row = conn.execute(
+        f"""
+        SELECT MAX(
+            COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0),
+            COALESCE((SELECT MAX(id) FROM {table}), 0)
+        )
+        """,
+        (table,),
+    ).fetchone()
+    return row[0] + 1
+
+
+@dataclass
+class InsertResult:
+    # Conversations that were inserted or had messages appended.
+    conversation_ids: list[int] = field(default_factory=list)
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    messages: int = 0
+
+
+def stored_versions(conn, external_ids: list[str]) -> dict[str, tuple[int, int, str]]:
+    """Map export conversation ids already in the archive to their (id, updated_at_ms, source)."""
+    if not external_ids:
+        return {}
+    rows = conn.execute(
+        """
+        SELECT id, external_id, updated_at_ms, source
+        FROM conversations
+        WHERE external_id IN (SELECT value FROM json_each(?))
+        """,
+        (json.dumps(external_ids),),
+    ).fetchall()
+    return {row[1]: (row[0], row[2], row[3]) for row in rows}
+
+
+def drop_unchanged(conn, conversations: list[ParsedConversation]) -> list[ParsedConversation]:
+    """Filter out conversations whose stored copy is at least as new as the export's."""
+    stored = stored_versions(conn, [parsed.external_id for parsed in conversations if parsed.external_id])
+    return [
+        parsed
+        for parsed in conversations
+        if not parsed.external_id
+        or parsed.external_id not in stored
+        or parsed.updated_at_ms > stored[parsed.external_id][1]
+    ]
+
+
+def _adopt_legacy_conversation(conn, parsed: ParsedConversation) -> tuple[int, int, str] | None:
+    # Conversations imported before export ids were stored are matched once by title and
+    # creation time; their messages are matched by content so they aren't duplicated.
+    row = conn.execute(
+        """
+        SELECT id, updated_at_ms, source FROM conversations
+        WHERE created_at = ? AND title = ? AND external_id IS NULL
+        ORDER BY id
+        LIMIT 1
+        """,
+        (parsed.created_at, parsed.title),
+    ).fetchone()
+    if row is None:
+        return None
+
+    unmatched: dict[tuple[str, str], list[int]] = {}
+    for message in conn.execute(
+        """
+        SELECT id, timestamp, content_text(content) FROM messages
+        WHERE conversation_id = ? AND external_id IS NULL
+        ORDER BY id
+        """,
+        (row[0],),
+    ):
+        unmatched.setdefault((message[1], message[2]), []).append(message[0])
+
+    updates = []
+    for message in parsed.messages:
+        candidates = unmatched.get((message.timestamp, message.content))
+        if message.external_id and candidates:
+            updates.append((message.external_id, candidates.pop(0)))
+    conn.executemany("UPDATE messages SET external_id = ? WHERE id = ?", updates)
+    conn.execute("UPDATE conversations SET external_id = ? WHERE id = ?", (parsed.external_id, row[0]))
+    return row[0], row[1], row[2]
+
+
+def insert_conversations(
+    conn,
+    source: str,
+    conversations: list[ParsedConversation],
+    media_index: MediaIndex,
+    archive_sha256: str | None = None,
+    path: Path | None = None,
+) -> InsertResult:
+    """Insert a batch with one executemany per table, assigning row ids up front.
+
+    Conversations already in the archive (matched by export id) are skipped when the
+    export's update_time is no newer, otherwise only their new messages are appended.
+    Ids are precomputed so attachments can reference their messages without a
+    round-trip per row; BEGIN IMMEDIATE holds the write lock while they are used.
+    path is the database conn writes to, whose dictionaries compress the content;
+    it defaults to db.DB_PATH.
+    """
+    result = InsertResult()
+    if not conversations:
+        return result
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+    stored = stored_versions(conn, [parsed.external_id for parsed in conversations if parsed.external_id])
+    # Only archives with conversations from before export ids were stored need matching.
+    legacy = conn.execute("SELECT 1 FROM conversations WHERE external_id IS NULL LIMIT 1").fetchone() is not None
+    conversation_id = _next_id(conn, "conversations")
+    message_id = _next_id(conn, "messages")
+    now = datetime.utcnow().isoformat()
+    # With compressed storage on, new messages use the newest trained dictionary.
+    compress = get_codec(path or db.DB_PATH).compress if COMPRESS_CONTENT else None
+    dictionary_id = current_dictionary(conn) if compress else None
+
+    conversation_rows: list[tuple] = []
+    update_rows: list[tuple] = []
+    message_rows: list[tuple] = []
+    attachment_rows: list[tuple] = []
+    # Applied to the rollups (stats.py) in this same transaction.
+    rollups = RollupDelta()
+
+    for parsed in conversations:
+        version = stored.get(parsed.external_id) if parsed.external_id else None
+        if version is None and parsed.external_id and legacy:
+            version = _adopt_legacy_conversation(conn, parsed)
+
+        if version is None:
+            target_id = conversation_id
+            conversation_id += 1
+            conversation_rows.append(
+                (
+                    target_id,
+                    parsed.title,
+                    source,
+                    parsed.created_at,
+                    parsed.updated_at,
+                    parsed.created_at_ms,
+                    parsed.updated_at_ms,
+                    archive_sha256,
+                    parsed.external_id,
+                )
+            )
+            known_messages: set[str] = set()
+            conversation_source = source
+            rollups.add_conversation(source)
+            result.created += 1
+        else:
+            target_id, stored_updated_at, conversation_source = version
+            if parsed.updated_at_ms <= stored_updated_at:
+                result.unchanged += 1
+                continue
+            known_messages = {
+                row[0]
+                for row in conn.execute(
+                    "SELECT external_id FROM messages WHERE conversation_id = ? AND external_id IS NOT NULL",
+                    (target_id,),
+                )
+            }
+            update_rows.append((parsed.title, parsed.updated_at, parsed.updated_at_ms, archive_sha256, target_id))
+            result.updated += 1
+        result.conversation_ids.append(target_id)
+
+        external_to_message_id: dict[str, int] = {}
+        for message in parsed.messages:
+            if message.external_id in known_messages:
+                continue
+            message_rows.append(
+                (
+                    message_id,
+                    target_id,
+                    message.role,
+                    compress(message.content, dictionary_id) if compress else message.content,
+                    message.timestamp,
+                    message.timestamp_ms,
+                    message.external_id,
+                )
+            )
+            rollups.add_message(target_id, conversation_source, message.role, message.timestamp_ms)
+            if message.external_id:
+                external_to_message_id[message.external_id] = message_id
+            message_id += 1
+
+        for ref in parsed.attachment_refs:
+            if not ref.file_name:
+                continue
+            # Attachments of messages stored by an earlier import are already linked.
+            if version is not None and (ref.message_id or "") not in external_to_message_id:
+                continue
+
+            media = media_index.get(ref.file_name.lower())
+            if not media and ref.file_id:
+                media = media_index.get(ref.file_id.lower())
+            if not media:
+                continue
+
+            attachment_rows.append(
+                (
+                    target_id,
+                    external_to_message_id.get(ref.message_id or ""),
+                    ref.file_id,
+                    str(media["file_name"]),
+                    ref.mime_type or media["mime_type"],
+                    str(media["local_path"]),
+                    media["sha256"],
+                    now,
+                )
+            )
+            rollups.add_attachment(conversation_source, int(media["size"]))
+
+    conn.executemany(
+        """
+        INSERT INTO conversations (
+            id, title, source, created_at, updated_at, created_at_ms, updated_at_ms, archive_sha256, external_id
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        conversation_rows,
+    )
+    conn.executemany(
+        """
+        UPDATE conversations
+        SET title = ?, updated_at = ?, updated_at_ms = ?, archive_sha256 = COALESCE(?, archive_sha256)
+        WHERE id = ?
+        """,
+        update_rows,
+    )
+    conn.executemany(
+        """
+        INSERT INTO messages (id, conversation_id, role, content, timestamp, timestamp_ms, external_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        message_rows,
+    )
+    conn.executemany(
+        """
+        INSERT INTO attachments (
+            conversation_id, message_id, file_id, file_name, mime_type, local_path, blob_sha256, created_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        attachment_rows,
+    )
+    rollups.apply(conn)
+
+    result.messages = len(message_rows)
+    record_ingest(len(conversation_rows), len(message_rows), len(attachment_rows))
+    return result
+
+
+def import_export(
+    conn, path: Path, file_name: str, media_dir: Path = MEDIA_DIR, defer_indexes: bool = False
+) -> list[int]:
+    """Synchronously import one export file, committing after every batch.
+
+    Returns the ids of conversations that were inserted or had messages appended.
+    """
+    changed_ids: list[int] = []
+    media_index: MediaIndex = {}
+
+    apply_bulk_load_pragmas(conn)
+    if defer_indexes:
+        deferred_indexes.suspend(conn)
+    try:
+        for batch in read_export(path, file_name, media_dir, change_filter=lambda batch: drop_unchanged(conn, batch)):
+            media_index.update(batch.media_index or {})
+            # Committed on its own, so the blobs can be collected if the insert fails.
+            register_media(conn, batch.media_index or {}, batch.archive)
+            conn.commit()
+            archive_sha256 = str(batch.archive["sha256"]) if batch.archive else None
+            result = insert_conversations(conn, file_name, batch.conversations, media_index, archive_sha256)
+            changed_ids.extend(result.conversation_ids)
+            conn.commit()
+            if result.conversation_ids:
+                archive_generation.bump(conn)
+            INGEST_BYTES.inc(batch.bytes_read)
+    finally:
+        if defer_indexes:
+            conn.rollback()
+            deferred_indexes.resume(conn)
+
+    collect_garbage(conn, media_dir)
+    return changed_ids
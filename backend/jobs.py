@@ -0,0 +1,394 @@
+"""
+Background ingestion jobs.
+
+An upload is spooled to disk and turned into a job. Parsing and media extraction run
+in a process pool; workers send ExportBatch objects over a bounded queue to a single
+writer thread, which splits each batch between the shards its conversations belong in
+and applies the parts through those shards' writer connections. The bound on the queue
+is the backpressure: a slow writer pauses the parsers instead of buffering whole exports
+in memory.
+
+After a job finishes, its new messages are embedded for semantic search on a thread of
+their own, so the writer goes on to the next batch meanwhile.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+import functools
+import multiprocessing
+import os
+from pathlib import Path
+import logging
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Any
+import uuid
+
+import db
+from db import apply_bulk_load_pragmas, archive_generation
+from ingest import ExportBatch, MediaIndex, insert_conversations, read_export, register_media
+from metrics import INGEST_BYTES, INGEST_STAGE_SECONDS
+import semantic
+from shards import Shard, ShardSet, shard_set
+
+INGEST_WORKERS = max(1, min(4, os.cpu_count() or 1))
+# Maximum number of parsed batches waiting for the writer.
+RESULT_QUEUE_SIZE = 8
+# Queued or running jobs allowed before new uploads are turned away with 503.
+MAX_PENDING_JOBS = int(os.environ.get("CHAT_ARCHIVE_MAX_PENDING_JOBS", str(INGEST_WORKERS * 2)))
+# Finished jobs kept around for status queries.
+MAX_FINISHED_JOBS = 200
+
+FINISHED_STATUSES = {"completed", "failed", "cancelled"}
+
+logger = logging.getLogger("chat_archive.jobs")
+
+
+@dataclass
+class IngestJob:
+    id: str
+    files: list[str]
+    status: str = "queued"
+    conversations: int = 0
+    # Conversations from earlier imports that got new messages, or were already up to date.
+    updated: int = 0
+    unchanged: int = 0
+    messages: int = 0
+    bytes_read: int = 0
+    total_bytes: int = 0
+    errors: list[str] = field(default_factory=list)
+    defer_indexes: bool = False
+    # Set once the semantic index covers the job's messages.
+    semantic_indexed: bool = False
+    created_at: str = field(default_factory=lambda: datetime.utcnow().isoformat())
+    finished_at: str | None = None
+
+
+# Set in each worker process by _init_worker.
+_results: Any = None
+
+
+def _init_worker(results: Any) -> None:
+    global _results
+    _results = results
+
+
+def _parse_job(
+    job_id: str, files: list[tuple[str, str]], media_dir: str, shards: list[Shard], cancel_event: Any
+) -> None:
+    # Read-only connections to the shards let the worker skip unchanged conversations
+    # before extracting their media or shipping them to the writer.
+    targets = ShardSet(shards)
+    try:
+        for file_name, path in files:
+            if cancel_event.is_set():
+                break
+            try:
+                batches = read_export(
+                    Path(path),
+                    file_name,
+                    Path(media_dir),
+                    change_filter=functools.partial(targets.drop_unchanged, file_name),
+                )
+                while not cancel_event.is_set():
+                    started = time.perf_counter()
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    batch.seconds = time.perf_counter() - started
+                    _results.put((job_id, "batch", batch))
+            except Exception as exc:
+                _results.put((job_id, "error", f"Failed to parse {file_name}: {exc}"))
+            finally:
+                Path(path).unlink(missing_ok=True)
+    finally:
+        _results.put((job_id, "done", None))
+
+
+class JobManager:
+    def __init__(self, workers: int = INGEST_WORKERS) -> None:
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._jobs: dict[str, IngestJob] = {}
+        self._cancel_events: dict[str, Any] = {}
+        # Jobs stopped because a batch failed to store; their cancel event is set to stop
+        # the worker, but they end as failed rather than cancelled.
+        self._aborted: set[str] = set()
+        self._spool_dirs: dict[str, Path] = {}
+        self._media_indexes: dict[tuple[str, str], MediaIndex] = {}
+        # Shards whose indexes each defer_indexes job has suspended.
+        self._deferred: dict[str, list[Shard]] = {}
+        self._pool: ProcessPoolExecutor | None = None
+        self._manager: Any = None
+        self._results: Any = None
+        self._writer: threading.Thread | None = None
+        # Finished jobs waiting for the next semantic index update. Jobs finishing while one
+        # runs are all covered by a single update after it.
+        self._awaiting_index: list[str] = []
+        self._index_requested = threading.Event()
+        self._stopping = False
+        self._indexer: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._pool is not None:
+            return
+
+        # Spawned rather than forked workers: the API process already runs threads.
+        context = multiprocessing.get_context("spawn")
+        self._manager = context.Manager()
+        self._results = context.Queue(maxsize=RESULT_QUEUE_SIZE)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self._workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self._results,),
+        )
+        self._writer = threading.Thread(target=self._write_loop, name="ingest-writer", daemon=True)
+        self._writer.start()
+        self._stopping = False
+        self._indexer = threading.Thread(target=self._index_loop, name="semantic-index", daemon=True)
+        self._indexer.start()
+
+    def shutdown(self) -> None:
+        if self._pool is None:
+            return
+
+        with self._lock:
+            for event in self._cancel_events.values():
+                event.set()
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._results.put(None)
+        self._writer.join()
+        self._stopping = True
+        self._index_requested.set()
+        self._indexer.join()
+        self._manager.shutdown()
+        self._pool = None
+
+    def submit(self, files: list[tuple[str, Path]], spool_dir: Path, defer_indexes: bool = False) -> IngestJob:
+        self.start()
+
+        job = IngestJob(
+            id=uuid.uuid4().hex,
+            files=[file_name for file_name, _ in files],
+            defer_indexes=defer_indexes,
+        )
+        cancel_event = self._manager.Event()
+        with self._lock:
+            self._jobs[job.id] = job
+            self._cancel_events[job.id] = cancel_event
+            self._spool_dirs[job.id] = spool_dir
+            self._evict_finished()
+
+        future = self._pool.submit(
+            _parse_job,
+            job.id,
+            [(file_name, str(path)) for file_name, path in files],
+            str(db.MEDIA_DIR),
+            shard_set.shards,
+            cancel_event,
+        )
+        future.add_done_callback(lambda done: self._on_worker_exit(job.id, done))
+        return self.get(job.id)
+
+    def get(self, job_id: str) -> IngestJob | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return replace(job, files=list(job.files), errors=list(job.errors)) if job else None
+
+    def list(self) -> list[IngestJob]:
+        with self._lock:
+            job_ids = list(self._jobs)
+        return [job for job in map(self.get, reversed(job_ids)) if job]
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(job.status not in FINISHED_STATUSES for job in self._jobs.values())
+
+    def cancel(self, job_id: str) -> IngestJob | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status not in FINISHED_STATUSES:
+                self._cancel_events[job_id].set()
+        return self.get(job_id)
+
+    def _on_worker_exit(self, job_id: str, future: Future) -> None:
+        # _parse_job reports its own failures; this only fires if the worker process died.
+        if future.cancelled() or future.exception() is not None:
+            reason = "cancelled" if future.cancelled() else str(future.exception())
+            self._results.put((job_id, "error", f"Ingestion worker stopped: {reason}"))
+            self._results.put((job_id, "done", None))
+
+    def _evict_finished(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_STATUSES]
+        for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def _write_loop(self) -> None:
+        for shard in shard_set.writable():
+            with shard.writer() as conn:
+                apply_bulk_load_pragmas(conn)
+
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+
+            job_id, kind, payload = item
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            try:
+                self._apply(job, kind, payload)
+            except Exception as exc:
+                with self._lock:
+                    job.errors.append(f"Failed to store batch: {exc}")
+                    if job_id in self._cancel_events:
+                        self._aborted.add(job_id)
+                        self._cancel_events[job_id].set()
+
+    def _apply(self, job: IngestJob, kind: str, payload: Any) -> None:
+        job_id = job.id
+        cancel_event = self._cancel_events.get(job_id)
+        cancelled = cancel_event is None or cancel_event.is_set()
+
+        if kind == "batch":
+            batch: ExportBatch = payload
+            # Every blob is recorded in the main database too, so garbage collection finds
+            # it even if none of its conversations end up anywhere, as when the job was
+            # cancelled or failed after the worker stored it.
+            with shard_set.main.writer() as conn:
+                register_media(conn, batch.media_index or {}, batch.archive)
+            if cancelled:
+                return
+            key = (job_id, batch.file_name)
+            media_index = self._media_indexes.setdefault(key, {})
+            media_index.update(batch.media_index or {})
+
+            with self._lock:
+                job.status = "running"
+
+            started = time.perf_counter()
+            archive_sha256 = str(batch.archive["sha256"]) if batch.archive else None
+            groups, sealed = shard_set.partition(batch.file_name, batch.conversations)
+            created = updated = unchanged = messages = 0
+            for shard, conversations in groups.items():
+                with shard.writer() as conn:
+                    if shard != shard_set.main:
+                        register_media(conn, batch.media_index or {}, batch.archive)
+                    if job.defer_indexes and shard not in self._deferred.setdefault(job_id, []):
+                        shard_set.deferred_indexes(shard).suspend(conn)
+                        self._deferred[job_id].append(shard)
+                    result = insert_conversations(
+                        conn, batch.file_name, conversations, media_index, archive_sha256, shard.path
+                    )
+                    conn.commit()
+                    if result.conversation_ids:
+                        archive_generation.bump(conn, shard.path)
+                created += result.created
+                updated += result.updated
+                unchanged += result.unchanged
+                messages += result.messages
+            INGEST_STAGE_SECONDS.observe(batch.seconds, stage="parse")
+            if batch.conversations:
+                INGEST_STAGE_SECONDS.observe(time.perf_counter() - started, stage="insert")
+            INGEST_BYTES.inc(batch.bytes_read)
+
+            with self._lock:
+                job.conversations += created
+                job.updated += updated
+                job.unchanged += unchanged + sealed + batch.unchanged
+                job.messages += messages
+                job.bytes_read += batch.bytes_read
+                job.total_bytes += batch.total_bytes
+        elif kind == "error":
+            with self._lock:
+                job.errors.append(payload)
+        elif kind == "done":
+            if job.status in FINISHED_STATUSES:
+                return
+            for shard in self._deferred.pop(job_id, []):
+                try:
+                    with shard.writer() as conn:
+                        shard_set.deferred_indexes(shard).resume(conn)
+                except sqlite3.Error as exc:
+                    with self._lock:
+                        job.errors.append(f"Failed to rebuild deferred indexes of shard {shard.name}: {exc}")
+
+            with self._lock:
+                aborted = job_id in self._aborted
+                self._aborted.discard(job_id)
+                if cancel_event.is_set() and not aborted:
+                    job.status = "cancelled"
+                elif job.errors:
+                    job.status = "failed"
+                else:
+                    job.status = "completed"
+                job.finished_at = datetime.utcnow().isoformat()
+                del self._cancel_events[job_id]
+                spool_dir = self._spool_dirs.pop(job_id)
+
+            for key in [key for key in self._media_indexes if key[0] == job_id]:
+                del self._media_indexes[key]
+            shutil.rmtree(spool_dir, ignore_errors=True)
+            self.collect_media_garbage()
+            if semantic.AUTO_UPDATE:
+                with self._lock:
+                    self._awaiting_index.append(job_id)
+                self._index_requested.set()
+
+    def _index_loop(self) -> None:
+        while True:
+            self._index_requested.wait()
+            if self._stopping:
+                return
+            self._index_requested.clear()
+            with self._lock:
+                job_ids, self._awaiting_index = self._awaiting_index, []
+            if not self._update_semantic_index():
+                continue
+            with self._lock:
+                for job_id in job_ids:
+                    if job_id in self._jobs:
+                        self._jobs[job_id].semantic_indexed = True
+
+    def _update_semantic_index(self) -> bool:
+        # Embedding reads the committed messages through this thread's reader connections,
+        # so searches and writes carry on meanwhile. Returns whether every shard succeeded.
+        indexed = True
+        for shard in shard_set.writable():
+            started = time.perf_counter()
+            try:
+                with shard.reader() as conn:
+                    embedded = semantic.get_index(shard.path).update(conn)
+            except Exception:
+                logger.exception("Failed to update the semantic index of shard %s", shard.name)
+                indexed = False
+                continue
+            if embedded:
+                INGEST_STAGE_SECONDS.observe(time.perf_counter() - started, stage="embed")
+        return indexed
+
+    def collect_media_garbage(self) -> tuple[int, int]:
+        """Remove unreferenced media blobs from every shard unless an import is in flight.
+
+        Workers store blobs before the writer records them, so collecting during an
+        import could delete a file an incoming attachment is about to use. The job lock
+        keeps new jobs from starting meanwhile; anything skipped is collected when the
+        last running job finishes. Call it without holding a writer: it takes each
+        shard's in turn.
+        """
+        with self._lock:
+            if any(job.status not in FINISHED_STATUSES for job in self._jobs.values()):
+                return 0, 0
+            return shard_set.collect_media_garbage()
+
+
+job_manager = JobManager()
@@ -1,24 +1,98 @@
-from datetime import datetime
-from io import BytesIO
+import asyncio
+from collections import Counter
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+import heapq
+from itertools import islice
+import json
 import mimetypes
-from pathlib import Path, PurePosixPath
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+from typing import Any, Callable, Literal
+from urllib.parse import urlencode
 import zipfile
 
-from fastapi import FastAPI, File, HTTPException, Query, UploadFile
+from fastapi import FastAPI, File, HTTPException, Query, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-
-from db import MEDIA_DIR, get_db, init_db
-from models import Attachment, ConversationDetail, ConversationSummary, Message, SearchResult
-from parsers import parse_chat_export, parse_chatgpt_conversations
-from pathlib import Path
-
-from fastapi import FastAPI, File, HTTPException, Query, UploadFile
-from fastapi.middleware.cors import CORSMiddleware
-
-from db import get_db, init_db
-from models import ConversationDetail, ConversationSummary, Message, SearchResult
-from parsers import parse_chat_export
+from pydantic_core import to_json
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+
+from cache import response_cache
+import export
+from db import (
+    MEDIA_DIR,
+    MIGRATIONS,
+    archive_generation,
+    close_pools,
+    get_pool,
+    init_db,
+    message_count,
+    message_time,
+    rollup_tables,
+    run_read,
+    run_write,
+    shutdown_executors,
+)
+from ingest import COPY_CHUNK_SIZE
+from jobs import FINISHED_STATUSES, MAX_PENDING_JOBS, job_manager
+import metrics
+from media import blob_file
+import migrations
+from models import (
+    ArchiveMember,
+    ArchiveStats,
+    Attachment,
+    ConversationDetail,
+    ConversationPage,
+    ConversationSummary,
+    IngestJob,
+    Message,
+    MessageWindow,
+    RoleStats,
+    SearchPage,
+    SearchResult,
+    SourceStats,
+    TimelineDay,
+)
+from parsers import epoch_ms
+from search import (
+    ELLIPSIS,
+    HIGHLIGHT_END,
+    HIGHLIGHT_START,
+    SNIPPET_TOKENS,
+    build_fts_query,
+    mark_terms,
+    split_highlights,
+)
+import semantic
+from shards import Shard, backfill_runner, shard_set
+import stats
+from stats import DAY_MS
+
+# Default and maximum page sizes for /api/conversations/{id}/messages.
+MESSAGE_WINDOW_LIMIT = 100
+MESSAGE_WINDOW_MAX = 1000
+# Rows read per query while streaming messages as NDJSON.
+MESSAGE_STREAM_BATCH = 500
+# Default and maximum page sizes for /api/search; semantic search returns one page of
+# at most SEMANTIC_SEARCH_LIMIT results.
+SEARCH_PAGE_LIMIT = 50
+SEARCH_PAGE_MAX = 200
+SEMANTIC_SEARCH_LIMIT = 50
+SEMANTIC_FILTER_OVERFETCH = 10
+# Filtered searches scan the matching messages directly, probing the full-text index for
+# each, when the filters leave fewer than this many and fewer than the query matches.
+SEARCH_FILTER_SCAN_LIMIT = 5000
+# Uploads received at once. Further uploads, or any upload while MAX_PENDING_JOBS jobs
+# are unfinished, get a 503 before their body is read.
+MAX_CONCURRENT_UPLOADS = int(os.environ.get("CHAT_ARCHIVE_MAX_CONCURRENT_UPLOADS", "2"))
+UPLOAD_RETRY_AFTER_SECONDS = 10
 
 app = FastAPI(title="AI Chat Archive API")
 
@@ -30,250 +104,298 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/media", StaticFiles(directory=MEDIA_DIR), name="media")
-
-
-@app.on_event("startup")
-def startup() -> None:
-    init_db()
+app.mount("/media", StaticFiles(directory=MEDIA_DIR, check_dir=False), name="media")
 
 
-def _safe_media_name(file_name: str) -> str:
-    return PurePosixPath(file_name).name or "attachment.bin"
+def _route_label(request: Request) -> str:
+    # Label by route template rather than raw path to keep the number of series bounded.
+    for route in app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
 
 
-def _is_binary_file(path: str, file_bytes: bytes) -> bool:
-    mime_type, _ = mimetypes.guess_type(path)
-    if mime_type:
-        if mime_type.startswith("text/") or mime_type in {
-            "application/json",
-            "application/xml",
-            "application/javascript",
-        }:
-            return False
-        return True
+_upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
 
-    chunk = file_bytes[:1024]
-    return b"\0" in chunk
 
+@app.middleware("http")
+async def limit_uploads(request: Request, call_next):
+    if request.method != "POST" or request.url.path != "/api/upload":
+        return await call_next(request)
 
-def _extract_binary_files(raw_zip: bytes, source_name: str) -> dict[str, dict[str, str | None]]:
-    extracted: dict[str, dict[str, str | None]] = {}
-
-    with zipfile.ZipFile(BytesIO(raw_zip)) as archive:
-        for info in archive.infolist():
-            if info.is_dir():
-                continue
+    if _upload_slots.locked() or job_manager.pending() >= MAX_PENDING_JOBS:
+        return JSONResponse(
+            {"detail": "Too many imports in progress; try again later"},
+            status_code=503,
+            headers={"Retry-After": str(UPLOAD_RETRY_AFTER_SECONDS)},
+        )
+    async with _upload_slots:
+        return await call_next(request)
+
+
+# Registered last so it wraps the other middleware and also times rejected uploads.
+@app.middleware("http")
+async def record_request_timing(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=_route_label(request),
+            status=status,
+        )
 
-            name = info.filename
-            if PurePosixPath(name).name == "conversations.json":
-                continue
 
-            data = archive.read(info)
-            if not _is_binary_file(name, data):
-                continue
+@app.on_event("startup")
+def startup() -> None:
+    init_db()
+    shard_set.load()
+    outdated = shard_set.outdated()
+    if outdated:
+        names = ", ".join(shard.name for shard in outdated)
+        raise RuntimeError(f"Sealed shards need migrating: unseal and seal again with manage.py seal-shard: {names}")
+    job_manager.start()
+    backfill_runner.start()
+
+
+@app.on_event("shutdown")
+def shutdown() -> None:
+    backfill_runner.stop()
+    job_manager.shutdown()
+    shutdown_executors()
+    close_pools()
+
 
-            safe_name = _safe_media_name(name)
-            output_name = f"{Path(source_name).stem}_{safe_name}"
-            output_path = MEDIA_DIR / output_name
+@app.post("/api/upload", response_model=IngestJob, status_code=202)
+async def upload_chat_exports(files: list[UploadFile] = File(...), defer_indexes: bool = Query(False)):
+    for upload in files:
+        if not upload.filename:
+            raise HTTPException(status_code=400, detail="Uploaded file is missing a filename")
+        if not upload.filename.lower().endswith((".json", ".zip")):
+            raise HTTPException(status_code=400, detail="Only JSON and ZIP files are supported")
 
-            counter = 1
-            while output_path.exists():
-                output_name = f"{Path(source_name).stem}_{counter}_{safe_name}"
-                output_path = MEDIA_DIR / output_name
-                counter += 1
+    # Copying to the spool and starting the job (which may spawn the worker pool) both
+    # block, so they run on a worker thread.
+    return await run_in_threadpool(_spool_and_submit, files, defer_indexes)
 
-            output_path.write_bytes(data)
-            mime_type, _ = mimetypes.guess_type(output_path.name)
 
-            normalized_path = str(PurePosixPath("media") / output_path.name)
-            record = {
-                "file_name": safe_name,
-                "local_path": normalized_path,
-                "mime_type": mime_type,
-            }
+def _spool_and_submit(files: list[UploadFile], defer_indexes: bool) -> IngestJob:
+    spool_dir = Path(tempfile.mkdtemp(prefix="chat-archive-upload-"))
+    spooled: list[tuple[str, Path]] = []
+    try:
+        for index, upload in enumerate(files):
+            path = spool_dir / f"{index}{Path(upload.filename).suffix.lower()}"
+            started = time.perf_counter()
+            with path.open("wb") as spool:
+                shutil.copyfileobj(upload.file, spool, COPY_CHUNK_SIZE)
+            metrics.INGEST_STAGE_SECONDS.observe(time.perf_counter() - started, stage="spool")
+            spooled.append((upload.filename, path))
+    except BaseException:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        raise
 
-            extracted[safe_name.lower()] = record
-            extracted[output_path.name.lower()] = record
+    return job_manager.submit(spooled, spool_dir, defer_indexes=defer_indexes)
 
-    return extracted
 
+@app.get("/api/jobs", response_model=list[IngestJob])
+def list_jobs():
+    return job_manager.list()
 
-def _insert_simple_json(conn, upload_name: str, raw: bytes, created_ids: list[int]) -> None:
-    parsed = parse_chat_export(raw, fallback_title=Path(upload_name).stem)
 
-    cursor = conn.execute(
-        """
-        INSERT INTO conversations (title, source, created_at, updated_at)
-        VALUES (?, ?, ?, ?)
-        """,
-        (parsed.title, upload_name, parsed.created_at, parsed.updated_at),
-    )
-    conversation_id = cursor.lastrowid
-    created_ids.append(conversation_id)
-
-    conn.executemany(
-        """
-        INSERT INTO messages (conversation_id, role, content, timestamp)
-        VALUES (?, ?, ?, ?)
-        """,
-        [
-            (conversation_id, message.role, message.content, message.timestamp)
-            for message in parsed.messages
-        ],
-    )
-
-
-def _insert_zip_export(conn, upload_name: str, raw: bytes, created_ids: list[int]) -> None:
-    with zipfile.ZipFile(BytesIO(raw)) as archive:
-        conversations_member = next(
-            (name for name in archive.namelist() if PurePosixPath(name).name == "conversations.json"),
-            None,
+@app.get("/api/jobs/{job_id}", response_model=IngestJob)
+def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.post("/api/jobs/{job_id}/cancel", response_model=IngestJob)
+def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/api/db/pool")
+def get_pool_stats():
+    return get_pool().stats()
+
+
+@app.get("/api/db/schema")
+async def get_schema_status():
+    return await run_read(shard_set.fan_out, _schema_status)
+
+
+def _schema_status(shard: Shard) -> dict:
+    with shard.reader() as conn:
+        return {
+            "shard": shard.name,
+            "version": migrations.schema_version(conn),
+            "latest_version": MIGRATIONS[-1].version,
+            "backfills": migrations.backfill_status(conn),
+        }
+
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    for name, value in get_pool().stats().items():
+        metrics.DB_POOL.set(float(value), stat=name)
+    for name, value in response_cache.stats().items():
+        metrics.RESPONSE_CACHE_SIZE.set(value, stat=name)
+
+    statuses = ["queued", "running", *sorted(FINISHED_STATUSES)]
+    counts = dict.fromkeys(statuses, 0)
+    for job in job_manager.list():
+        counts[job.status] += 1
+    for status, count in counts.items():
+        metrics.INGEST_JOBS.set(count, status=status)
+
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/metrics/slow-queries")
+def get_slow_queries():
+    return list(reversed(metrics.slow_queries))
+
+
+def _parse_cursor(value: str, name: str, key: str) -> tuple[str, int]:
+    sort_key, separator, row_id = value.rpartition(",")
+    if not separator or not row_id.isdigit():
+        raise HTTPException(status_code=400, detail=f"{name} must look like <{key}>,<id>")
+    return sort_key, int(row_id)
+
+
+def _parse_time_cursor(value: str, name: str, key: str) -> tuple[int, int]:
+    sort_key, row_id = _parse_cursor(value, name, key)
+    try:
+        return int(sort_key), row_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must look like <{key}>,<id>")
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # If-None-Match uses weak comparison, so W/"x" matches "x".
+    return any(tag.strip().removeprefix("W/") in ("*", etag) for tag in if_none_match.split(","))
+
+
+def _serialize(fn: Callable[..., Any], *args: Any) -> bytes:
+    return to_json(fn(*args))
+
+
+async def _cached_json(request: Request, fn: Callable[..., Any], *args: Any, shard: Shard | None = None) -> Response:
+    """Respond with fn(*args) as JSON, tagged with the archive generation.
+
+    Archived conversations only change when an import or delete bumps the generation,
+    so a matching If-None-Match gets 304 and repeated requests are served from the
+    response cache, neither touching SQLite. Responses read from one shard carry that
+    shard's generation, others the combined generation of all of them.
+    """
+    stamp = shard_set.stamp(shard)
+    etag = f'"{stamp[0]}-{stamp[1]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        metrics.RESPONSE_CACHE.inc(result="not_modified")
+        return Response(status_code=304, headers=headers)
+
+    key = f"{request.url.path}?{urlencode(sorted(request.query_params.multi_items()))}"
+    body = response_cache.get(key, stamp)
+    if body is None:
+        metrics.RESPONSE_CACHE.inc(result="miss")
+        body = await run_read(_serialize, fn, *args)
+        response_cache.put(key, stamp, body)
+    else:
+        metrics.RESPONSE_CACHE.inc(result="hit")
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.get("/api/conversations", response_model=ConversationPage)
+async def list_conversations(
+    request: Request,
+    after: str | None = Query(None, description="Cursor from a previous page: <created_at_ms>,<id>"),
+    limit: int = Query(50, ge=1, le=500),
+    source: str | None = None,
+    title_prefix: str | None = Query(None, min_length=1),
+):
+    return await _cached_json(request, _list_conversations, after, limit, source, title_prefix)
+
+
+def _list_conversations(
+    after: str | None, limit: int, source: str | None, title_prefix: str | None
+) -> ConversationPage:
+    clauses: list[str] = []
+    params: list[str | int] = []
+
+    if after:
+        clauses.append("(created_at_ms, id) < (?, ?)")
+        params.extend(_parse_time_cursor(after, "after", "created_at_ms"))
+    if source:
+        clauses.append("source = ?")
+        params.append(source)
+    if title_prefix:
+        # A range rather than LIKE so idx_conversations_title can serve it.
+        clauses.append("title >= ? COLLATE NOCASE AND title < ? COLLATE NOCASE")
+        params.extend((title_prefix, title_prefix + "\U0010ffff"))
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    # Ids are unique across shards, so the merged pages share one cursor.
+    rows = list(
+        islice(
+            heapq.merge(
+                *shard_set.fan_out(_select_conversations, where, params, limit + 1),
+                key=lambda row: (row["created_at_ms"], row["id"]),
+                reverse=True,
+            ),
+            limit + 1,
         )
-        if not conversations_member:
-            raise ValueError("ZIP export is missing conversations.json")
+    )
 
-        conversations_raw = archive.read(conversations_member)
+    items = [ConversationSummary(**dict(row)) for row in rows[:limit]]
+    next_after = f"{items[-1].created_at_ms},{items[-1].id}" if len(rows) > limit else None
+    return ConversationPage(items=items, next_after=next_after)
 
-    media_index = _extract_binary_files(raw, upload_name)
-    parsed_conversations = parse_chatgpt_conversations(conversations_raw)
 
-    for parsed in parsed_conversations:
-        convo_cursor = conn.execute(
-            """
-            INSERT INTO conversations (title, source, created_at, updated_at)
-            VALUES (?, ?, ?, ?)
+def _select_conversations(shard: Shard, where: str, params: list[str | int], limit: int) -> list:
+    with shard.reader() as conn:
+        return conn.execute(
+            f"""
+            SELECT id, title, source, created_at, created_at_ms, {message_count(conn)} AS message_count
+            FROM conversations
+            {where}
+            ORDER BY created_at_ms DESC, id DESC
+            LIMIT ?
             """,
-            (parsed.title, upload_name, parsed.created_at, parsed.updated_at),
-        )
-        conversation_id = convo_cursor.lastrowid
-        created_ids.append(conversation_id)
-
-        external_to_message_id: dict[str, int] = {}
-        for message in parsed.messages:
-            message_cursor = conn.execute(
-                """
-                INSERT INTO messages (conversation_id, role, content, timestamp)
-                VALUES (?, ?, ?, ?)
-                """,
-                (conversation_id, message.role, message.content, message.timestamp),
-            )
-            if message.external_id:
-                external_to_message_id[message.external_id] = message_cursor.lastrowid
-
-        now = datetime.utcnow().isoformat()
-        for ref in parsed.attachment_refs:
-            if not ref.file_name:
-                continue
-
-            media = media_index.get(ref.file_name.lower())
-            if not media and ref.file_id:
-                media = media_index.get(ref.file_id.lower())
-            if not media:
-                continue
-
-            conn.execute(
-                """
-                INSERT INTO attachments (
-                    conversation_id, message_id, file_id, file_name, mime_type, local_path, created_at
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    conversation_id,
-                    external_to_message_id.get(ref.message_id or ""),
-                    ref.file_id,
-                    str(media["file_name"]),
-                    ref.mime_type or media["mime_type"],
-                    str(media["local_path"]),
-                    now,
-                ),
-            )
-
+            (*params, limit),
+        ).fetchall()
 
-@app.post("/api/upload")
-async def upload_chat_exports(files: list[UploadFile] = File(...)):
-    created_ids: list[int] = []
-
-    with get_db() as conn:
-        for upload in files:
-            if not upload.filename:
-                raise HTTPException(status_code=400, detail="Uploaded file is missing a filename")
-
-            file_name = upload.filename
-            raw = await upload.read()
-
-            try:
-                if file_name.lower().endswith(".json"):
-                    _insert_simple_json(conn, file_name, raw, created_ids)
-                elif file_name.lower().endswith(".zip"):
-                    _insert_zip_export(conn, file_name, raw, created_ids)
-                else:
-                    raise HTTPException(status_code=400, detail="Only JSON and ZIP files are supported")
-            except HTTPException:
-                raise
-            except Exception as exc:
-                raise HTTPException(status_code=400, detail=f"Failed to parse {file_name}: {exc}") from exc
-
-@app.post("/api/upload")
-async def upload_chat_exports(files: list[UploadFile] = File(...)):
-    created_ids: list[int] = []
-
-    with get_db() as conn:
-        for upload in files:
-            if not upload.filename or not upload.filename.lower().endswith(".json"):
-                raise HTTPException(status_code=400, detail="Only JSON files are supported")
-
-            raw = await upload.read()
-            try:
-                parsed = parse_chat_export(raw, fallback_title=Path(upload.filename).stem)
-            except Exception as exc:
-                raise HTTPException(status_code=400, detail=f"Failed to parse {upload.filename}: {exc}") from exc
-
-            now = datetime.utcnow().isoformat()
-            cursor = conn.execute(
-                """
-                INSERT INTO conversations (title, source, created_at, updated_at)
-                VALUES (?, ?, ?, ?)
-                """,
-                (parsed.title, upload.filename, now, now),
-            )
-            conversation_id = cursor.lastrowid
-            created_ids.append(conversation_id)
-
-            conn.executemany(
-                """
-                INSERT INTO messages (conversation_id, role, content, timestamp)
-                VALUES (?, ?, ?, ?)
-                """,
-                [
-                    (conversation_id, message.role, message.content, message.timestamp)
-                    for message in parsed.messages
-                ],
-            )
 
-    return {"created_conversation_ids": created_ids, "count": len(created_ids)}
+def _conversation_shard(conversation_id: int) -> Shard:
+    shard = shard_set.for_id(conversation_id)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return shard
 
 
-@app.get("/api/conversations", response_model=list[ConversationSummary])
-def list_conversations():
-    with get_db() as conn:
-        rows = conn.execute(
-            """
-            SELECT id, title, source, created_at
-            FROM conversations
-            ORDER BY created_at DESC
-            """
-        ).fetchall()
-    return [ConversationSummary(**dict(row)) for row in rows]
+@app.get("/api/conversations/{conversation_id}", response_model=ConversationDetail)
+async def get_conversation(request: Request, conversation_id: int, include_messages: bool = True):
+    shard = _conversation_shard(conversation_id)
+    return await _cached_json(request, _get_conversation, shard, conversation_id, include_messages, shard=shard)
 
 
-@app.get("/api/conversations/{conversation_id}", response_model=ConversationDetail)
-def get_conversation(conversation_id: int):
-    with get_db() as conn:
+def _get_conversation(shard: Shard, conversation_id: int, include_messages: bool) -> ConversationDetail:
+    with shard.reader() as conn:
         convo = conn.execute(
-            """
-            SELECT id, title, source, created_at, updated_at
+            f"""
+            SELECT id, title, source, created_at, updated_at, archive_sha256, {message_count(conn)} AS message_count
             FROM conversations
             WHERE id = ?
             """,
@@ -283,15 +405,9 @@ def get_conversation(conversation_id: int):
         if not convo:
             raise HTTPException(status_code=404, detail="Conversation not found")
 
-        messages = conn.execute(
-            """
-            SELECT id, conversation_id, role, content, timestamp
-            FROM messages
-            WHERE conversation_id = ?
-            ORDER BY timestamp ASC, id ASC
-            """,
-            (conversation_id,),
-        ).fetchall()
+        messages = []
+        if include_messages:
+            messages = _select_messages(conn, conversation_id, limit=-1)
 
     return ConversationDetail(
         **dict(convo),
@@ -299,9 +415,179 @@ def get_conversation(conversation_id: int):
     )
 
 
+@app.delete("/api/conversations/{conversation_id}", status_code=204)
+async def delete_conversation(conversation_id: int):
+    await run_write(_delete_conversation, conversation_id)
+    return Response(status_code=204)
+
+
+def _delete_conversation(conversation_id: int) -> None:
+    shard = _conversation_shard(conversation_id)
+    if shard.read_only:
+        raise HTTPException(status_code=409, detail="The conversation is in a sealed shard")
+    with shard.writer() as conn:
+        # The search index only catches up on inserts after a deferred bulk load.
+        if shard_set.deferred_indexes(shard).active:
+            raise HTTPException(status_code=409, detail="An import is rebuilding indexes; try again later")
+
+        # Counted and deleted under one write lock, so the rollups match what is removed.
+        conn.execute("BEGIN IMMEDIATE")
+        rollups = stats.conversation_delta(conn, conversation_id, message_time(conn))
+        if rollups is None:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        rollups.apply(conn, sign=-1)
+        conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+        conn.commit()
+        archive_generation.bump(conn, shard.path)
+    job_manager.collect_media_garbage()
+
+
+def _select_messages(
+    conn,
+    conversation_id: int,
+    after: tuple[int, int] | None = None,
+    before: tuple[int, int] | None = None,
+    limit: int = MESSAGE_WINDOW_LIMIT,
+    inclusive: bool = False,
+) -> list:
+    """Messages in (timestamp_ms, id) order, strictly after `after` or strictly before `before`.
+
+    With `before`, rows are read backwards from the cursor and returned in forward order.
+    A limit of -1 means no limit.
+    """
+    time = message_time(conn)
+    clauses = ["conversation_id = ?"]
+    params: list[int] = [conversation_id]
+    if after:
+        clauses.append(f"({time}, id) {'>=' if inclusive else '>'} (?, ?)")
+        params.extend(after)
+    if before:
+        clauses.append(f"({time}, id) < (?, ?)")
+        params.extend(before)
+    direction = "DESC" if before else "ASC"
+
+    rows = conn.execute(
+        f"""
+        SELECT id, conversation_id, role, content_text(content) AS content, timestamp, {time} AS timestamp_ms
+        FROM messages
+        WHERE {' AND '.join(clauses)}
+        ORDER BY {time} {direction}, id {direction}
+        LIMIT ?
+        """,
+        (*params, limit),
+    ).fetchall()
+    return rows[::-1] if before else rows
+
+
+def _message_cursor(conn, conversation_id: int, message_id: int) -> tuple[int, int]:
+    row = conn.execute(
+        f"SELECT {message_time(conn)}, id FROM messages WHERE id = ? AND conversation_id = ?",
+        (message_id, conversation_id),
+    ).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Message not found in this conversation")
+    return row[0], row[1]
+
+
+def _read_message_batch(
+    shard: Shard, conversation_id: int, after: tuple[int, int] | None, size: int
+) -> tuple[str, int, tuple[int, int] | None]:
+    """One NDJSON chunk of up to `size` messages, its row count and the cursor after it."""
+    with shard.reader() as conn:
+        rows = _select_messages(conn, conversation_id, after=after, limit=size)
+    chunk = "".join(json.dumps(dict(row), ensure_ascii=False) + "\n" for row in rows)
+    return chunk, len(rows), (rows[-1]["timestamp_ms"], rows[-1]["id"]) if rows else None
+
+
+async def _stream_messages_ndjson(
+    shard: Shard, conversation_id: int, after: tuple[int, int] | None, limit: int | None
+):
+    # Each batch is read and serialized on whichever reader thread is free, so the
+    # stream never holds a cursor open across yields.
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = MESSAGE_STREAM_BATCH if remaining is None else min(MESSAGE_STREAM_BATCH, remaining)
+        chunk, count, after = await run_read(_read_message_batch, shard, conversation_id, after, size)
+        if chunk:
+            yield chunk
+
+        if count < size:
+            return
+        if remaining is not None:
+            remaining -= count
+
+
+@app.get("/api/conversations/{conversation_id}/messages", response_model=MessageWindow)
+async def get_conversation_messages(
+    conversation_id: int,
+    after: str | None = Query(None, description="Messages after this cursor: <timestamp_ms>,<id>"),
+    before: str | None = Query(None, description="Messages before this cursor: <timestamp_ms>,<id>"),
+    around: int | None = Query(None, description="Center the window on this message id"),
+    limit: int | None = Query(None, ge=1),
+    format: Literal["json", "ndjson"] = "json",
+):
+    return await run_read(_get_conversation_messages, conversation_id, after, before, around, limit, format)
+
+
+def _get_conversation_messages(
+    conversation_id: int,
+    after: str | None,
+    before: str | None,
+    around: int | None,
+    limit: int | None,
+    format: str,
+) -> MessageWindow | StreamingResponse:
+    if sum(value is not None for value in (after, before, around)) > 1:
+        raise HTTPException(status_code=400, detail="Use only one of after, before and around")
+
+    shard = _conversation_shard(conversation_id)
+    with shard.reader() as conn:
+        if not conn.execute("SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)).fetchone():
+            raise HTTPException(status_code=404, detail="Conversation not found")
+
+        after_cursor = _parse_time_cursor(after, "after", "timestamp_ms") if after else None
+        before_cursor = _parse_time_cursor(before, "before", "timestamp_ms") if before else None
+
+        if format == "ndjson":
+            if before_cursor or around is not None:
+                raise HTTPException(status_code=400, detail="NDJSON streams only support after")
+            return StreamingResponse(
+                _stream_messages_ndjson(shard, conversation_id, after_cursor, limit),
+                media_type="application/x-ndjson",
+            )
+
+        limit = min(limit or MESSAGE_WINDOW_LIMIT, MESSAGE_WINDOW_MAX)
+        if around is not None:
+            center = _message_cursor(conn, conversation_id, around)
+            earlier = _select_messages(conn, conversation_id, before=center, limit=limit // 2 + 1)
+            later = _select_messages(conn, conversation_id, after=center, limit=limit - limit // 2 + 1, inclusive=True)
+            has_before = len(earlier) > limit // 2
+            has_after = len(later) > limit - limit // 2
+            rows = earlier[len(earlier) - limit // 2 :] + later[: limit - limit // 2]
+        elif before_cursor:
+            rows = _select_messages(conn, conversation_id, before=before_cursor, limit=limit + 1)
+            has_before, has_after = len(rows) > limit, True
+            rows = rows[-limit:]
+        else:
+            rows = _select_messages(conn, conversation_id, after=after_cursor, limit=limit + 1)
+            has_before, has_after = after_cursor is not None, len(rows) > limit
+            rows = rows[:limit]
+
+    return MessageWindow(
+        items=[Message(**dict(row)) for row in rows],
+        has_before=has_before,
+        has_after=has_after,
+    )
+
+
 @app.get("/api/conversations/{conversation_id}/attachments", response_model=list[Attachment])
-def get_attachments(conversation_id: int):
-    with get_db() as conn:
+async def get_attachments(request: Request, conversation_id: int):
+    shard = _conversation_shard(conversation_id)
+    return await _cached_json(request, _get_attachments, shard, conversation_id, shard=shard)
+
+
+def _get_attachments(shard: Shard, conversation_id: int) -> list[Attachment]:
+    with shard.reader() as conn:
         exists = conn.execute("SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
         if not exists:
             raise HTTPException(status_code=404, detail="Conversation not found")
@@ -319,20 +605,507 @@ def get_attachments(conversation_id: int):
     return [Attachment(**dict(row)) for row in rows]
 
 
-@app.get("/api/search", response_model=list[SearchResult])
-def search_messages(query: str = Query(..., min_length=1)):
-    like_query = f"%{query}%"
+def _find_archive(shard: Shard, sha256: str):
+    with shard.reader() as conn:
+        return conn.execute(
+            "SELECT local_path FROM media_blobs WHERE sha256 = ? AND ref_count > 0",
+            (sha256,),
+        ).fetchone()
+
+
+def _open_archive(sha256: str) -> zipfile.ZipFile:
+    # Shards share the media directory; any shard whose conversations use the archive knows its path.
+    row = next(filter(None, shard_set.fan_out(_find_archive, sha256)), None)
+    if not row or not row["local_path"].endswith(".zip"):
+        raise HTTPException(status_code=404, detail="Archive not found")
+    try:
+        return zipfile.ZipFile(blob_file(MEDIA_DIR, row["local_path"]))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Archive not found")
+
+
+@app.get("/api/archives/{sha256}/members", response_model=list[ArchiveMember])
+async def list_archive_members(sha256: str):
+    return await run_read(_list_archive_members, sha256)
+
+
+def _list_archive_members(sha256: str) -> list[ArchiveMember]:
+    with _open_archive(sha256) as archive:
+        return [
+            ArchiveMember(name=info.filename, size=info.file_size, mime_type=mimetypes.guess_type(info.filename)[0])
+            for info in archive.infolist()
+            if not info.is_dir()
+        ]
+
+
+def _stream_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo):
+    with archive, archive.open(info) as member:
+        while chunk := member.read(COPY_CHUNK_SIZE):
+            yield chunk
+
+
+def _open_archive_member(sha256: str, name: str) -> tuple[zipfile.ZipFile, zipfile.ZipInfo]:
+    archive = _open_archive(sha256)
+    try:
+        return archive, archive.getinfo(name)
+    except KeyError:
+        archive.close()
+        raise HTTPException(status_code=404, detail="Archive member not found")
 
-    with get_db() as conn:
+
+@app.get("/api/archives/{sha256}/members/{name:path}")
+async def get_archive_member(sha256: str, name: str):
+    # Members no conversation references are never extracted; they are read from the
+    # stored export on demand. The chunks are read in the threadpool by StreamingResponse.
+    archive, info = await run_read(_open_archive_member, sha256, name)
+    return StreamingResponse(
+        _stream_member(archive, info),
+        media_type=mimetypes.guess_type(name)[0] or "application/octet-stream",
+        headers={"Content-Length": str(info.file_size)},
+    )
+
+
+@app.get("/api/export")
+async def export_archive(
+    format: Literal["zip", "ndjson", "ndjson.gz"] = "zip",
+    include_archives: bool = Query(False, description="Also include the uploaded export ZIPs (zip format only)"),
+    shard: str | None = Query(None, description="Export this shard instead of the main database"),
+):
+    target = shard_set.get(shard) if shard else shard_set.main
+    if target is None:
+        raise HTTPException(status_code=404, detail="Shard not found")
+    # The generators read from their own snapshot connection in the threadpool, batch by
+    # batch, so a multi-GB export streams without tying up a reader or buffering.
+    if format == "zip":
+        chunks = export.stream_zip(include_archives, target.pool())
+    else:
+        chunks = export.stream_ndjson(format == "ndjson.gz", target.pool())
+    return StreamingResponse(
+        chunks,
+        media_type=export.FORMATS[format][0],
+        headers={"Content-Disposition": f'attachment; filename="{export.export_filename(format)}"'},
+    )
+
+
+@dataclass
+class SearchFilters:
+    role: str | None = None
+    source: str | None = None
+    conversation_id: int | None = None
+    # Epoch milliseconds, compared with messages.timestamp_ms.
+    start: int | None = None
+    end: int | None = None
+
+    def clauses(self, time: str = "m.timestamp_ms") -> tuple[list[str], list[str | int]]:
+        """WHERE clauses over messages m and conversations c; time is the SQL for m's timestamp_ms."""
+        clauses: list[str] = []
+        params: list[str | int] = []
+        for clause, value in (
+            ("m.role = ?", self.role),
+            ("c.source = ?", self.source),
+            ("m.conversation_id = ?", self.conversation_id),
+            (f"{time} >= ?", self.start),
+            (f"{time} < ?", self.end),
+        ):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        return clauses, params
+
+
+def _epoch_bound(value: datetime | None) -> int | None:
+    # Times without an offset are UTC, as they are for stored timestamps.
+    return epoch_ms(value.isoformat()) if value is not None else None
+
+
+@app.get("/api/search", response_model=SearchPage)
+async def search_messages(
+    query: str = Query(..., min_length=1),
+    mode: Literal["keyword", "semantic"] = "keyword",
+    role: str | None = Query(None, description="Only messages with this role, e.g. user or assistant"),
+    source: str | None = Query(None, description="Only conversations imported from this file"),
+    conversation_id: int | None = None,
+    start: datetime | None = Query(None, alias="from", description="Messages at or after this time (UTC)"),
+    end: datetime | None = Query(None, alias="to", description="Messages before this time (UTC)"),
+    order: Literal["relevance", "recency"] = "relevance",
+    after: str | None = Query(None, description="Cursor from a previous page"),
+    limit: int = Query(SEARCH_PAGE_LIMIT, ge=1, le=SEARCH_PAGE_MAX),
+):
+    filters = SearchFilters(role, source, conversation_id, _epoch_bound(start), _epoch_bound(end))
+    if mode == "semantic":
+        if after:
+            raise HTTPException(status_code=400, detail="Semantic search returns a single page")
+        return await run_read(_semantic_search, query, filters, min(limit, SEMANTIC_SEARCH_LIMIT))
+    return await run_read(_search_messages, query, filters, order, after, limit)
+
+
+def _search_cursor(after: str | None, order: str) -> tuple[int | float, int] | None:
+    if not after:
+        return None
+    if order == "recency":
+        return _parse_time_cursor(after, "after", "timestamp_ms")
+    rank, message_id = _parse_cursor(after, "after", "rank")
+    try:
+        return float(rank), message_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="after must look like <rank>,<id>")
+
+
+def _drive_from_filters(conn, match_query: str, tables: str, where: str, params: list[str | int]) -> bool:
+    """Whether to scan the filtered messages and check each against the search index.
+
+    That beats walking every full-text match when the filters leave fewer messages than
+    the query matches, e.g. one conversation, or one role over a short time range.
+    """
+    candidates = conn.execute(
+        f"SELECT COUNT(*) FROM (SELECT 1 FROM {tables} WHERE {where} LIMIT ?)",
+        (*params, SEARCH_FILTER_SCAN_LIMIT),
+    ).fetchone()[0]
+    if candidates >= SEARCH_FILTER_SCAN_LIMIT:
+        return False
+    matches = conn.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM messages_fts WHERE messages_fts MATCH ? LIMIT ?)",
+        (match_query, candidates),
+    ).fetchone()[0]
+    return matches >= candidates
+
+
+def _rank_messages(conn, match_query: str, message_ids: list[int]) -> list[tuple[float, int]]:
+    # bm25 counts the documents matching each term once per index cursor, so probing
+    # the index with rank once per message repeats that count every time. One cursor
+    # over the id range, with the id list as a plain filter (+rowid keeps SQLite from
+    # turning it into one probe per id), counts once.
+    rows = conn.execute(
+        """
+        SELECT rank, rowid FROM messages_fts
+        WHERE messages_fts MATCH ? AND rowid BETWEEN ? AND ?
+            AND +rowid IN (SELECT value FROM json_each(?))
+        """,
+        (match_query, min(message_ids), max(message_ids), json.dumps(message_ids)),
+    ).fetchall()
+    return sorted((row[0], row[1]) for row in rows)
+
+
+def _search_page(
+    conn,
+    match_query: str,
+    filters: SearchFilters,
+    order: str,
+    cursor: tuple[int | float, int] | None,
+    size: int,
+) -> list[tuple[int, int | float]]:
+    """(message id, sort key) of up to `size` matches in result order, after `cursor`."""
+    time = message_time(conn, "m")
+    clauses, params = filters.clauses(time)
+    # CROSS JOIN fixes the join order, so the plan chosen here is the one SQLite runs.
+    if filters.source:
+        # Conversations from idx_conversations_source_time, then their messages.
+        tables = "conversations AS c CROSS JOIN messages AS m ON m.conversation_id = c.id"
+    else:
+        tables = "messages AS m"
+
+    if clauses and _drive_from_filters(conn, match_query, tables, " AND ".join(clauses), params):
+        source_tables = f"{tables} CROSS JOIN messages_fts ON messages_fts.rowid = m.id"
+        if order == "relevance":
+            message_ids = [
+                row[0]
+                for row in conn.execute(
+                    f"SELECT m.id FROM {source_tables} WHERE {' AND '.join(['messages_fts MATCH ?', *clauses])}",
+                    (match_query, *params),
+                )
+            ]
+            ranked = _rank_messages(conn, match_query, message_ids) if message_ids else []
+            if cursor:
+                ranked = [entry for entry in ranked if entry > cursor]
+            return [(message_id, rank) for rank, message_id in ranked[:size]]
+    else:
+        source_tables = "messages_fts CROSS JOIN messages AS m ON m.id = messages_fts.rowid"
+        if filters.source:
+            source_tables += " JOIN conversations AS c ON c.id = m.conversation_id"
+
+    if order == "recency":
+        key, order_by = time, f"{time} DESC, m.id DESC"
+        if cursor:
+            clauses.append(f"({time}, m.id) < (?, ?)")
+            params.extend(cursor)
+    else:
+        # rank is FTS5's bm25 score: lower is more relevant.
+        key, order_by = "messages_fts.rank", "messages_fts.rank, m.id"
+        if cursor:
+            clauses.append("(messages_fts.rank, m.id) > (?, ?)")
+            params.extend(cursor)
+
+    rows = conn.execute(
+        f"""
+        SELECT m.id, {key}
+        FROM {source_tables}
+        WHERE {" AND ".join(["messages_fts MATCH ?", *clauses])}
+        ORDER BY {order_by}
+        LIMIT ?
+        """,
+        (match_query, *params, size),
+    ).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+
+def _filter_shards(conversation_id: int | None) -> list[Shard] | None:
+    """The shards to read when narrowed to one conversation; None for all of them."""
+    if conversation_id is None:
+        return None
+    shard = shard_set.for_id(conversation_id)
+    return [shard] if shard else []
+
+
+def _search_shard(
+    shard: Shard,
+    match_query: str,
+    filters: SearchFilters,
+    order: str,
+    cursor: tuple[int | float, int] | None,
+    size: int,
+) -> list[tuple[int, int | float]]:
+    with shard.reader() as conn:
+        return _search_page(conn, match_query, filters, order, cursor, size)
+
+
+def _search_snippets(shard: Shard, match_query: str, message_ids: list[int]) -> list[dict]:
+    """Result fields of those message_ids that shard holds."""
+    with shard.reader() as conn:
         rows = conn.execute(
             """
-            SELECT conversation_id, id AS message_id, content AS snippet, timestamp
-            FROM messages
-            WHERE content LIKE ?
-            ORDER BY timestamp DESC
-            LIMIT 200
+            SELECT
+                m.conversation_id,
+                m.id AS message_id,
+                m.role,
+                m.timestamp,
+                c.title AS conversation_title,
+                snippet(messages_fts, 0, ?, ?, ?, ?) AS marked_snippet
+            FROM json_each(?) AS page
+            CROSS JOIN messages_fts ON messages_fts.rowid = page.value
+            CROSS JOIN messages AS m ON m.id = page.value
+            JOIN conversations AS c ON c.id = m.conversation_id
+            WHERE messages_fts MATCH ?
+            """,
+            (
+                HIGHLIGHT_START,
+                HIGHLIGHT_END,
+                ELLIPSIS,
+                SNIPPET_TOKENS,
+                json.dumps(message_ids),
+                match_query,
+            ),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _search_messages(
+    query: str, filters: SearchFilters, order: str, after: str | None, limit: int
+) -> SearchPage:
+    match_query = build_fts_query(query)
+    if not match_query:
+        return SearchPage(items=[], next_after=None)
+
+    cursor = _search_cursor(after, order)
+    # Each shard returns its own first page after the cursor, and the pages are merged.
+    # BM25 weighs terms by each shard's own index, so relevance across shards is approximate.
+    pages = shard_set.fan_out(
+        _search_shard, match_query, filters, order, cursor, limit + 1, shards=_filter_shards(filters.conversation_id)
+    )
+    merged = heapq.merge(*pages, key=lambda entry: (entry[1], entry[0]), reverse=order == "recency")
+    page = list(islice(merged, limit + 1))
+
+    # Snippets are built only for the page, once its order is settled, by the shards holding it.
+    message_ids = [message_id for message_id, _ in page[:limit]]
+    holders = list(dict.fromkeys(shard_set.for_id(message_id) for message_id in message_ids))
+    found = {
+        fields["message_id"]: fields
+        for rows in shard_set.fan_out(_search_snippets, match_query, message_ids, shards=holders)
+        for fields in rows
+    }
+
+    results: list[SearchResult] = []
+    for message_id in message_ids:
+        # Deleted since the page was read.
+        fields = found.get(message_id)
+        if fields is None:
+            continue
+        snippet, highlights = split_highlights(fields.pop("marked_snippet"))
+        results.append(SearchResult(**fields, snippet=snippet, highlights=highlights))
+
+    next_after = None
+    if len(page) > limit:
+        message_id, key = page[limit - 1]
+        next_after = f"{key if order == 'recency' else repr(key)},{message_id}"
+    return SearchPage(items=results, next_after=next_after)
+
+
+def _semantic_shard(
+    shard: Shard, query: str, filters: SearchFilters, limit: int
+) -> list[tuple[float, dict]] | None:
+    """(similarity, result fields) of shard's closest messages passing the filters, or None without an index."""
+    # Filters are applied to the nearest vectors, so look further when there are any.
+    filtered = any(value is not None for value in vars(filters).values())
+    hits = semantic.get_index(shard.path).search(query, limit * SEMANTIC_FILTER_OVERFETCH if filtered else limit)
+    if not hits:
+        return hits
+
+    with shard.reader() as conn:
+        clauses, params = filters.clauses(message_time(conn, "m"))
+        rows = conn.execute(
+            f"""
+            SELECT
+                m.conversation_id,
+                m.id AS message_id,
+                m.role,
+                m.timestamp,
+                content_text(m.content) AS content,
+                c.title AS conversation_title
+            FROM messages AS m
+            JOIN conversations AS c ON c.id = m.conversation_id
+            WHERE {" AND ".join(["m.id IN (SELECT value FROM json_each(?))", *clauses])}
             """,
-            (like_query,),
+            (json.dumps([message_id for message_id, _ in hits]), *params),
         ).fetchall()
 
-    return [SearchResult(**dict(row)) for row in rows]
+    by_id = {row["message_id"]: dict(row) for row in rows}
+    # Filtered out, or deleted since indexing: vectors stay until the index is rebuilt.
+    return [(score, by_id[message_id]) for message_id, score in hits if message_id in by_id][:limit]
+
+
+def _semantic_search(query: str, filters: SearchFilters, limit: int) -> SearchPage:
+    found = shard_set.fan_out(
+        _semantic_shard, query, filters, limit, shards=_filter_shards(filters.conversation_id)
+    )
+    if found and all(matches is None for matches in found):
+        raise HTTPException(
+            status_code=503,
+            detail="The semantic index has not been built yet; import an export or run manage.py build-semantic-index",
+        )
+    # Every shard fits its own model; cosine similarities are compared as they are.
+    nearest = heapq.nlargest(limit, (match for matches in found if matches for match in matches), key=lambda match: match[0])
+
+    # Highlight the query's own words where they occur; matches are often paraphrases.
+    terms = set(semantic.tokenize(query))
+    results: list[SearchResult] = []
+    for _, fields in nearest:
+        snippet, highlights = split_highlights(mark_terms(fields.pop("content"), terms))
+        results.append(SearchResult(**fields, snippet=snippet, highlights=highlights))
+    return SearchPage(items=results, next_after=None)
+
+
+def _day_date(day: int) -> str:
+    """ISO date of a day number (timestamp_ms / DAY_MS)."""
+    return (date(1970, 1, 1) + timedelta(days=day)).isoformat()
+
+
+@app.get("/api/timeline", response_model=list[TimelineDay])
+async def get_timeline(
+    start: datetime | None = Query(None, alias="from", description="Messages at or after this time (UTC)"),
+    end: datetime | None = Query(None, alias="to", description="Messages before this time (UTC)"),
+    role: str | None = None,
+    source: str | None = None,
+    conversation_id: int | None = None,
+):
+    return await run_read(_get_timeline, _epoch_bound(start), _epoch_bound(end), role, source, conversation_id)
+
+
+def _get_timeline(
+    start: int | None, end: int | None, role: str | None, source: str | None, conversation_id: int | None
+) -> list[TimelineDay]:
+    filters: tuple[tuple[str, str | int | None], ...]
+    if conversation_id is None and all(bound is None or bound % DAY_MS == 0 for bound in (start, end)):
+        # Whole days across all conversations are summed from daily_rollups.
+        table, day, count = "{rollups}", "day", "SUM(messages)"
+        filters = (
+            ("role = ?", role),
+            ("source = ?", source),
+            ("day >= ?", None if start is None else start // DAY_MS),
+            ("day < ?", None if end is None else end // DAY_MS),
+        )
+    else:
+        # Apart from source, every filter is a prefix of idx_messages_time,
+        # idx_messages_role_time or idx_messages_conversation_time, so the count never
+        # reads the messages table.
+        table, day, count = "messages", f"{{time}} / {DAY_MS}", "COUNT(*)"
+        filters = (
+            ("role = ?", role),
+            ("conversation_id = ?", conversation_id),
+            ("{time} >= ?", start),
+            ("{time} < ?", end),
+            ("conversation_id IN (SELECT id FROM conversations WHERE source = ?)", source),
+        )
+
+    clauses: list[str] = []
+    params: list[str | int] = []
+    for clause, value in filters:
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    sql = f"""
+        SELECT {day} AS day, {count} AS count
+        FROM {table}
+        {where}
+        GROUP BY day
+    """
+    counts: Counter[int] = Counter()
+    for rows in shard_set.fan_out(_count_days, sql, params, shards=_filter_shards(conversation_id)):
+        counts.update(dict(rows))
+    return [TimelineDay(day=_day_date(day), count=counts[day]) for day in sorted(counts)]
+
+
+def _count_days(shard: Shard, sql: str, params: list[str | int]) -> list[tuple[int, int]]:
+    # sql reads {rollups} and {time} for the shard's daily_rollups and timestamp_ms, which
+    # are computed while a backfill is still filling them in.
+    with shard.reader() as conn:
+        sql = sql.format(rollups=rollup_tables(conn)[1], time=message_time(conn))
+        return [(row[0], row[1]) for row in conn.execute(sql, params)]
+
+
+@app.get("/api/stats", response_model=ArchiveStats)
+async def get_stats(request: Request):
+    return await _cached_json(request, _get_stats)
+
+
+def _read_rollups(shard: Shard) -> tuple[list[tuple], list[tuple[str, int]], tuple[int | None, int | None]]:
+    with shard.reader() as conn:
+        source_rollups, daily_rollups = rollup_tables(conn)
+        sources = [
+            tuple(row)
+            for row in conn.execute(f"SELECT source, {', '.join(stats.SOURCE_COLUMNS)} FROM {source_rollups}")
+        ]
+        roles = [
+            (row[0], row[1]) for row in conn.execute(f"SELECT role, SUM(messages) FROM {daily_rollups} GROUP BY role")
+        ]
+        first_day, last_day = conn.execute(f"SELECT MIN(day), MAX(day) FROM {daily_rollups}").fetchone()
+    return sources, roles, (first_day, last_day)
+
+
+def _get_stats() -> ArchiveStats:
+    # Only the rollup tables are read, so this costs the same however many messages there
+    # are (once the rollups backfill has built them).
+    totals: dict[str, list[int]] = {}
+    role_totals: Counter[str] = Counter()
+    days: list[int] = []
+    for shard_sources, shard_roles, bounds in shard_set.fan_out(_read_rollups):
+        for source, *counts in shard_sources:
+            total = totals.setdefault(source, [0] * len(counts))
+            for index, count in enumerate(counts):
+                total[index] += count
+        role_totals.update(dict(shard_roles))
+        days.extend(day for day in bounds if day is not None)
+
+    sources = [
+        SourceStats(source=source, **dict(zip(stats.SOURCE_COLUMNS, totals[source]))) for source in sorted(totals)
+    ]
+    roles = [RoleStats(role=role, messages=role_totals[role]) for role in sorted(role_totals)]
+    first_day, last_day = (min(days), max(days)) if days else (None, None)
+
+    return ArchiveStats(
+        **{column: sum(getattr(entry, column) for entry in sources) for column in stats.SOURCE_COLUMNS},
+        first_day=None if first_day is None else _day_date(first_day),
+        last_day=None if last_day is None else _day_date(last_day),
+        sources=sources,
+        roles=roles,
+    )
@@ -0,0 +1,309 @@
+"""
+Maintenance commands for the archive database.
+
+Usage (from the backend directory):
+    python manage.py [--shard NAME] <command>
+    python manage.py rebuild-fts
+    python manage.py migrate-media [--prune-unreferenced]
+    python manage.py gc-media
+    python manage.py build-semantic-index
+    python manage.py export [--format zip|ndjson|ndjson.gz] [--include-archives] [--output PATH]
+    python manage.py compress-content [--retrain | --decompress] [--vacuum]
+    python manage.py content-report
+    python manage.py rebuild-stats
+    python manage.py add-shard NAME [--path PATH] [--route PATTERN]
+    python manage.py seal-shard NAME [--unseal]
+    python manage.py list-shards
+    python manage.py migrate
+
+--shard runs a command against that shard's database instead of the main one.
+"""
+
+from __future__ import annotations
+
+import argparse
+from datetime import datetime
+import mimetypes
+from pathlib import Path, PurePosixPath
+import time
+
+import codec
+import db
+import migrations
+from db import get_db, get_write_db, init_db, rebuild_search_index
+import export
+from media import blob_file, register_blobs, store_blob
+import semantic
+import shards
+from shards import shard_set
+import stats
+
+
+def _rebuild_fts(args: argparse.Namespace) -> None:
+    with get_write_db() as conn:
+        rebuild_search_index(conn)
+        indexed = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    print(f"Rebuilt full-text index over {indexed} messages")
+
+
+def _migrate(args: argparse.Namespace) -> None:
+    # init_db() has applied the migrations already; what is left are their backfills.
+    shards = [shard_set.get(args.shard)] if args.shard else None
+    started = time.perf_counter()
+    batches = 0
+    while shard_set.backfill_batch(shards) is not None:
+        batches += 1
+    print(f"Ran {batches} backfill batches in {time.perf_counter() - started:.1f}s")
+    for shard in shards or shard_set.shards:
+        with shard.reader() as conn:
+            version = migrations.schema_version(conn)
+            pending = [row["name"] for row in migrations.backfill_status(conn) if row["finished_at"] is None]
+        state = f"backfills pending: {', '.join(pending)}" if pending else "up to date"
+        print(f"{shard.name}: schema version {version}, {state}")
+
+
+def _migrate_media(args: argparse.Namespace) -> None:
+    moved = missing = 0
+    with get_write_db() as conn:
+        paths = conn.execute("SELECT DISTINCT local_path FROM attachments WHERE blob_sha256 IS NULL").fetchall()
+        for (local_path,) in paths:
+            path = blob_file(db.MEDIA_DIR, local_path)
+            if not path.is_file():
+                missing += 1
+                continue
+
+            with path.open("rb") as source:
+                sha256, relative_path, size = store_blob(source, db.MEDIA_DIR, path.suffix)
+            blob_path = str(PurePosixPath("media") / relative_path)
+            mime_type, _ = mimetypes.guess_type(path.name)
+            register_blobs(conn, [(sha256, blob_path, size, mime_type, datetime.utcnow().isoformat())])
+            conn.execute(
+                "UPDATE attachments SET blob_sha256 = ?, local_path = ? WHERE local_path = ? AND blob_sha256 IS NULL",
+                (sha256, blob_path, local_path),
+            )
+            conn.commit()
+            path.unlink()
+            moved += 1
+        if moved:
+            # Migrated attachments now have sizes, which the attachment byte counts include.
+            stats.rebuild(conn, db.message_time(conn, "m"))
+            conn.commit()
+            # Attachment paths changed; a running server picks this up when restarted.
+            db.archive_generation.bump(conn)
+
+        pruned = 0
+        if args.prune_unreferenced:
+            # Files written by older versions for members no attachment ever linked to, in
+            # any shard.
+            referenced: set[str] = set()
+            for shard in shard_set.shards:
+                with shard.reader() as shard_conn:
+                    referenced.update(row[0] for row in shard_conn.execute("SELECT DISTINCT local_path FROM attachments"))
+            for path in db.MEDIA_DIR.iterdir():
+                if path.is_file() and f"media/{path.name}" not in referenced:
+                    path.unlink()
+                    pruned += 1
+
+    blobs, freed = shard_set.collect_media_garbage()
+
+    print(f"Moved {moved} files into the media store ({missing} missing on disk)")
+    if args.prune_unreferenced:
+        print(f"Deleted {pruned} unreferenced legacy files")
+    print(f"Collected {blobs} unreferenced blobs ({freed} bytes)")
+
+
+def _gc_media(args: argparse.Namespace) -> None:
+    blobs, freed = shard_set.collect_media_garbage()
+    print(f"Collected {blobs} unreferenced blobs ({freed} bytes)")
+
+
+def _rebuild_stats(args: argparse.Namespace) -> None:
+    with get_write_db() as conn:
+        stats.rebuild(conn, db.message_time(conn, "m"))
+        conn.commit()
+        db.archive_generation.bump(conn)
+        sources, messages = conn.execute("SELECT COUNT(*), COALESCE(SUM(messages), 0) FROM source_rollups").fetchone()
+    print(f"Rebuilt statistics for {messages} messages from {sources} sources")
+
+
+def _add_shard(args: argparse.Namespace) -> None:
+    try:
+        shard = shards.create_shard(args.name, args.path, args.route)
+    except ValueError as exc:
+        raise SystemExit(f"error: {exc}")
+    print(f"Added shard {shard.name} at {shard.path} (ids from {shard.first_id})")
+
+
+def _seal_shard(args: argparse.Namespace) -> None:
+    try:
+        shard = shards.seal_shard(args.name, sealed=not args.unseal)
+    except ValueError as exc:
+        raise SystemExit(f"error: {exc}")
+    print(f"Shard {shard.name} is now {'read-only' if shard.read_only else 'writable'}")
+
+
+def _list_shards(args: argparse.Namespace) -> None:
+    for shard in shard_set.shards:
+        with shard.reader() as conn:
+            conversations, messages = conn.execute(
+                "SELECT COALESCE(SUM(conversations), 0), COALESCE(SUM(messages), 0) "
+                f"FROM {db.rollup_tables(conn)[0]}"
+            ).fetchone()
+        print(
+            f"{shard.number:>4}  {shard.name:<16} {'sealed' if shard.read_only else 'writable':<8} "
+            f"route={shard.route or '-':<12} {conversations} conversations, {messages} messages  {shard.path}"
+        )
+
+
+def _build_semantic_index(args: argparse.Namespace) -> None:
+    index = semantic.get_index()
+    with get_db() as conn:
+        embedded = index.rebuild(conn)
+    print(f"Embedded {embedded} messages into {index.directory} ({index.stats()['dimensions']} dimensions)")
+
+
+def _export(args: argparse.Namespace) -> None:
+    output = args.output or Path(export.export_filename(args.format))
+    if args.format == "zip":
+        chunks = export.stream_zip(args.include_archives)
+    else:
+        chunks = export.stream_ndjson(compress=args.format == "ndjson.gz")
+
+    started = time.perf_counter()
+    written = 0
+    with output.open("wb") as file:
+        for chunk in chunks:
+            file.write(chunk)
+            written += len(chunk)
+    elapsed = time.perf_counter() - started
+    print(f"Exported {written} bytes to {output} in {elapsed:.1f}s")
+
+
+def _print_content_report() -> None:
+    with get_db() as conn:
+        report = codec.space_report(conn)
+    saved = report["text_bytes"] - report["stored_bytes"]
+    share = saved / report["text_bytes"] if report["text_bytes"] else 0.0
+    print(f"{report['compressed']} of {report['messages']} messages stored compressed")
+    print(f"Message text: {report['text_bytes']} bytes stored in {report['stored_bytes']} ({saved} bytes, {share:.0%} saved)")
+    if report["messages_table_bytes"] is not None:
+        print(f"messages table: {report['messages_table_bytes']} bytes on disk")
+    print(f"Database file: {report['file_bytes']} bytes, {report['free_bytes']} of them free pages")
+
+
+def _compress_content(args: argparse.Namespace) -> None:
+    started = time.perf_counter()
+    with get_write_db() as conn:
+        if args.decompress:
+            dictionary_id = None
+        else:
+            dictionary_id = codec.current_dictionary(conn)
+            if args.retrain or dictionary_id == codec.NO_DICTIONARY:
+                dictionary_id = codec.train_archive_dictionary(conn)
+                print(f"Trained dictionary {dictionary_id}")
+        scanned, rewritten = codec.recompress(conn, db.DB_PATH, dictionary_id)
+    print(f"Rewrote {rewritten} of {scanned} messages in {time.perf_counter() - started:.1f}s")
+
+    if args.vacuum:
+        # Freed pages stay in the file until it is rebuilt; VACUUM needs no other writer.
+        with get_write_db() as conn:
+            conn.execute("VACUUM")
+    _print_content_report()
+
+
+def _content_report(args: argparse.Namespace) -> None:
+    _print_content_report()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="AI Chat Archive maintenance commands")
+    parser.add_argument("--shard", help="Run the command against this shard instead of the main database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_fts = commands.add_parser("rebuild-fts", help="Rebuild the full-text search index from messages")
+    rebuild_fts.set_defaults(handler=_rebuild_fts)
+
+    rebuild_stats = commands.add_parser("rebuild-stats", help="Recompute the statistics rollups from the tables")
+    rebuild_stats.set_defaults(handler=_rebuild_stats)
+
+    migrate_media = commands.add_parser(
+        "migrate-media", help="Move files from the flat media layout into the content-addressed store"
+    )
+    migrate_media.add_argument(
+        "--prune-unreferenced",
+        action="store_true",
+        help="Also delete flat-layout files that no attachment references",
+    )
+    migrate_media.set_defaults(handler=_migrate_media)
+
+    gc_media = commands.add_parser("gc-media", help="Delete media blobs no attachment references")
+    gc_media.set_defaults(handler=_gc_media)
+
+    build_semantic_index = commands.add_parser(
+        "build-semantic-index", help="Refit the semantic search model and re-embed every message"
+    )
+    build_semantic_index.set_defaults(handler=_build_semantic_index, read_only=True)
+
+    export_archive = commands.add_parser("export", help="Write the whole archive to a ZIP or NDJSON file")
+    export_archive.add_argument("--format", choices=sorted(export.FORMATS), default="zip")
+    export_archive.add_argument(
+        "--include-archives", action="store_true", help="Also include the uploaded export ZIPs (zip format only)"
+    )
+    export_archive.add_argument("--output", type=Path, help="Defaults to chat-archive-<time>.<format>")
+    export_archive.set_defaults(handler=_export, read_only=True)
+
+    compress_content = commands.add_parser(
+        "compress-content", help="Store message content compressed with a dictionary trained on the archive"
+    )
+    compress_mode = compress_content.add_mutually_exclusive_group()
+    compress_mode.add_argument(
+        "--retrain", action="store_true", help="Train a new dictionary and recompress everything with it"
+    )
+    compress_mode.add_argument("--decompress", action="store_true", help="Store all content as plain text again")
+    compress_content.add_argument(
+        "--vacuum", action="store_true", help="Rebuild the database file afterwards to return freed space to the disk"
+    )
+    compress_content.set_defaults(handler=_compress_content)
+
+    content_report = commands.add_parser("content-report", help="Show how much space message content takes")
+    content_report.set_defaults(handler=_content_report, read_only=True)
+
+    add_shard = commands.add_parser("add-shard", help="Create a shard database and register it")
+    add_shard.add_argument("name")
+    add_shard.add_argument("--path", type=Path, help="Defaults to chat_archive-<name>.db next to the main database")
+    add_shard.add_argument(
+        "--route", help="New conversations whose routing key (year or source) matches this pattern go to the shard"
+    )
+    add_shard.set_defaults(handler=_add_shard)
+
+    seal_shard = commands.add_parser(
+        "seal-shard", help="Make a shard read-only (immutable); stop the server first"
+    )
+    seal_shard.add_argument("name")
+    seal_shard.add_argument("--unseal", action="store_true", help="Make the shard writable again")
+    seal_shard.set_defaults(handler=_seal_shard)
+
+    list_shards = commands.add_parser("list-shards", help="List the main database and its shards")
+    list_shards.set_defaults(handler=_list_shards, read_only=True)
+
+    migrate = commands.add_parser(
+        "migrate", help="Run pending schema backfills to completion instead of in the server's background"
+    )
+    migrate.set_defaults(handler=_migrate)
+
+    args = parser.parse_args(argv)
+    init_db()
+    shard_set.load()
+    if args.shard:
+        shard = shard_set.get(args.shard)
+        if shard is None:
+            parser.error(f"no shard named {args.shard}")
+        if shard.read_only and not getattr(args, "read_only", False):
+            parser.error(f"shard {shard.name} is sealed; run seal-shard {shard.name} --unseal first")
+        # The commands work on db.DB_PATH; the shard registry stays the main database's.
+        db.DB_PATH = shard.path
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
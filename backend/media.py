@@ -0,0 +1,116 @@
+"""
+Content-addressed media store.
+
+Attachment files and uploaded ZIP archives are stored once per content hash under
+MEDIA_DIR/<aa>/<bb>/<sha256><ext>, so re-imports and overlapping exports don't duplicate
+them. media_blobs keeps a reference count per blob, maintained by triggers on
+attachments and conversations; blobs whose count drops to zero are removed by
+collect_garbage().
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path, PurePosixPath
+import re
+import sqlite3
+import tempfile
+from typing import BinaryIO, Callable
+
+INCOMING_DIR = ".incoming"
+
+_SUFFIX_RE = re.compile(r"^\.[a-z0-9]{1,10}$")
+
+
+def blob_relative_path(sha256: str, suffix: str) -> PurePosixPath:
+    suffix = suffix.lower()
+    if not _SUFFIX_RE.match(suffix):
+        suffix = ""
+    return PurePosixPath(sha256[:2]) / sha256[2:4] / f"{sha256}{suffix}"
+
+
+def store_blob(
+    stream: BinaryIO, media_dir: Path, suffix: str, head: bytes = b"", chunk_size: int = 1024 * 1024
+) -> tuple[str, PurePosixPath, int]:
+    """Copy a stream into the store while hashing it; returns (sha256, path relative to media_dir, size).
+
+    The data is written to a temporary file first and renamed into place, so readers
+    never see a partial blob and storing identical content twice is harmless.
+    """
+    incoming = media_dir / INCOMING_DIR
+    incoming.mkdir(parents=True, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=incoming, delete=False) as output:
+        try:
+            chunk = head or stream.read(chunk_size)
+            while chunk:
+                digest.update(chunk)
+                output.write(chunk)
+                size += len(chunk)
+                chunk = stream.read(chunk_size)
+        except BaseException:
+            output.close()
+            os.unlink(output.name)
+            raise
+
+    sha256 = digest.hexdigest()
+    relative_path = blob_relative_path(sha256, suffix)
+    final_path = media_dir / relative_path
+    final_path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(output.name, final_path)
+    return sha256, relative_path, size
+
+
+def blob_file(media_dir: Path, local_path: str) -> Path:
+    """Filesystem path of a blob from its stored local_path ("media/aa/bb/<sha256><ext>")."""
+    return media_dir / PurePosixPath(local_path).relative_to("media")
+
+
+def register_blobs(conn: sqlite3.Connection, blobs: list[tuple[str, str, int, str | None, str]]) -> None:
+    """Insert (sha256, local_path, size, mime_type, created_at) rows for blobs not yet known."""
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO media_blobs (sha256, local_path, size, mime_type, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        blobs,
+    )
+
+
+def collect_garbage(
+    conn: sqlite3.Connection,
+    media_dir: Path,
+    used_elsewhere: Callable[[list[str]], set[str]] | None = None,
+) -> tuple[int, int]:
+    """Delete unreferenced blobs; returns (blobs removed, bytes freed).
+
+    Rows are deleted and committed before files are unlinked, so a failed commit
+    never leaves a row pointing at a missing file. Shards share the media directory, so
+    used_elsewhere, given the hashes of removed rows, returns those whose files another
+    shard still references; those files are kept.
+    """
+    rows = conn.execute("SELECT sha256, local_path, size FROM media_blobs WHERE ref_count <= 0").fetchall()
+    if not rows:
+        return 0, 0
+
+    removed = [
+        row
+        for row in rows
+        if conn.execute("DELETE FROM media_blobs WHERE sha256 = ? AND ref_count <= 0", (row[0],)).rowcount
+    ]
+    conn.commit()
+
+    kept = used_elsewhere([row[0] for row in removed]) if used_elsewhere and removed else set()
+    freed = 0
+    for sha256, local_path, size in removed:
+        if sha256 in kept:
+            continue
+        try:
+            blob_file(media_dir, local_path).unlink()
+            freed += size
+        except FileNotFoundError:
+            pass
+    return len(removed), freed
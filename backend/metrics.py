@@ -0,0 +1,311 @@
+"""
+In-process metrics exposed in the Prometheus text format on /api/metrics.
+
+Covers per-route request latency, per-statement SQL timing and row counts (collected
+by the connection factory used for pooled connections), ingestion volume and stage
+timings. Statements slower than CHAT_ARCHIVE_SLOW_QUERY_MS are logged to the
+chat_archive.sql logger and kept in a short in-memory log.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SLOW_QUERY_SECONDS = float(os.environ.get("CHAT_ARCHIVE_SLOW_QUERY_MS", "250")) / 1000
+SLOW_QUERY_LOG_SIZE = 100
+# Set CHAT_ARCHIVE_SQL_PROFILING=0 to open pooled connections without statement timing.
+SQL_PROFILING = os.environ.get("CHAT_ARCHIVE_SQL_PROFILING", "1") != "0"
+# Statements are labelled by their whitespace-normalized text, cut to this length.
+STATEMENT_LABEL_CHARS = 160
+
+logger = logging.getLogger("chat_archive.sql")
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: LabelKey, extra: tuple[tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels: dict[str, Any]) -> LabelKey:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def _header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self._values: dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help_text)
+        self.buckets = buckets
+        # Per label set: [per-bucket counts (last one is +Inf), sum, count].
+        self._values: dict[LabelKey, list[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in sorted(self._values.items())]
+
+        lines = self._header()
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = bound if isinstance(bound, str) else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key, (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._register(Gauge(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "chat_archive_http_request_duration_seconds", "Time to produce a response, by method, route and status."
+)
+SQL_STATEMENT_SECONDS = registry.histogram(
+    "chat_archive_sql_statement_duration_seconds", "Time spent executing and fetching each SQL statement."
+)
+SQL_ROWS = registry.counter(
+    "chat_archive_sql_rows_total", "Rows returned by queries or changed by writes, per SQL statement."
+)
+SQL_SLOW_QUERIES = registry.counter(
+    "chat_archive_sql_slow_queries_total", "Statements slower than the slow query threshold."
+)
+INGEST_CONVERSATIONS = registry.counter("chat_archive_ingest_conversations_total", "Conversations imported.")
+INGEST_MESSAGES = registry.counter("chat_archive_ingest_messages_total", "Messages imported.")
+INGEST_ATTACHMENTS = registry.counter("chat_archive_ingest_attachments_total", "Attachments linked to messages.")
+INGEST_BYTES = registry.counter("chat_archive_ingest_bytes_total", "Bytes of uploaded exports processed.")
+INGEST_STAGE_SECONDS = registry.histogram(
+    "chat_archive_ingest_stage_duration_seconds",
+    "Time per ingestion step: spool (upload to disk), parse (including media extraction), insert, "
+    "embed (semantic index update).",
+)
+INGEST_JOBS = registry.gauge("chat_archive_ingest_jobs", "Tracked ingestion jobs by status.")
+DB_POOL = registry.gauge("chat_archive_db_pool", "Connection pool statistics.")
+RESPONSE_CACHE = registry.counter(
+    "chat_archive_response_cache_total", "Cacheable GET requests by result: hit, miss or not_modified."
+)
+RESPONSE_CACHE_SIZE = registry.gauge("chat_archive_response_cache", "Response cache entries, bytes and max_bytes.")
+
+slow_queries: deque[dict[str, Any]] = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+
+@lru_cache(maxsize=1024)
+def statement_label(sql: str) -> str:
+    return " ".join(sql.split())[:STATEMENT_LABEL_CHARS]
+
+
+def record_statement(sql: str, seconds: float, rows: int) -> None:
+    label = statement_label(sql)
+    SQL_STATEMENT_SECONDS.observe(seconds, statement=label)
+    if rows:
+        SQL_ROWS.inc(rows, statement=label)
+
+    if seconds >= SLOW_QUERY_SECONDS:
+        SQL_SLOW_QUERIES.inc()
+        slow_queries.append(
+            {
+                "statement": " ".join(sql.split()),
+                "duration_ms": round(seconds * 1000, 3),
+                "rows": rows,
+                "at": datetime.utcnow().isoformat(),
+            }
+        )
+        logger.warning("Slow query (%.1f ms, %d rows): %s", seconds * 1000, rows, label)
+
+
+def record_ingest(conversations: int, messages: int, attachments: int) -> None:
+    INGEST_CONVERSATIONS.inc(conversations)
+    INGEST_MESSAGES.inc(messages)
+    INGEST_ATTACHMENTS.inc(attachments)
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Times each statement from execute() until its rows are exhausted or the cursor is dropped.
+
+    Only time spent inside cursor calls counts, not the caller's work between fetches.
+    """
+
+    _statement: str | None = None
+    _elapsed = 0.0
+    _rows = 0
+
+    def _start(self, sql: str, started: float) -> None:
+        self._statement = sql
+        self._elapsed = time.perf_counter() - started
+        # rowcount is -1 for queries; their rows are counted as they are fetched.
+        self._rows = max(self.rowcount, 0)
+
+    def _finish(self) -> None:
+        if self._statement is not None:
+            statement, self._statement = self._statement, None
+            record_statement(statement, self._elapsed, self._rows)
+
+    def _fetched(self, started: float, rows: int) -> None:
+        self._elapsed += time.perf_counter() - started
+        self._rows += rows
+
+    def execute(self, sql: str, parameters: Any = ()):
+        self._finish()
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self._start(sql, started)
+        return self
+
+    def executemany(self, sql: str, seq_of_parameters: Any):
+        self._finish()
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._start(sql, started)
+        return self
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size: int | None = None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(started, len(rows))
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        self._finish()
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0)
+            self._finish()
+            raise
+        self._fetched(started, 1)
+        return row
+
+    def close(self) -> None:
+        self._finish()
+        super().close()
+
+    def __del__(self) -> None:
+        self._finish()
+
+
+class ProfilingConnection(sqlite3.Connection):
+    # Connection.execute() builds a plain cursor internally, so route it through ours.
+    def cursor(self, factory: type[sqlite3.Cursor] = ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Any = ()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Any):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory() -> type[sqlite3.Connection]:
+    return ProfilingConnection if SQL_PROFILING else sqlite3.Connection
@@ -0,0 +1,251 @@
+"""
+Versioned schema migrations and online backfills.
+
+schema_version has a row per migration applied to a database. init_db() compares the
+newest with the last migration defined in db.py and applies only the missing ones, so
+starting against an up-to-date database costs one query. Migrations are statements that
+complete in moments (new tables, columns, triggers), applied in order; each must be safe
+to run again, as one interrupted before its row was written will be.
+
+Work over every existing row (building an index, filling a derived column, indexing text
+for search, recomputing rollups) is a Backfill instead. A migration names the backfills it
+needs and they are recorded in schema_backfills; unless there turns out to be nothing to
+do, BackfillRunner carries them out in the background, a batch of about
+BACKFILL_BATCH_ROWS rows per write transaction with the cursor saved in the same
+transaction. The API keeps serving meanwhile, other writers get the database between
+batches, and a restart resumes where the last committed batch left off. Readers of what a
+backfill fills in check pending() and compute it themselves until it is done.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+import logging
+import os
+import sqlite3
+import threading
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_ROWS = int(os.environ.get("CHAT_ARCHIVE_BACKFILL_BATCH_ROWS", "2000"))
+# Pause between batches, so imports and deletes waiting on the writer go first.
+BACKFILL_PAUSE_SECONDS = float(os.environ.get("CHAT_ARCHIVE_BACKFILL_PAUSE_MS", "20")) / 1000
+# A failed batch is retried after 1 s, doubling up to this.
+BACKFILL_RETRY_MAX_SECONDS = 300
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[sqlite3.Connection], None]
+    # Backfills to start, or start over, once it is applied.
+    backfills: tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class Backfill:
+    """Work over the rows already stored, done a batch at a time.
+
+    start() prepares it and returns the bound its cursor runs up to, typically the
+    largest id it has to cover (rows written later are taken care of as they are
+    written), or 0 when there is nothing to do. step(conn, cursor, bound) does the next
+    batch and returns the new cursor; the backfill is done when it reaches the bound.
+    finish() runs in the transaction that completes it.
+    """
+
+    name: str
+    start: Callable[[sqlite3.Connection], int]
+    step: Callable[[sqlite3.Connection, int, int], int]
+    finish: Callable[[sqlite3.Connection], None] | None = None
+
+
+def _init_tables(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_backfills (
+            name TEXT PRIMARY KEY,
+            cursor INTEGER NOT NULL,
+            bound INTEGER NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT
+        );
+        """
+    )
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    """The newest migration applied to the database, 0 for one created before migrations."""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_version'").fetchone():
+        return 0
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection, migrations: list[Migration], backfills: dict[str, Backfill]) -> int:
+    """Apply the migrations the database hasn't had; returns how many."""
+    current = schema_version(conn)
+    latest = migrations[-1].version
+    if current > latest:
+        raise RuntimeError(f"The database is at schema version {current}, newer than this code's {latest}")
+    if current == latest:
+        return 0
+
+    _init_tables(conn)
+    pending = [migration for migration in migrations if migration.version > current]
+    for migration in pending:
+        migration.apply(conn)
+        for name in migration.backfills:
+            schedule(conn, backfills[name])
+        conn.execute(
+            "INSERT OR REPLACE INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+            (migration.version, migration.name, datetime.utcnow().isoformat()),
+        )
+        conn.commit()
+        logger.info("Applied schema migration %d (%s)", migration.version, migration.name)
+    return len(pending)
+
+
+def schedule(conn: sqlite3.Connection, backfill: Backfill) -> None:
+    """Start the backfill, or start it over; finish it at once if there is nothing to do."""
+    bound = backfill.start(conn)
+    now = datetime.utcnow().isoformat()
+    finished_at = None
+    if bound <= 0:
+        if backfill.finish:
+            backfill.finish(conn)
+        finished_at = now
+    conn.execute(
+        """
+        INSERT INTO schema_backfills (name, cursor, bound, started_at, finished_at) VALUES (?, 0, ?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET
+            cursor = 0, bound = excluded.bound, started_at = excluded.started_at, finished_at = excluded.finished_at
+        """,
+        (backfill.name, max(bound, 0), now, finished_at),
+    )
+
+
+def complete(conn: sqlite3.Connection, name: str) -> None:
+    """Mark a backfill done without running the rest of it, for when its work was done otherwise."""
+    conn.execute(
+        "UPDATE schema_backfills SET cursor = bound, finished_at = ? WHERE name = ? AND finished_at IS NULL",
+        (datetime.utcnow().isoformat(), name),
+    )
+
+
+def run_batch(conn: sqlite3.Connection, backfills: dict[str, Backfill]) -> bool:
+    """Run the next batch of the first unfinished backfill, in backfills' order.
+
+    Returns False when none is left. The caller commits.
+    """
+    rows = {
+        row[0]: (row[1], row[2])
+        for row in conn.execute("SELECT name, cursor, bound FROM schema_backfills WHERE finished_at IS NULL")
+    }
+    name = next((name for name in backfills if name in rows), None)
+    if name is None:
+        return False
+
+    backfill = backfills[name]
+    cursor, bound = rows[name]
+    cursor = backfill.step(conn, cursor, bound)
+    finished_at = None
+    if cursor >= bound:
+        if backfill.finish:
+            backfill.finish(conn)
+        finished_at = datetime.utcnow().isoformat()
+        logger.info("Finished backfill %s", name)
+    conn.execute(
+        "UPDATE schema_backfills SET cursor = ?, finished_at = ? WHERE name = ?", (cursor, finished_at, name)
+    )
+    return True
+
+
+def pending(conn: sqlite3.Connection, name: str) -> bool:
+    """Whether the backfill has been started and not finished yet."""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_backfills'").fetchone():
+        return False
+    return (
+        conn.execute("SELECT 1 FROM schema_backfills WHERE name = ? AND finished_at IS NULL", (name,)).fetchone()
+        is not None
+    )
+
+
+def batch_end(conn: sqlite3.Connection, table: str, cursor: int, bound: int) -> int:
+    """The id ending the next batch of table's rows after cursor, at most bound.
+
+    Found by the ids actually stored rather than by adding to cursor, since shards
+    number their rows from far above 0.
+    """
+    row = conn.execute(
+        f"SELECT id FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT 1 OFFSET ?",
+        (cursor, bound, BACKFILL_BATCH_ROWS - 1),
+    ).fetchone()
+    return row[0] if row else bound
+
+
+def backfill_status(conn: sqlite3.Connection) -> list[dict]:
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_backfills'").fetchone():
+        return []
+    return [
+        dict(zip(("name", "cursor", "bound", "started_at", "finished_at"), row))
+        for row in conn.execute(
+            "SELECT name, cursor, bound, started_at, finished_at FROM schema_backfills ORDER BY started_at, name"
+        )
+    ]
+
+
+class BackfillRunner:
+    """Runs backfills on a background thread until none is left.
+
+    step() runs one batch wherever one is pending and returns how long to wait before
+    the next, or None once all are done.
+    """
+
+    def __init__(self, step: Callable[[], float | None]) -> None:
+        self._step = step
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="schema-backfill", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                wait = self._step()
+                failures = 0
+            except Exception:
+                # The failed batch was rolled back along with its cursor, so retrying
+                # picks it up again.
+                failures += 1
+                wait = min(2 ** (failures - 1), BACKFILL_RETRY_MAX_SECONDS)
+                logger.exception("Schema backfill failed; retrying in %d s", wait)
+            if wait is None:
+                return
+            self._stop.wait(wait)
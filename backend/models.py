@@ -6,6 +6,13 @@ class ConversationSummary(BaseModel):
     title: str
     source: str
     created_at: str
+    created_at_ms: int
+    message_count: int
+
+
+class ConversationPage(BaseModel):
+    items: list[ConversationSummary]
+    next_after: str | None
 
 
 class Message(BaseModel):
@@ -14,6 +21,7 @@ class Message(BaseModel):
     role: str
     content: str
     timestamp: str
+    timestamp_ms: int
 
 
 class ConversationDetail(BaseModel):
@@ -22,16 +30,66 @@ class ConversationDetail(BaseModel):
     source: str
     created_at: str
     updated_at: str
+    # Stored ZIP export the conversation was imported from; see /api/archives.
+    archive_sha256: str | None
+    message_count: int
     messages: list[Message]
 
 
+class MessageWindow(BaseModel):
+    items: list[Message]
+    has_before: bool
+    has_after: bool
+
+
 class SearchResult(BaseModel):
     conversation_id: int
+    conversation_title: str
     message_id: int
+    role: str
     snippet: str
+    # [start, end) code point offsets of the matched terms within snippet.
+    highlights: list[tuple[int, int]]
     timestamp: str
 
 
+class SearchPage(BaseModel):
+    items: list[SearchResult]
+    next_after: str | None
+
+
+class TimelineDay(BaseModel):
+    # UTC date, YYYY-MM-DD.
+    day: str
+    count: int
+
+
+class SourceStats(BaseModel):
+    source: str
+    conversations: int
+    messages: int
+    attachments: int
+    # Sum of the attachments' file sizes; files shared between attachments count each time.
+    attachment_bytes: int
+
+
+class RoleStats(BaseModel):
+    role: str
+    messages: int
+
+
+class ArchiveStats(BaseModel):
+    conversations: int
+    messages: int
+    attachments: int
+    attachment_bytes: int
+    # UTC dates (YYYY-MM-DD) of the earliest and latest message.
+    first_day: str | None
+    last_day: str | None
+    sources: list[SourceStats]
+    roles: list[RoleStats]
+
+
 class Attachment(BaseModel):
     id: int
     conversation_id: int
@@ -41,3 +99,26 @@ class Attachment(BaseModel):
     mime_type: str | None
     local_path: str
     created_at: str
+
+
+class ArchiveMember(BaseModel):
+    name: str
+    size: int
+    mime_type: str | None
+
+
+class IngestJob(BaseModel):
+    id: str
+    files: list[str]
+    status: str
+    conversations: int
+    updated: int
+    unchanged: int
+    messages: int
+    bytes_read: int
+    total_bytes: int
+    errors: list[str]
+    defer_indexes: bool
+    semantic_indexed: bool
+    created_at: str
+    finished_at: str | None
@@ -2,17 +2,26 @@
 Assumptions:
 - Simple JSON uploads are either {"title": ..., "messages": [...]} or a top-level list of messages.
 - ChatGPT ZIP uploads include a conversations.json file following the mapping/current_node graph format.
-Assumption: uploaded JSON is either:
-1) {"title": "Optional Title", "messages": [{"role": "user", "content": "...", "timestamp": "..."}]}
-or 2) [{"role": "user", "content": "...", "timestamp": "..."}] as a top-level list.
+- conversations.json is read incrementally, one top-level conversation at a time, so memory use
+  follows the largest single conversation rather than the whole export.
+- With several parse workers, conversations.json is cut into blocks that worker processes
+  decode and walk; conversations still come out in file order.
 """
 
 from __future__ import annotations
 
+import codecs
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from io import BytesIO
 import json
-from typing import Any
+import math
+import multiprocessing
+import re
+from typing import Any, BinaryIO, Iterator
 
 
 VALID_ROLES = {"user", "assistant", "system"}
@@ -24,9 +33,6 @@ class ParsedAttachmentRef:
     file_id: str | None
     file_name: str | None
     mime_type: str | None
-from dataclasses import dataclass
-from datetime import datetime
-import json
 
 
 @dataclass
@@ -35,6 +41,7 @@ class ParsedMessage:
     content: str
     timestamp: str
     external_id: str | None = None
+    timestamp_ms: int | None = None
 
 
 @dataclass
@@ -44,16 +51,68 @@ class ParsedConversation:
     updated_at: str
     messages: list[ParsedMessage]
     attachment_refs: list[ParsedAttachmentRef] = field(default_factory=list)
+    external_id: str | None = None
+    created_at_ms: int | None = None
+    updated_at_ms: int | None = None
+
+
+_EPOCH = datetime(1970, 1, 1)
+_MILLISECOND = timedelta(milliseconds=1)
+# Numbers above this are already milliseconds; as seconds they would be past the year 5000.
+_EPOCH_MS_THRESHOLD = 1e11
 
 
+def epoch_ms(value: Any) -> int | None:
+    """Milliseconds since the Unix epoch for an export timestamp, or None if it is not recognized.
 
-def _iso_or_now(value: Any) -> str:
+    Accepts epoch seconds or milliseconds (numbers or numeric strings), ISO 8601 and RFC 2822
+    dates. Values without a UTC offset are taken as UTC.
+    """
+    if isinstance(value, bool):
+        return None
     if isinstance(value, (int, float)):
-        return datetime.utcfromtimestamp(value).isoformat()
+        if not math.isfinite(value):
+            return None
+        return round(value if abs(value) >= _EPOCH_MS_THRESHOLD else value * 1000)
+    if not isinstance(value, str):
+        return None
+
+    text = value.strip()
+    if not text:
+        return None
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        try:
+            return epoch_ms(float(text))
+        except ValueError:
+            pass
+        try:
+            parsed = parsedate_to_datetime(text)
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    if parsed.tzinfo is not None:
+        # Naive arithmetic; converting through timezone objects is several times slower.
+        parsed = parsed.replace(tzinfo=None) - parsed.utcoffset()
+    return (parsed - _EPOCH) // _MILLISECOND
+
+
+def _now() -> tuple[str, int]:
+    now = datetime.utcnow()
+    return now.isoformat(), (now - _EPOCH) // _MILLISECOND
+
+
+def _timestamp(value: Any) -> tuple[str, int]:
+    """The stored text and epoch milliseconds for a raw timestamp; missing values become now."""
+    milliseconds = epoch_ms(value)
+    if isinstance(value, (int, float)) and milliseconds is not None:
+        seconds = value if abs(value) < _EPOCH_MS_THRESHOLD else value / 1000
+        return datetime.utcfromtimestamp(seconds).isoformat(), milliseconds
     if isinstance(value, str) and value.strip():
-        return value
-    return datetime.utcnow().isoformat()
-    messages: list[ParsedMessage]
+        # Keep what the export said; text nothing can read sorts as of the import.
+        return value, milliseconds if milliseconds is not None else _now()[1]
+    return _now()
 
 
 def parse_chat_export(raw_bytes: bytes, fallback_title: str) -> ParsedConversation:
@@ -74,15 +133,24 @@ def parse_chat_export(raw_bytes: bytes, fallback_title: str) -> ParsedConversati
             continue
         role = str(item.get("role", "unknown"))
         content = str(item.get("content", "")).strip()
-        timestamp = str(item.get("timestamp") or datetime.utcnow().isoformat())
+        timestamp, timestamp_ms = _timestamp(str(item.get("timestamp") or ""))
         if content:
-            normalized.append(ParsedMessage(role=role, content=content, timestamp=timestamp))
+            normalized.append(
+                ParsedMessage(role=role, content=content, timestamp=timestamp, timestamp_ms=timestamp_ms)
+            )
 
     if not normalized:
         raise ValueError("No valid messages found")
 
-    now = datetime.utcnow().isoformat()
-    return ParsedConversation(title=title, created_at=now, updated_at=now, messages=normalized)
+    now, now_ms = _now()
+    return ParsedConversation(
+        title=title,
+        created_at=now,
+        updated_at=now,
+        messages=normalized,
+        created_at_ms=now_ms,
+        updated_at_ms=now_ms,
+    )
 
 
 def _extract_text_content(content: dict[str, Any]) -> str:
@@ -129,84 +197,318 @@ def _extract_attachment_refs(message: dict[str, Any], node_id: str) -> list[Pars
     return refs
 
 
-def parse_chatgpt_conversations(raw_bytes: bytes) -> list[ParsedConversation]:
-    payload = json.loads(raw_bytes.decode("utf-8"))
-    if not isinstance(payload, list):
-        raise ValueError("conversations.json must contain a list")
-
-    parsed_conversations: list[ParsedConversation] = []
-
-    for conversation in payload:
-        if not isinstance(conversation, dict):
-            continue
+def _parse_chatgpt_conversation(conversation: Any) -> ParsedConversation | None:
+    if not isinstance(conversation, dict):
+        return None
 
-        mapping = conversation.get("mapping")
-        current_node = conversation.get("current_node")
-        if not isinstance(mapping, dict) or not isinstance(current_node, str):
-            continue
+    mapping = conversation.get("mapping")
+    current_node = conversation.get("current_node")
+    if not isinstance(mapping, dict) or not isinstance(current_node, str):
+        return None
 
-        ordered_node_ids: list[str] = []
-        cursor: str | None = current_node
-        seen: set[str] = set()
-        while cursor and cursor not in seen:
-            seen.add(cursor)
-            ordered_node_ids.append(cursor)
-            node = mapping.get(cursor)
-            if not isinstance(node, dict):
-                break
-            parent = node.get("parent")
-            cursor = parent if isinstance(parent, str) else None
-
-        ordered_node_ids.reverse()
-
-        messages: list[ParsedMessage] = []
-        refs: list[ParsedAttachmentRef] = []
-
-        for node_id in ordered_node_ids:
-            node = mapping.get(node_id)
-            if not isinstance(node, dict):
-                continue
+    ordered_node_ids: list[str] = []
+    cursor: str | None = current_node
+    seen: set[str] = set()
+    while cursor and cursor not in seen:
+        seen.add(cursor)
+        ordered_node_ids.append(cursor)
+        node = mapping.get(cursor)
+        if not isinstance(node, dict):
+            break
+        parent = node.get("parent")
+        cursor = parent if isinstance(parent, str) else None
 
-            message = node.get("message")
-            if not isinstance(message, dict):
-                continue
+    ordered_node_ids.reverse()
 
-            author = message.get("author")
-            role = author.get("role") if isinstance(author, dict) else None
-            if role not in VALID_ROLES:
-                continue
+    messages: list[ParsedMessage] = []
+    refs: list[ParsedAttachmentRef] = []
 
-            content = message.get("content")
-            if not isinstance(content, dict):
-                continue
+    for node_id in ordered_node_ids:
+        node = mapping.get(node_id)
+        if not isinstance(node, dict):
+            continue
 
-            text_content = _extract_text_content(content)
-            if not text_content:
-                continue
+        message = node.get("message")
+        if not isinstance(message, dict):
+            continue
 
-            messages.append(
-                ParsedMessage(
-                    role=role,
-                    content=text_content,
-                    timestamp=_iso_or_now(message.get("create_time") or conversation.get("create_time")),
-                    external_id=node_id,
-                )
-            )
+        author = message.get("author")
+        role = author.get("role") if isinstance(author, dict) else None
+        if role not in VALID_ROLES:
+            continue
 
-            refs.extend(_extract_attachment_refs(message, node_id))
+        content = message.get("content")
+        if not isinstance(content, dict):
+            continue
 
-        if not messages:
+        text_content = _extract_text_content(content)
+        if not text_content:
             continue
 
-        parsed_conversations.append(
-            ParsedConversation(
-                title=str(conversation.get("title") or "Untitled conversation"),
-                created_at=_iso_or_now(conversation.get("create_time")),
-                updated_at=_iso_or_now(conversation.get("update_time") or conversation.get("create_time")),
-                messages=messages,
-                attachment_refs=refs,
+        timestamp, timestamp_ms = _timestamp(message.get("create_time") or conversation.get("create_time"))
+        messages.append(
+            ParsedMessage(
+                role=role,
+                content=text_content,
+                timestamp=timestamp,
+                external_id=node_id,
+                timestamp_ms=timestamp_ms,
             )
         )
 
-    return parsed_conversations
-    return ParsedConversation(title=title, messages=normalized)
+        refs.extend(_extract_attachment_refs(message, node_id))
+
+    if not messages:
+        return None
+
+    created_at, created_at_ms = _timestamp(conversation.get("create_time"))
+    updated_at, updated_at_ms = _timestamp(conversation.get("update_time") or conversation.get("create_time"))
+    return ParsedConversation(
+        title=str(conversation.get("title") or "Untitled conversation"),
+        created_at=created_at,
+        updated_at=updated_at,
+        messages=messages,
+        attachment_refs=refs,
+        external_id=str(conversation.get("id") or conversation.get("conversation_id") or "") or None,
+        created_at_ms=created_at_ms,
+        updated_at_ms=updated_at_ms,
+    )
+
+
+JSON_READ_SIZE = 1024 * 1024
+_JSON_WHITESPACE = " \t\n\r\ufeff"
+
+
+class _JSONArrayReader:
+    """Decodes the elements of a top-level JSON array from a byte stream one at a time."""
+
+    def __init__(self, stream: BinaryIO, read_size: int = JSON_READ_SIZE) -> None:
+        self._stream = stream
+        self._read_size = read_size
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        # Grow reads with the pending element so one huge conversation is decoded a
+        # logarithmic number of times rather than once per chunk.
+        pending = len(self._buffer) - self._pos
+        chunk = self._stream.read(max(self._read_size, pending))
+        text = self._utf8.decode(chunk, final=not chunk)
+        self._eof = not chunk
+        self._buffer = self._buffer[self._pos :] + text
+        self._pos = 0
+        return True
+
+    def _next_char(self) -> str:
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _JSON_WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def _decode_value(self) -> Any:
+        self._next_char()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A value touching the end of the buffer (e.g. a number) may continue in the next chunk.
+            if end == len(self._buffer) and not self._eof:
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self) -> Iterator[Any]:
+        if self._next_char() != "[":
+            raise ValueError("conversations.json must contain a list")
+        self._pos += 1
+
+        if self._next_char() == "]":
+            return
+
+        while True:
+            yield self._decode_value()
+
+            separator = self._next_char()
+            self._pos += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError("conversations.json is not a valid JSON list")
+
+
+# Bytes of conversations.json per parallel parse task. Blocks are cut just after a comma,
+# which is ASCII, so each one is valid UTF-8 on its own.
+PARALLEL_BLOCK_SIZE = 8 * 1024 * 1024
+# A conversation in a block starts at an object after a comma. `{"` never occurs inside a
+# JSON string (the quote would be escaped), but it does open nested objects too.
+_ELEMENT_START_RE = re.compile(r'(?:\A|,)\s*(\{")')
+_DECODER = json.JSONDecoder()
+
+
+def _skip_whitespace(text: str, pos: int) -> int:
+    while pos < len(text) and text[pos] in _JSON_WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _array_elements(text: str, pos: int, after_value: bool) -> tuple[list[Any], int, bool | None]:
+    """Decode the whole elements of a JSON array found in text[pos:], a piece of its body.
+
+    Returns the values, where decoding stopped (the start of an element cut off by the end
+    of the text, or len(text)) and whether that point follows a value; None once the
+    closing bracket has been read.
+    """
+    values: list[Any] = []
+    while True:
+        pos = _skip_whitespace(text, pos)
+        if pos == len(text):
+            return values, pos, after_value
+        if text[pos] == "]":
+            return values, pos + 1, None
+        if after_value:
+            if text[pos] != ",":
+                raise ValueError("conversations.json is not a valid JSON list")
+            pos = _skip_whitespace(text, pos + 1)
+            if pos == len(text):
+                return values, pos, False
+
+        try:
+            value, end = _DECODER.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            return values, pos, False
+        # Cut off, or complete but the separator after it is in the next piece.
+        if end == len(text):
+            return values, pos, False
+        values.append(value)
+        pos, after_value = end, True
+
+
+def _guess_element_start(text: str) -> int:
+    for match in _ELEMENT_START_RE.finditer(text):
+        start = match.start(1)
+        try:
+            value, _ = _DECODER.raw_decode(text, start)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(value, dict) and "mapping" in value:
+            return start
+    return len(text)
+
+
+def _parse_block(block: bytes, first: bool) -> tuple[str, list[ParsedConversation] | None, str, bool | None]:
+    """Parse the conversations that start in one block of conversations.json.
+
+    Runs in a worker process. Where the first conversation starts is a guess unless this
+    is the first block; the text before it and the text after the last whole element are
+    returned for the caller, which checks the guess while joining blocks. Conversations
+    are None when no start was found.
+    """
+    text = block.decode("utf-8")
+    start = 0 if first else _guess_element_start(text)
+    if start == len(text):
+        return text, None, "", False
+
+    values, stop, after_value = _array_elements(text, start, after_value=False)
+    conversations = [parsed for value in values if (parsed := _parse_chatgpt_conversation(value)) is not None]
+    return text[:start], conversations, text[stop:], after_value
+
+
+def _read_blocks(stream: BinaryIO, block_size: int) -> Iterator[bytes]:
+    """The body of the top-level array in blocks that end just after a comma."""
+    pending = stream.read(block_size)
+    pending = pending.lstrip().removeprefix(codecs.BOM_UTF8).lstrip()
+    if not pending.startswith(b"["):
+        raise ValueError("conversations.json must contain a list")
+    pending = pending[1:]
+
+    while True:
+        chunk = stream.read(block_size)
+        if not chunk:
+            if pending:
+                yield pending
+            return
+        pending += chunk
+        cut = pending.rfind(b",") + 1
+        if cut:
+            yield pending[:cut]
+            pending = pending[cut:]
+
+
+def _iter_parallel(stream: BinaryIO, workers: int) -> Iterator[ParsedConversation]:
+    def parse(values: list[Any]) -> Iterator[ParsedConversation]:
+        for value in values:
+            parsed = _parse_chatgpt_conversation(value)
+            if parsed is not None:
+                yield parsed
+
+    # Text not parsed yet: an element that spans blocks, or a block whose guessed start
+    # turned out to be inside a conversation.
+    carry = ""
+    after_value: bool | None = False
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        in_flight: deque[tuple[bytes, Future]] = deque()
+
+        def joined() -> Iterator[ParsedConversation]:
+            nonlocal carry, after_value
+            block, future = in_flight.popleft()
+            prefix, conversations, suffix, block_after = future.result()
+            if after_value is None:
+                if (carry + prefix + suffix).strip() or conversations:
+                    raise ValueError("conversations.json is not a valid JSON list")
+                return
+
+            pending = carry + prefix
+            values, stop, after_value = _array_elements(pending, 0, after_value)
+            yield from parse(values)
+            if after_value is None:
+                carry = pending[stop:]
+                return
+            if conversations is not None and stop == len(pending) and after_value is False:
+                yield from conversations
+                carry, after_value = suffix, block_after
+                return
+            if conversations is not None:
+                # The guess was a nested object: read the rest of the block here instead.
+                pending = pending[stop:] + block.decode("utf-8")[len(prefix) :]
+                values, stop, after_value = _array_elements(pending, 0, after_value)
+                yield from parse(values)
+            carry = pending[stop:]
+
+        for index, block in enumerate(_read_blocks(stream, PARALLEL_BLOCK_SIZE)):
+            in_flight.append((block, pool.submit(_parse_block, block, index == 0)))
+            # Two blocks per worker keeps them busy without reading far ahead.
+            if len(in_flight) >= workers * 2:
+                yield from joined()
+        while in_flight:
+            yield from joined()
+
+    if after_value is not None:
+        raise ValueError("conversations.json ends before its list does")
+
+
+def iter_chatgpt_conversations(stream: BinaryIO, workers: int = 1) -> Iterator[ParsedConversation]:
+    """Conversations in file order; with several workers, parsed in a process pool."""
+    if workers > 1:
+        yield from _iter_parallel(stream, workers)
+        return
+    for conversation in _JSONArrayReader(stream):
+        parsed = _parse_chatgpt_conversation(conversation)
+        if parsed is not None:
+            yield parsed
+
+
+def parse_chatgpt_conversations(raw_bytes: bytes) -> list[ParsedConversation]:
+    return list(iter_chatgpt_conversations(BytesIO(raw_bytes)))
@@ -0,0 +1,95 @@
+"""
+Translates free-text search input into an FTS5 MATCH expression.
+
+- Bare words are ANDed together: `sqlite index` matches messages containing both.
+- Double-quoted text is a phrase: `"connection pool"`.
+- A trailing `*` makes a prefix query: `pars*` matches parse, parser, parsing.
+Everything else is quoted so FTS5 operators and punctuation in user input can't
+produce a syntax error.
+"""
+
+from __future__ import annotations
+
+import re
+
+
+_TOKEN_RE = re.compile(r'"([^"]*)"?|(\S+)')
+_WORD_RE = re.compile(r"\w+")
+
+
+def _quote(words: list[str]) -> str:
+    return '"' + " ".join(words) + '"'
+
+
+def build_fts_query(text: str) -> str | None:
+    terms: list[str] = []
+
+    for phrase, token in _TOKEN_RE.findall(text):
+        source = phrase if phrase else token
+        words = _WORD_RE.findall(source)
+        if not words:
+            continue
+
+        term = _quote(words)
+        if not phrase and token.endswith("*"):
+            term += "*"
+        terms.append(term)
+
+    return " ".join(terms) or None
+
+
+# snippet() wraps matches in these control characters, which chat text doesn't use;
+# split_highlights() turns them into offsets.
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+SNIPPET_TOKENS = 24
+SNIPPET_MAX_CHARS = 320
+ELLIPSIS = "…"
+_MARKER_RE = re.compile(f"([{HIGHLIGHT_START}{HIGHLIGHT_END}])")
+
+
+def mark_terms(text: str, terms: set[str]) -> str:
+    """Wrap whole words whose lowercase form is in terms in highlight markers, for split_highlights()."""
+    return _WORD_RE.sub(
+        lambda match: f"{HIGHLIGHT_START}{match[0]}{HIGHLIGHT_END}" if match[0].lower() in terms else match[0],
+        text,
+    )
+
+
+def split_highlights(marked: str, max_chars: int = SNIPPET_MAX_CHARS) -> tuple[str, list[tuple[int, int]]]:
+    """Strip highlight markers, returning the text and [start, end) code point offsets of each match.
+
+    FTS5 bounds snippets by token count, so very long tokens are also cut down to
+    max_chars around the first match.
+    """
+    parts: list[str] = []
+    highlights: list[tuple[int, int]] = []
+    length = 0
+    start: int | None = None
+
+    for part in _MARKER_RE.split(marked):
+        if part == HIGHLIGHT_START:
+            start = length
+        elif part == HIGHLIGHT_END:
+            if start is not None:
+                highlights.append((start, length))
+            start = None
+        else:
+            parts.append(part)
+            length += len(part)
+
+    text = "".join(parts)
+    if len(text) <= max_chars:
+        return text, highlights
+
+    window_start = max(0, min(highlights[0][0] - max_chars // 3 if highlights else 0, len(text) - max_chars))
+    window_end = window_start + max_chars
+    prefix = ELLIPSIS if window_start > 0 else ""
+    suffix = ELLIPSIS if window_end < len(text) else ""
+    shift = len(prefix) - window_start
+    clipped = [
+        (max(begin, window_start) + shift, min(end, window_end) + shift)
+        for begin, end in highlights
+        if begin < window_end and end > window_start
+    ]
+    return prefix + text[window_start:window_end] + suffix, clipped
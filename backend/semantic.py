@@ -0,0 +1,355 @@
+"""
+Offline semantic search over messages.
+
+Messages are embedded with latent semantic analysis: words are hashed into FEATURES
+buckets, weighted by TF-IDF and projected onto the top DIMENSIONS directions of a
+randomized SVD computed from a sample of the archive. Nothing is downloaded; NumPy is the
+only dependency.
+
+The index lives next to the database in <db name>-semantic/. Each build is a directory
+holding the model (IDF weights and projection) plus append-only files of message ids
+(int64) and unit-length vectors (float16) in id order; CURRENT names the live build.
+New messages are embedded with the existing model and appended; rebuild() refits the
+model and swaps in a new build, which also drops vectors of deleted messages.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from itertools import chain
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import sqlite3
+import threading
+import uuid
+import zlib
+
+import numpy as np
+
+import db
+
+FEATURES = 1 << 15
+DIMENSIONS = 128
+# Messages sampled to fit the model, and extra random directions for the randomized SVD.
+FIT_SAMPLE = 10_000
+OVERSAMPLE = 16
+POWER_ITERATIONS = 1
+SEED = 1234
+# Messages read and embedded per query while indexing.
+EMBED_BATCH = 2_000
+# Stored vectors scored per matrix product while searching.
+QUERY_CHUNK = 65_536
+# Nonzero entries expanded at once in sparse products; bounds their temporary memory.
+SPARSE_CHUNK = 200_000
+BUCKET_CACHE_SIZE = 1_000_000
+# Set CHAT_ARCHIVE_SEMANTIC_INDEX=0 to skip embedding new messages after each import.
+AUTO_UPDATE = os.environ.get("CHAT_ARCHIVE_SEMANTIC_INDEX", "1") != "0"
+
+_WORD_RE = re.compile(r"\w\w+")
+_bucket_cache: dict[str, int] = {}
+
+
+def tokenize(text: str) -> list[str]:
+    return _WORD_RE.findall(text.lower())
+
+
+def _buckets(tokens: list[str]) -> np.ndarray:
+    # crc32 rather than hash(): bucket numbers must be stable across processes. Each
+    # distinct token is hashed once and cached, so the common case is a dict lookup.
+    missing = set(tokens).difference(_bucket_cache)
+    if len(_bucket_cache) + len(missing) > BUCKET_CACHE_SIZE:
+        _bucket_cache.clear()
+        missing = set(tokens)
+    for token in missing:
+        _bucket_cache[token] = zlib.crc32(token.encode()) & (FEATURES - 1)
+    return np.fromiter(map(_bucket_cache.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+
+
+@dataclass
+class TermMatrix:
+    """Sparse rows of hashed term weights in CSR layout."""
+
+    indptr: np.ndarray
+    columns: np.ndarray
+    values: np.ndarray
+
+    @classmethod
+    def from_texts(cls, texts: list[str]) -> TermMatrix:
+        tokens = [tokenize(text) for text in texts]
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        buckets = _buckets(list(chain.from_iterable(tokens)))
+        # One sort for the whole batch: (row, bucket) pairs packed into a single key.
+        keys, counts = np.unique(np.repeat(np.arange(len(texts)), lengths) * FEATURES + buckets, return_counts=True)
+        indptr = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // FEATURES, minlength=len(texts)), out=indptr[1:])
+        # Sublinear term frequency, so one repeated word doesn't dominate a message.
+        return cls(indptr, (keys % FEATURES).astype(np.int32), (1 + np.log(counts)).astype(np.float32))
+
+    @property
+    def rows(self) -> int:
+        return len(self.indptr) - 1
+
+    def row_index(self) -> np.ndarray:
+        return np.repeat(np.arange(self.rows), np.diff(self.indptr))
+
+    def weight(self, idf: np.ndarray) -> None:
+        """Apply IDF weights and scale every row to unit length, in place."""
+        rows = self.row_index()
+        self.values *= idf[self.columns]
+        norms = np.sqrt(np.bincount(rows, weights=self.values**2, minlength=self.rows))
+        self.values /= norms[rows].astype(np.float32)
+
+    def dot(self, matrix: np.ndarray) -> np.ndarray:
+        """self @ matrix, for a dense (FEATURES, k) matrix."""
+        out = np.zeros((self.rows, matrix.shape[1]), dtype=np.float32)
+        _segment_sum(self.row_index(), self.columns, self.values, matrix, out)
+        return out
+
+    def transpose_dot(self, matrix: np.ndarray) -> np.ndarray:
+        """self.T @ matrix, for a dense (rows, k) matrix."""
+        order = np.argsort(self.columns, kind="stable")
+        out = np.zeros((FEATURES, matrix.shape[1]), dtype=np.float32)
+        _segment_sum(self.columns[order], self.row_index()[order], self.values[order], matrix, out)
+        return out
+
+
+def _segment_sum(
+    keys: np.ndarray, rows: np.ndarray, weights: np.ndarray, matrix: np.ndarray, out: np.ndarray
+) -> None:
+    # out[keys[i]] += weights[i] * matrix[rows[i]], with keys sorted so equal keys are
+    # adjacent and can be summed with reduceat instead of the much slower np.add.at.
+    for start in range(0, len(keys), SPARSE_CHUNK):
+        chunk = keys[start : start + SPARSE_CHUNK]
+        if not len(chunk):
+            continue
+        contributions = matrix[rows[start : start + SPARSE_CHUNK]]
+        contributions *= weights[start : start + SPARSE_CHUNK, None]
+        boundaries = np.flatnonzero(np.r_[True, chunk[1:] != chunk[:-1]])
+        out[chunk[boundaries]] += np.add.reduceat(contributions, boundaries, axis=0)
+
+
+@dataclass
+class Model:
+    idf: np.ndarray
+    projection: np.ndarray
+
+    @property
+    def dimensions(self) -> int:
+        return self.projection.shape[1]
+
+    @classmethod
+    def fit(cls, texts: list[str]) -> Model:
+        terms = TermMatrix.from_texts(texts)
+        document_frequency = np.bincount(terms.columns, minlength=FEATURES)
+        idf = (np.log((1 + terms.rows) / (1 + document_frequency)) + 1).astype(np.float32)
+        terms.weight(idf)
+
+        # Randomized SVD (Halko, Martinsson & Tropp): find an orthonormal basis for the
+        # range of the term matrix, then take the exact SVD of its small projection.
+        rank = min(DIMENSIONS + OVERSAMPLE, terms.rows)
+        omega = np.random.default_rng(SEED).standard_normal((FEATURES, rank), dtype=np.float32)
+        basis, _ = np.linalg.qr(terms.dot(omega))
+        for _ in range(POWER_ITERATIONS):
+            basis, _ = np.linalg.qr(terms.transpose_dot(basis))
+            basis, _ = np.linalg.qr(terms.dot(basis))
+        _, _, vt = np.linalg.svd(terms.transpose_dot(basis).T, full_matrices=False)
+        return cls(idf, np.ascontiguousarray(vt[:DIMENSIONS].T, dtype=np.float32))
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """Unit-length float32 vectors, one row per text; texts without words get zeros."""
+        terms = TermMatrix.from_texts(texts)
+        terms.weight(self.idf)
+        vectors = terms.dot(self.projection)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    def save(self, path: Path) -> None:
+        np.savez(path, idf=self.idf, projection=self.projection)
+
+    @classmethod
+    def load(cls, path: Path) -> Model:
+        with np.load(path) as data:
+            return cls(data["idf"], data["projection"])
+
+
+@dataclass
+class _Build:
+    path: Path
+    model: Model
+    ids: np.ndarray
+    vectors: np.ndarray
+
+
+class SemanticIndex:
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._build: _Build | None = None
+
+    def _current_path(self) -> Path | None:
+        try:
+            name = (self.directory / "CURRENT").read_text().strip()
+        except FileNotFoundError:
+            return None
+        return self.directory / name
+
+    def _load(self) -> _Build | None:
+        """The live build, reopened if it was replaced or has grown since the last call."""
+        path = self._current_path()
+        if path is None:
+            return None
+
+        build = self._build
+        if build is None or build.path != path:
+            model = Model.load(path / "model.npz")
+        else:
+            model = build.model
+        count = _stored_count(path, model)
+        if build is not None and build.path == path and len(build.ids) == count:
+            return build
+
+        if count:
+            ids = np.memmap(path / "ids.i64", dtype=np.int64, mode="r", shape=(count,))
+            vectors = np.memmap(path / "vectors.f16", dtype=np.float16, mode="r", shape=(count, model.dimensions))
+        else:
+            ids = np.zeros(0, np.int64)
+            vectors = np.zeros((0, model.dimensions), np.float16)
+        self._build = build = _Build(path, model, ids, vectors)
+        return build
+
+    def stats(self) -> dict[str, int | bool]:
+        build = self._load()
+        return {
+            "built": build is not None,
+            "vectors": len(build.ids) if build else 0,
+            "dimensions": build.model.dimensions if build else 0,
+        }
+
+    def search(self, query: str, limit: int) -> list[tuple[int, float]] | None:
+        """(message id, cosine similarity) of the closest messages, or None if there is no index yet."""
+        build = self._load()
+        if build is None:
+            return None
+
+        vector = build.model.embed([query])[0]
+        if not vector.any():
+            return []
+
+        ids: list[np.ndarray] = []
+        scores: list[np.ndarray] = []
+        for start in range(0, len(build.ids), QUERY_CHUNK):
+            # float16 has no BLAS kernels, so each chunk is widened before the product.
+            chunk_scores = build.vectors[start : start + QUERY_CHUNK].astype(np.float32) @ vector
+            if len(chunk_scores) > limit:
+                top = np.argpartition(chunk_scores, -limit)[-limit:]
+            else:
+                top = np.arange(len(chunk_scores))
+            ids.append(np.asarray(build.ids[start : start + QUERY_CHUNK])[top])
+            scores.append(chunk_scores[top])
+        if not ids:
+            return []
+
+        all_ids = np.concatenate(ids)
+        all_scores = np.concatenate(scores)
+        best = np.argsort(-all_scores, kind="stable")[:limit]
+        return [(int(all_ids[index]), float(all_scores[index])) for index in best]
+
+    def update(self, conn: sqlite3.Connection) -> int:
+        """Embed messages added since the last update; builds the index if there is none.
+
+        Returns the number of messages embedded.
+        """
+        with self._lock:
+            build = self._load()
+            if build is None:
+                return self._rebuild(conn)
+            last_id = int(build.ids[-1]) if len(build.ids) else 0
+            return self._append(conn, build.path, build.model, last_id)
+
+    def rebuild(self, conn: sqlite3.Connection) -> int:
+        with self._lock:
+            return self._rebuild(conn)
+
+    def _rebuild(self, conn: sqlite3.Connection) -> int:
+        ids = np.array([row[0] for row in conn.execute("SELECT id FROM messages")], dtype=np.int64)
+        if not len(ids):
+            return 0
+
+        sample = np.random.default_rng(SEED).choice(ids, size=min(FIT_SAMPLE, len(ids)), replace=False)
+        texts = [
+            row[0]
+            for row in conn.execute(
+                "SELECT content_text(content) FROM messages WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(sample.tolist()),),
+            )
+        ]
+        model = Model.fit(texts)
+
+        path = self.directory / f"build-{uuid.uuid4().hex}"
+        path.mkdir(parents=True)
+        model.save(path / "model.npz")
+        (path / "ids.i64").touch()
+        (path / "vectors.f16").touch()
+        embedded = self._append(conn, path, model, 0)
+
+        previous = self._current_path()
+        current = self.directory / "CURRENT"
+        (self.directory / "CURRENT.tmp").write_text(path.name)
+        os.replace(self.directory / "CURRENT.tmp", current)
+        if previous is not None:
+            # Searches already holding the old arrays keep them until they finish.
+            shutil.rmtree(previous, ignore_errors=True)
+        return embedded
+
+    def _append(self, conn: sqlite3.Connection, path: Path, model: Model, last_id: int) -> int:
+        # A crash between the two writes of a batch leaves vectors without their ids (or,
+        # with a partial write, either file ending mid-entry). Cut both back to the entries
+        # they have in common first, or the next ids would pair with the wrong vectors.
+        count = _stored_count(path, model)
+        os.truncate(path / "ids.i64", count * 8)
+        os.truncate(path / "vectors.f16", count * 2 * model.dimensions)
+        embedded = 0
+        with (path / "ids.i64").open("ab") as ids_file, (path / "vectors.f16").open("ab") as vectors_file:
+            while True:
+                rows = conn.execute(
+                    "SELECT id, content_text(content) FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, EMBED_BATCH),
+                ).fetchall()
+                if not rows:
+                    return embedded
+
+                vectors = model.embed([row[1] for row in rows]).astype(np.float16)
+                # Vectors first: a crash in between leaves an extra vector, which is ignored
+                # and cut off by the next update, rather than an id without one.
+                vectors_file.write(vectors.tobytes())
+                vectors_file.flush()
+                ids_file.write(np.array([row[0] for row in rows], dtype=np.int64).tobytes())
+                ids_file.flush()
+                embedded += len(rows)
+                last_id = rows[-1][0]
+
+
+def _stored_count(path: Path, model: Model) -> int:
+    """Entries of the build at path that have both their id and their vector written."""
+    return min(
+        os.path.getsize(path / "ids.i64") // 8,
+        os.path.getsize(path / "vectors.f16") // (2 * model.dimensions),
+    )
+
+
+_indexes: dict[Path, SemanticIndex] = {}
+_index_lock = threading.Lock()
+
+
+def get_index(path: Path | None = None) -> SemanticIndex:
+    """The index of the database at path, by default db.DB_PATH."""
+    path = path or db.DB_PATH
+    directory = path.with_name(f"{path.stem}-semantic")
+    with _index_lock:
+        index = _indexes.get(directory)
+        if index is None:
+            index = _indexes[directory] = SemanticIndex(directory)
+        return index
@@ -0,0 +1,337 @@
+"""
+Federated archive databases ("shards").
+
+The main database (db.DB_PATH) is shard 0 and keeps the registry of the others in
+archive_shards. Each shard is a complete archive database with its own search index,
+rollups and semantic index; media files are shared through MEDIA_DIR. Shard n allocates
+row ids from n << SHARD_ID_BITS, so ids are unique across shards and an id alone says which
+shard holds the row: conversation, message and attachment ids mean the same in the API
+however many shards there are.
+
+Imports keep each conversation in the shard that already holds it, and send new ones to the
+first shard whose route pattern matches their SHARD_KEY, or else to the main database.
+Listing, search, the timeline and statistics query every shard concurrently and merge the
+results; reads of one conversation go straight to its shard.
+
+A sealed shard is read-only. It is opened with immutable=1, so SQLite takes no locks, never
+checks the file for changes and maps it whole, and its cached responses outlive imports
+elsewhere. Updates to conversations it holds are skipped; new conversations routed to it go
+to the main database.
+"""
+
+from __future__ import annotations
+
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from fnmatch import fnmatchcase
+import functools
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import sqlite3
+from typing import Any, Callable, TypeVar
+
+import db
+from db import ConnectionPool, DeferredIndexes, archive_generation
+from ingest import drop_unchanged, stored_versions
+from media import collect_garbage
+import migrations
+from migrations import BackfillRunner
+from parsers import ParsedConversation
+
+# 2**40 ids per table and shard, leaving room for 8191 shards below 2**53, the largest
+# integer JavaScript represents exactly.
+SHARD_ID_BITS = 40
+MAX_SHARDS = 1 << (53 - SHARD_ID_BITS)
+# What new conversations are routed by: "year" (the UTC year they were created) or
+# "source" (the uploaded file name).
+SHARD_KEY = os.environ.get("CHAT_ARCHIVE_SHARD_KEY", "year")
+MAIN_SHARD = "main"
+# How often schema backfills check again on a shard whose indexes a bulk load has suspended.
+BACKFILL_DEFERRED_WAIT_SECONDS = 1.0
+# Tables whose ids each shard allocates from its own block.
+ID_TABLES = ("conversations", "messages", "attachments")
+
+_NAME_RE = re.compile(r"^[a-z0-9][a-z0-9_-]{0,63}$")
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class Shard:
+    name: str
+    number: int
+    path: Path
+    # fnmatch pattern matched against the routing key, e.g. "2023" or "alice-*".
+    route: str | None = None
+    read_only: bool = False
+
+    @property
+    def first_id(self) -> int:
+        return self.number << SHARD_ID_BITS
+
+    def pool(self) -> ConnectionPool:
+        return db.get_pool(self.path, immutable=self.read_only)
+
+    @contextmanager
+    def reader(self):
+        with self.pool().reader() as conn:
+            yield conn
+
+    @contextmanager
+    def writer(self):
+        with self.pool().writer() as conn:
+            yield conn
+
+
+def route_key(source: str, parsed: ParsedConversation) -> str:
+    if SHARD_KEY == "source":
+        return source
+    return str(datetime.fromtimestamp(parsed.created_at_ms / 1000, timezone.utc).year)
+
+
+def _held_external_ids(shard: Shard, external_ids: list[str]) -> set[str]:
+    with shard.reader() as conn:
+        return set(stored_versions(conn, external_ids))
+
+
+def _blobs_in_use(shard: Shard, hashes: list[str]) -> set[str]:
+    with shard.reader() as conn:
+        return {
+            row[0]
+            for row in conn.execute(
+                "SELECT sha256 FROM media_blobs WHERE ref_count > 0 AND sha256 IN (SELECT value FROM json_each(?))",
+                (json.dumps(hashes),),
+            )
+        }
+
+
+class ShardSet:
+    """The archive's shards, main database first."""
+
+    def __init__(self, shards: list[Shard] | None = None) -> None:
+        self._shards = shards
+        self._deferred: dict[Path, DeferredIndexes] = {}
+        # Shards with no schema backfill left to run.
+        self._backfilled: set[Path] = set()
+
+    @property
+    def shards(self) -> list[Shard]:
+        # The main database alone until load() has read the registry.
+        return self._shards or [Shard(MAIN_SHARD, 0, db.DB_PATH)]
+
+    @property
+    def main(self) -> Shard:
+        return self.shards[0]
+
+    def load(self) -> None:
+        """Read the registry from the main database and bring writable shards' schemas up to date."""
+        with db.get_db() as conn:
+            rows = conn.execute(
+                "SELECT number, name, path, route, read_only FROM archive_shards ORDER BY number"
+            ).fetchall()
+        shards = [Shard(MAIN_SHARD, 0, db.DB_PATH)]
+        for number, name, path, route, read_only in rows:
+            # Relative paths are relative to the main database's directory.
+            shard = Shard(name, number, db.DB_PATH.parent / path, route, bool(read_only))
+            if not shard.read_only:
+                db.init_db(shard.path)
+            shards.append(shard)
+        self._shards = shards
+
+    def outdated(self) -> list[Shard]:
+        """Sealed shards whose schema is older than the code's; they can't be migrated while sealed."""
+        latest = db.MIGRATIONS[-1].version
+        stale = []
+        for shard in self.shards:
+            if shard.read_only:
+                with shard.reader() as conn:
+                    if migrations.schema_version(conn) < latest:
+                        stale.append(shard)
+        return stale
+
+    def get(self, name: str) -> Shard | None:
+        return next((shard for shard in self.shards if shard.name == name), None)
+
+    def for_id(self, row_id: int) -> Shard | None:
+        """The shard holding the conversation, message or attachment with this id."""
+        number = row_id >> SHARD_ID_BITS
+        return next((shard for shard in self.shards if shard.number == number), None)
+
+    def writable(self) -> list[Shard]:
+        return [shard for shard in self.shards if not shard.read_only]
+
+    def deferred_indexes(self, shard: Shard) -> DeferredIndexes:
+        if shard.number == 0:
+            return db.deferred_indexes
+        return self._deferred.setdefault(shard.path, DeferredIndexes())
+
+    def stamp(self, shard: Shard | None = None) -> tuple[str, int]:
+        """(archive id, generation) of a response read from shard, or from all of them."""
+        if shard is not None:
+            return archive_generation.current(shard.path)
+        stamps = [archive_generation.current(shard.path) for shard in self.shards]
+        if len(stamps) == 1:
+            return stamps[0]
+        # Every generation only grows, so the sum moves whenever any shard changes.
+        archive_id = hashlib.blake2b(" ".join(stamp[0] for stamp in stamps).encode(), digest_size=16).hexdigest()
+        return archive_id, sum(stamp[1] for stamp in stamps)
+
+    def fan_out(self, fn: Callable[..., T], *args: Any, shards: list[Shard] | None = None) -> list[T]:
+        """fn(shard, *args) for every shard, or the ones given, run concurrently; results in shard order."""
+        targets = self.shards if shards is None else shards
+        return db.run_parallel([functools.partial(fn, shard, *args) for shard in targets])
+
+    def route(self, source: str, parsed: ParsedConversation) -> Shard:
+        """The shard a new conversation belongs in; never a sealed one."""
+        key = route_key(source, parsed)
+        for shard in self.shards[1:]:
+            if shard.route and fnmatchcase(key, shard.route):
+                return self.main if shard.read_only else shard
+        return self.main
+
+    def partition(
+        self, source: str, conversations: list[ParsedConversation]
+    ) -> tuple[dict[Shard, list[ParsedConversation]], int]:
+        """Group conversations by the shard they are written to.
+
+        Conversations stay in whichever shard holds them, so changing routes never
+        duplicates one. Those held by a sealed shard are left out and counted in the
+        second value.
+        """
+        if len(self.shards) == 1:
+            return ({self.main: conversations} if conversations else {}), 0
+
+        held: dict[str, Shard] = {}
+        external_ids = [parsed.external_id for parsed in conversations if parsed.external_id]
+        if external_ids:
+            for shard, found in zip(self.shards, self.fan_out(_held_external_ids, external_ids)):
+                for external_id in found:
+                    held.setdefault(external_id, shard)
+
+        groups: dict[Shard, list[ParsedConversation]] = {}
+        sealed = 0
+        for parsed in conversations:
+            shard = held.get(parsed.external_id) if parsed.external_id else None
+            if shard is None:
+                shard = self.route(source, parsed)
+            elif shard.read_only:
+                sealed += 1
+                continue
+            groups.setdefault(shard, []).append(parsed)
+        return groups, sealed
+
+    def drop_unchanged(self, source: str, conversations: list[ParsedConversation]) -> list[ParsedConversation]:
+        """ingest.drop_unchanged() against the shard each conversation would be written to."""
+        groups, _ = self.partition(source, conversations)
+        kept: set[int] = set()
+        for shard, routed in groups.items():
+            with shard.reader() as conn:
+                kept.update(id(parsed) for parsed in drop_unchanged(conn, routed))
+        return [parsed for parsed in conversations if id(parsed) in kept]
+
+    def backfill_batch(self, shards: list[Shard] | None = None) -> float | None:
+        """Run one batch of a schema backfill in the first shard, of shards or all writable ones, with one pending.
+
+        Returns how long to wait before the next, or None once every shard is done. A
+        shard whose indexes are suspended for a bulk load waits until they are back.
+        """
+        waiting = False
+        for shard in self.writable() if shards is None else shards:
+            if shard.path in self._backfilled:
+                continue
+            with shard.writer() as conn:
+                if self.deferred_indexes(shard).active:
+                    waiting = True
+                    continue
+                if migrations.run_batch(conn, db.BACKFILLS):
+                    conn.commit()
+                    # Backfilled columns change what listings and the timeline return.
+                    archive_generation.bump(conn, shard.path)
+                    return migrations.BACKFILL_PAUSE_SECONDS
+            self._backfilled.add(shard.path)
+        return BACKFILL_DEFERRED_WAIT_SECONDS if waiting else None
+
+    def _blobs_used_elsewhere(self, shard: Shard, hashes: list[str]) -> set[str]:
+        others = [other for other in self.shards if other != shard]
+        return set().union(*self.fan_out(_blobs_in_use, hashes, shards=others))
+
+    def collect_media_garbage(self) -> tuple[int, int]:
+        """collect_garbage() in every writable shard, keeping files another shard references."""
+        blobs = freed = 0
+        for shard in self.writable():
+            with shard.writer() as conn:
+                removed, size = collect_garbage(conn, db.MEDIA_DIR, functools.partial(self._blobs_used_elsewhere, shard))
+            blobs += removed
+            freed += size
+        return blobs, freed
+
+
+shard_set = ShardSet()
+backfill_runner = BackfillRunner(shard_set.backfill_batch)
+
+
+def create_shard(name: str, path: Path | None = None, route: str | None = None) -> Shard:
+    """Register a shard, creating its database at path or adopting an empty one there."""
+    if name == MAIN_SHARD or not _NAME_RE.match(name):
+        raise ValueError(f"Invalid shard name {name!r}: use lowercase letters, digits, '-' and '_'")
+    main = shard_set.main
+    with main.reader() as conn:
+        if conn.execute("SELECT 1 FROM archive_shards WHERE name = ?", (name,)).fetchone():
+            raise ValueError(f"A shard named {name} already exists")
+        number = conn.execute("SELECT COALESCE(MAX(number), 0) + 1 FROM archive_shards").fetchone()[0]
+    if number >= MAX_SHARDS:
+        raise ValueError("No shard numbers left")
+
+    path = path.resolve() if path else main.path.with_name(f"{main.path.stem}-{name}.db")
+    shard = Shard(name, number, path, route)
+    db.init_db(shard.path)
+    with shard.writer() as conn:
+        for table in ID_TABLES:
+            low, high = conn.execute(f"SELECT MIN(id), MAX(id) FROM {table}").fetchone()
+            if low is not None and (low >> SHARD_ID_BITS != number or high >> SHARD_ID_BITS != number):
+                raise ValueError(f"{path} already holds {table} rows outside the shard's ids")
+            # AUTOINCREMENT, and the ids ingestion assigns up front, continue from here.
+            conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+            conn.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, max(high or 0, shard.first_id))
+            )
+
+    stored_path = path.relative_to(main.path.parent) if path.is_relative_to(main.path.parent) else path
+    with main.writer() as conn:
+        conn.execute(
+            "INSERT INTO archive_shards (number, name, path, route, created_at) VALUES (?, ?, ?, ?, ?)",
+            (number, name, str(stored_path), route, datetime.utcnow().isoformat()),
+        )
+    shard_set.load()
+    return shard
+
+
+def seal_shard(name: str, sealed: bool = True) -> Shard:
+    """Make a shard read-only, or writable again. Run it with the server stopped."""
+    shard = shard_set.get(name)
+    if shard is None or shard.number == 0:
+        raise ValueError(f"No shard named {name}")
+    if sealed:
+        # Sealed shards can't be migrated, so their backfills must be done first.
+        while shard_set.backfill_batch([shard]) is not None:
+            pass
+        shard.pool().close()
+        # Immutable readers never look at the WAL, so everything must be in the main file.
+        # Leaving WAL mode fails while any other connection has the file open.
+        with closing(sqlite3.connect(shard.path, timeout=0)) as conn:
+            try:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                mode = conn.execute("PRAGMA journal_mode = DELETE;").fetchone()[0]
+            except sqlite3.OperationalError:
+                mode = None
+            if mode != "delete":
+                raise ValueError(f"{shard.path} is in use; stop the server before sealing it")
+    with shard_set.main.writer() as conn:
+        conn.execute("UPDATE archive_shards SET read_only = ? WHERE number = ?", (int(sealed), shard.number))
+    # Unsealed shards go back to WAL mode in init_db().
+    shard_set.load()
+    return shard_set.get(name)
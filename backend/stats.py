@@ -0,0 +1,196 @@
+"""
+Archive statistics kept as rollups.
+
+Counting messages per source, role or day with GROUP BY reads every message, so the
+counts are maintained as rows are written instead:
+
+- conversations.message_count: messages per conversation
+- source_rollups: conversations, messages, attachments and attachment bytes per source
+- daily_rollups: messages per (UTC day, source, role)
+
+Ingestion adds what each batch inserts, and deleting a conversation subtracts what it
+held, inside the same transaction as the rows themselves, so the counts commit or roll
+back with them. rebuild() recomputes everything from the tables (`manage.py rebuild-stats`,
+and the backfill that fills them in for databases created before they existed); until that
+backfill is done, readers aggregate the same rows on the fly (db.rollup_tables()).
+"""
+
+from __future__ import annotations
+
+from collections import Counter
+from dataclasses import dataclass, field
+import sqlite3
+
+DAY_MS = 86_400_000
+
+SOURCE_COLUMNS = ("conversations", "messages", "attachments", "attachment_bytes")
+
+
+def epoch_day(timestamp_ms: int) -> int:
+    """timestamp_ms / DAY_MS as SQLite computes it, truncating towards zero."""
+    day = abs(timestamp_ms) // DAY_MS
+    return day if timestamp_ms >= 0 else -day
+
+
+@dataclass
+class RollupDelta:
+    """Changes to the rollups, collected while a batch is written and applied with it."""
+
+    # Messages added to existing rows of conversations.message_count.
+    conversation_messages: Counter[int] = field(default_factory=Counter)
+    # source -> counts in SOURCE_COLUMNS order.
+    sources: dict[str, list[int]] = field(default_factory=dict)
+    # (day, source, role) -> messages
+    days: Counter[tuple[int, str, str]] = field(default_factory=Counter)
+
+    def _source(self, source: str) -> list[int]:
+        return self.sources.setdefault(source, [0] * len(SOURCE_COLUMNS))
+
+    def add_conversation(self, source: str) -> None:
+        self._source(source)[0] += 1
+
+    def add_message(self, conversation_id: int, source: str, role: str, timestamp_ms: int) -> None:
+        self.conversation_messages[conversation_id] += 1
+        self._source(source)[1] += 1
+        self.days[epoch_day(timestamp_ms), source, role] += 1
+
+    def add_attachment(self, source: str, size: int) -> None:
+        counts = self._source(source)
+        counts[2] += 1
+        counts[3] += size
+
+    def apply(self, conn: sqlite3.Connection, sign: int = 1) -> None:
+        conn.executemany(
+            "UPDATE conversations SET message_count = message_count + ? WHERE id = ?",
+            [(sign * count, conversation_id) for conversation_id, count in self.conversation_messages.items()],
+        )
+        conn.executemany(
+            f"""
+            INSERT INTO source_rollups (source, {", ".join(SOURCE_COLUMNS)}) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (source) DO UPDATE SET
+                {", ".join(f"{column} = {column} + excluded.{column}" for column in SOURCE_COLUMNS)}
+            """,
+            [(source, *(sign * count for count in counts)) for source, counts in self.sources.items()],
+        )
+        conn.executemany(
+            """
+            INSERT INTO daily_rollups (day, source, role, messages) VALUES (?, ?, ?, ?)
+            ON CONFLICT (day, source, role) DO UPDATE SET messages = messages + excluded.messages
+            """,
+            [(day, source, role, sign * count) for (day, source, role), count in self.days.items()],
+        )
+        if sign < 0:
+            conn.execute("DELETE FROM daily_rollups WHERE messages <= 0")
+            conn.execute("DELETE FROM source_rollups WHERE conversations <= 0")
+
+
+def init_rollups(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS source_rollups (
+            source TEXT PRIMARY KEY,
+            conversations INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            attachments INTEGER NOT NULL,
+            attachment_bytes INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            day INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            role TEXT NOT NULL,
+            messages INTEGER NOT NULL,
+            PRIMARY KEY (day, source, role)
+        ) WITHOUT ROWID;
+        """
+    )
+
+
+# The rows of source_rollups, counted from the tables.
+SOURCE_COUNTS = """
+    SELECT
+        c.source AS source,
+        COUNT(*) AS conversations,
+        COALESCE(SUM(m.messages), 0) AS messages,
+        COALESCE(SUM(a.attachments), 0) AS attachments,
+        COALESCE(SUM(a.attachment_bytes), 0) AS attachment_bytes
+    FROM conversations AS c
+    LEFT JOIN (
+        SELECT conversation_id, COUNT(*) AS messages FROM messages GROUP BY conversation_id
+    ) AS m ON m.conversation_id = c.id
+    LEFT JOIN (
+        SELECT a.conversation_id, COUNT(*) AS attachments, SUM(COALESCE(b.size, 0)) AS attachment_bytes
+        FROM attachments AS a
+        LEFT JOIN media_blobs AS b ON b.sha256 = a.blob_sha256
+        GROUP BY a.conversation_id
+    ) AS a ON a.conversation_id = c.id
+    GROUP BY c.source
+"""
+
+
+def daily_counts(time: str = "m.timestamp_ms") -> str:
+    """The rows of daily_rollups counted from the tables, with time the SQL for m's timestamp_ms."""
+    return f"""
+        SELECT {time} / {DAY_MS} AS day, c.source AS source, m.role AS role, COUNT(*) AS messages
+        FROM messages AS m
+        JOIN conversations AS c ON c.id = m.conversation_id
+        GROUP BY 1, 2, 3
+    """
+
+
+def rebuild(conn: sqlite3.Connection, time: str = "m.timestamp_ms") -> None:
+    """Recompute every rollup from conversations, messages and attachments.
+
+    time is the SQL for a message's timestamp_ms (see db.message_time()).
+    """
+    conn.execute(
+        """
+        UPDATE conversations
+        SET message_count = (SELECT COUNT(*) FROM messages WHERE conversation_id = conversations.id)
+        """
+    )
+    conn.execute("DELETE FROM source_rollups")
+    conn.execute(f"INSERT INTO source_rollups (source, {', '.join(SOURCE_COLUMNS)}) {SOURCE_COUNTS}")
+    conn.execute("DELETE FROM daily_rollups")
+    conn.execute(f"INSERT INTO daily_rollups (day, source, role, messages) {daily_counts(time)}")
+
+
+def conversation_delta(
+    conn: sqlite3.Connection, conversation_id: int, time: str = "messages.timestamp_ms"
+) -> RollupDelta | None:
+    """What a conversation contributes to the rollups, to subtract before deleting it.
+
+    time is the SQL for a message's timestamp_ms (see db.message_time()).
+    """
+    row = conn.execute("SELECT source, message_count FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+    if row is None:
+        return None
+    source, message_count = row[0], row[1]
+
+    delta = RollupDelta()
+    delta.add_conversation(source)
+    delta.sources[source][1] = message_count
+    for day, role, count in conn.execute(
+        f"""
+        SELECT {time} / {DAY_MS}, role, COUNT(*)
+        FROM messages
+        WHERE conversation_id = ?
+        GROUP BY 1, 2
+        """,
+        (conversation_id,),
+    ):
+        delta.days[day, source, role] = count
+    attachments, attachment_bytes = conn.execute(
+        """
+        SELECT COUNT(*), COALESCE(SUM(b.size), 0)
+        FROM attachments AS a
+        LEFT JOIN media_blobs AS b ON b.sha256 = a.blob_sha256
+        WHERE a.conversation_id = ?
+        """,
+        (conversation_id,),
+    ).fetchone()
+    delta.sources[source][2:] = [attachments, attachment_bytes]
+    return delta
@@ -0,0 +1,19 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The backend modules import each other by their flat names.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    """An empty archive database in tmp_path, used as db.DB_PATH."""
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "archive.db")
+    monkeypatch.setattr(db, "MEDIA_DIR", tmp_path / "media")
+    db.init_db()
+    yield db.DB_PATH
+    db.close_pools()
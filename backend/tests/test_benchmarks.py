@@ -0,0 +1,13 @@
+import json
+
+from benchmarks import run
+
+
+def test_benchmark_runs_at_a_tiny_scale(tmp_path):
+    output = tmp_path / "bench.json"
+    run.main(["--scales", "40", "--queries", "3", "--parse-workers", "2", "--output", str(output)])
+
+    (scale,) = json.loads(output.read_text())["scales"]
+    assert scale["ingest"]["messages"] == 40
+    for measurement in ("search", "list_first_page", "list_20_pages", "detail"):
+        assert scale[measurement]["count"] > 0
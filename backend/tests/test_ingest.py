@@ -0,0 +1,57 @@
+import struct
+import zipfile
+
+import pytest
+
+from benchmarks.synthetic import ExportSpec, write_chatgpt_export
+import db
+from ingest import import_export, read_export
+from media import collect_garbage
+
+
+def _zip_without_conversations(path):
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("chat.html", "<html></html>")
+
+
+def _not_a_zip(path):
+    path.write_bytes(b"not a zip archive" * 1000)
+
+
+@pytest.mark.parametrize("write", [_zip_without_conversations, _not_a_zip])
+def test_rejected_zip_upload_is_not_stored(write, tmp_path):
+    upload = tmp_path / "upload.zip"
+    write(upload)
+    media_dir = tmp_path / "media"
+
+    with pytest.raises((ValueError, zipfile.BadZipFile)):
+        next(read_export(upload, "export.zip", media_dir))
+    assert not [path for path in media_dir.rglob("*") if path.is_file()]
+
+
+def _corrupt_last_attachment(path):
+    with zipfile.ZipFile(path) as archive:
+        info = [info for info in archive.infolist() if info.filename.startswith("file-")][-1]
+    with path.open("r+b") as export:
+        export.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", export.read(4))
+        export.seek(info.header_offset + 30 + name_length + extra_length)
+        first = export.read(1)
+        export.seek(-1, 1)
+        export.write(bytes([first[0] ^ 0xFF]))
+
+
+def test_media_stored_before_a_failed_extraction_is_collected(archive, tmp_path):
+    export = write_chatgpt_export(
+        tmp_path / "export.zip",
+        ExportSpec(conversations=3, messages_per_conversation=2, attachments_per_conversation=2, attachment_bytes=64),
+    )
+    _corrupt_last_attachment(export)
+
+    with db.get_write_db() as conn:
+        with pytest.raises(zipfile.BadZipFile):
+            import_export(conn, export, "export.zip", db.MEDIA_DIR)
+        stored = [path for path in db.MEDIA_DIR.rglob("*") if path.is_file()]
+        assert len(stored) > 1
+        collect_garbage(conn, db.MEDIA_DIR)
+    assert not [path for path in db.MEDIA_DIR.rglob("*") if path.is_file()]
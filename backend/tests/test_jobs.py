@@ -0,0 +1,107 @@
+from io import BytesIO
+import queue
+import sqlite3
+import threading
+import time
+
+from benchmarks.synthetic import ExportSpec, write_chatgpt_export
+import db
+from ingest import ExportBatch, _media_record
+import jobs
+from media import store_blob
+import semantic
+from shards import shard_set
+
+
+class _BlockedIndex:
+    """Stands in for every shard's semantic index, holding updates until released."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.updates = 0
+
+    def update(self, conn):
+        self.updates += 1
+        self.started.set()
+        self.release.wait(30)
+        return 0
+
+
+def _submit(manager, tmp_path, name):
+    spool_dir = tmp_path / f"spool-{name}"
+    spool_dir.mkdir()
+    export = write_chatgpt_export(spool_dir / "export.zip", ExportSpec(conversations=4, messages_per_conversation=3))
+    return manager.submit([(f"{name}.zip", export)], spool_dir)
+
+
+def _wait_for(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_semantic_index_updates_do_not_hold_up_the_writer(archive, tmp_path, monkeypatch):
+    shard_set.load()
+    index = _BlockedIndex()
+    monkeypatch.setattr(semantic, "AUTO_UPDATE", True)
+    monkeypatch.setattr(semantic, "get_index", lambda path: index)
+    manager = jobs.JobManager(workers=1)
+    try:
+        first = _submit(manager, tmp_path, "first")
+        _wait_for(index.started.is_set)
+
+        # The first job's update is still running; later jobs complete regardless.
+        second = _submit(manager, tmp_path, "second")
+        third = _submit(manager, tmp_path, "third")
+        _wait_for(lambda: all(manager.get(job.id).status == "completed" for job in (second, third)))
+        assert manager.get(first.id).semantic_indexed is False
+        assert manager.get(second.id).semantic_indexed is False
+
+        index.release.set()
+        _wait_for(lambda: all(manager.get(job.id).semantic_indexed for job in (first, second, third)))
+        # One update for the first job, then one covering both jobs that finished meanwhile.
+        assert index.updates == 2 * len(shard_set.writable())
+    finally:
+        index.release.set()
+        manager.shutdown()
+
+
+def test_media_of_batches_dropped_after_cancelling_is_collected(archive):
+    shard_set.load()
+    sha256, relative_path, size = store_blob(BytesIO(b"attachment"), db.MEDIA_DIR, ".png")
+    batch = ExportBatch(
+        file_name="export.zip", media_index={"file-1": _media_record("file-1.png", sha256, relative_path, size)}
+    )
+    manager = jobs.JobManager()
+    job = jobs.IngestJob(id="job", files=["export.zip"])
+    manager._jobs[job.id] = job
+    manager._cancel_events[job.id] = threading.Event()
+    manager._cancel_events[job.id].set()
+
+    manager._apply(job, "batch", batch)
+    assert job.conversations == 0
+    assert shard_set.collect_media_garbage() == (1, size)
+    assert not (db.MEDIA_DIR / relative_path).exists()
+
+
+def test_job_whose_batch_fails_to_store_ends_failed(archive, tmp_path, monkeypatch):
+    shard_set.load()
+
+    def fail(*args):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(jobs, "register_media", fail)
+    manager = jobs.JobManager()
+    job = jobs.IngestJob(id="job", files=["export.zip"])
+    manager._jobs[job.id] = job
+    manager._cancel_events[job.id] = threading.Event()
+    manager._spool_dirs[job.id] = tmp_path / "spool"
+    manager._results = queue.Queue()
+    for item in ((job.id, "batch", ExportBatch(file_name="export.zip")), (job.id, "done", None), None):
+        manager._results.put(item)
+
+    manager._write_loop()
+    assert job.status == "failed"
+    assert job.errors == ["Failed to store batch: disk I/O error"]
@@ -0,0 +1,131 @@
+import json
+import sqlite3
+
+from fastapi.testclient import TestClient
+
+from benchmarks.synthetic import ExportSpec, write_chatgpt_export
+from codec import register_functions
+import db
+from ingest import import_export
+import migrations
+from shards import shard_set
+
+
+def _make_pre_migration_archive(path, tmp_path):
+    """Import an export, then strip the database back to how versions before the epoch
+    columns, rollups and schema_version left it."""
+    export = write_chatgpt_export(tmp_path / "export.zip", ExportSpec(conversations=12, messages_per_conversation=6))
+    with db.get_write_db() as conn:
+        import_export(conn, export, "export.zip", db.MEDIA_DIR)
+    db.close_pools()
+
+    conn = sqlite3.connect(path)
+    register_functions(conn, path)
+    expected = dict(conn.execute("SELECT id, timestamp_ms FROM messages"))
+    for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'"
+    ).fetchall():
+        conn.execute(f"DROP INDEX {name}")
+    for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'messages_fts_%'"
+    ).fetchall():
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.execute("DROP TABLE schema_version")
+    conn.execute("DROP TABLE schema_backfills")
+    conn.execute("DELETE FROM source_rollups")
+    conn.execute("DELETE FROM daily_rollups")
+    conn.execute("UPDATE conversations SET created_at_ms = NULL, updated_at_ms = NULL, message_count = 0")
+    conn.execute("UPDATE messages SET timestamp_ms = NULL")
+    conn.commit()
+    conn.close()
+    return expected
+
+
+def _check_reads(client, conversation_id, expected):
+    detail = client.get(f"/api/conversations/{conversation_id}")
+    assert detail.status_code == 200
+    assert detail.json()["message_count"] == 6
+    listed = client.get("/api/conversations", params={"limit": 100}).json()["items"]
+    assert {item["message_count"] for item in listed} == {6}
+
+    window = client.get(f"/api/conversations/{conversation_id}/messages", params={"limit": 2})
+    assert window.status_code == 200
+    last = window.json()["items"][-1]
+    following = client.get(
+        f"/api/conversations/{conversation_id}/messages",
+        params={"limit": 10, "after": f"{last['timestamp_ms']},{last['id']}"},
+    )
+    items = window.json()["items"] + following.json()["items"]
+    assert len(items) == 6
+    ids = [item["id"] for item in items]
+    assert ids == sorted(ids, key=lambda message_id: (expected[message_id], message_id))
+
+    stream = client.get(f"/api/conversations/{conversation_id}/messages", params={"format": "ndjson"})
+    records = [json.loads(line) for line in stream.text.splitlines()]
+    assert {record["id"]: record["timestamp_ms"] for record in records} == {
+        message_id: expected[message_id] for message_id in ids
+    }
+
+    timeline = client.get("/api/timeline", params={"conversation_id": conversation_id})
+    assert timeline.status_code == 200
+    assert sum(day["count"] for day in timeline.json()) == 6
+    return sum(day["count"] for day in client.get("/api/timeline").json()), client.get("/api/stats").json()
+
+
+def test_reads_work_while_background_backfills_are_pending(archive, tmp_path):
+    expected = _make_pre_migration_archive(archive, tmp_path)
+
+    # What a server start does, short of starting backfill_runner.
+    db.init_db()
+    shard_set.load()
+    import main
+
+    with db.get_db() as conn:
+        assert migrations.schema_version(conn) == db.MIGRATIONS[-1].version
+        pending = {row["name"] for row in migrations.backfill_status(conn) if row["finished_at"] is None}
+        assert pending == {"rollups", "epochs", "indexes", "search_index"}
+        assert conn.execute("SELECT COUNT(*) FROM messages WHERE timestamp_ms IS NULL").fetchone()[0] == 72
+        first_id, last_id = conn.execute("SELECT MIN(id), MAX(id) FROM conversations").fetchone()
+
+    # Until the backfills are done, readers compute what they will fill in.
+    client = TestClient(main.app)
+    messages, stats = _check_reads(client, first_id, expected)
+    assert messages == 72
+    assert (stats["conversations"], stats["messages"]) == (12, 72)
+
+    assert client.delete(f"/api/conversations/{last_id}").status_code == 204
+    messages, stats = _check_reads(client, first_id, expected)
+    assert messages == 66
+    assert (stats["conversations"], stats["messages"]) == (11, 66)
+
+    # Finishing the backfills fills the columns, rollups and indexes in, and reads don't change.
+    while shard_set.backfill_batch() is not None:
+        pass
+    with db.get_write_db() as conn:
+        assert not [row for row in migrations.backfill_status(conn) if row["finished_at"] is None]
+        filled = dict(conn.execute("SELECT id, timestamp_ms FROM messages"))
+        assert filled == {message_id: expected[message_id] for message_id in filled}
+        assert conn.execute("SELECT SUM(messages) FROM source_rollups").fetchone()[0] == 66
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('integrity-check')")
+        indexes = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'")
+        assert indexes.fetchone()[0] == len(db.INDEXES)
+    messages, stats = _check_reads(client, first_id, expected)
+    assert messages == 66
+    assert (stats["conversations"], stats["messages"]) == (11, 66)
+
+
+def test_backfill_runner_retries_failed_batches(monkeypatch):
+    monkeypatch.setattr(migrations, "BACKFILL_RETRY_MAX_SECONDS", 0)
+    calls = []
+
+    def step():
+        calls.append(None)
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        return None
+
+    runner = migrations.BackfillRunner(step)
+    runner.start()
+    runner._thread.join(timeout=5)
+    assert not runner.running
+    assert len(calls) == 3
@@ -0,0 +1,91 @@
+from io import BytesIO
+import json
+import random
+
+import pytest
+
+import parsers
+
+# Text that looks like the start of a conversation, or ends a block mid-character if
+# cut in the wrong place.
+_PIECES = [
+    "hello",
+    "world",
+    ',{"mapping"',
+    ',{"mapping": {}}',
+    "],[",
+    "{",
+    "}",
+    ",",
+    "\\",
+    '"',
+    "\n",
+    "é",
+    "日本語",
+    "🙂",
+    "Ωμέγα",
+]
+
+
+def _text(rng):
+    return " ".join(rng.choice(_PIECES) for _ in range(rng.randint(0, 12)))
+
+
+def _conversation(rng, index):
+    created = 1_700_000_000 + index * 3600
+    mapping = {"root": {"id": "root", "parent": None, "children": [], "message": None}}
+    parent = "root"
+    for position in range(rng.randint(0, 4)):
+        node_id = f"c{index}-m{position}"
+        # Objects after a comma, some with a "mapping" key, which a block's start guess can
+        # mistake for a conversation.
+        metadata = {
+            "references": [
+                {"mapping": {"note": _text(rng)}} if rng.random() < 0.5 else {"title": _text(rng)}
+                for _ in range(rng.randint(0, 3))
+            ]
+        }
+        mapping[node_id] = {
+            "id": node_id,
+            "parent": parent,
+            "children": [],
+            "message": {
+                "id": node_id,
+                "author": {"role": rng.choice(["user", "assistant"])},
+                "create_time": created + position,
+                "content": {"content_type": "text", "parts": [_text(rng)]},
+                "metadata": metadata,
+            },
+        }
+        mapping[parent]["children"].append(node_id)
+        parent = node_id
+    return {
+        "id": f"conv-{index}",
+        "title": _text(rng),
+        "create_time": created,
+        "update_time": created + 60,
+        "mapping": mapping,
+        "current_node": parent,
+    }
+
+
+def _export(seed):
+    rng = random.Random(seed)
+    conversations = [_conversation(rng, index) for index in range(rng.randint(0, 12))]
+    if rng.random() < 0.5:
+        text = json.dumps(conversations, ensure_ascii=False)
+    else:
+        text = json.dumps(conversations, ensure_ascii=False, indent=rng.choice([1, 2, "\t"]))
+    return text.encode("utf-8")
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_parallel_parse_matches_serial(seed, monkeypatch):
+    data = _export(seed)
+    block_size = random.Random(seed).choice([7, 13, 31, 64, 257, 1024, 2048])
+    monkeypatch.setattr(parsers, "PARALLEL_BLOCK_SIZE", block_size)
+
+    serial = list(parsers.iter_chatgpt_conversations(BytesIO(data)))
+    parallel = list(parsers.iter_chatgpt_conversations(BytesIO(data), workers=2))
+    assert parallel == serial
+
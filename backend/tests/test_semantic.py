@@ -0,0 +1,39 @@
+import numpy as np
+
+from benchmarks.synthetic import ExportSpec, write_chatgpt_export, write_simple_json_export
+import db
+from ingest import import_export
+import semantic
+
+
+def _import(export):
+    with db.get_write_db() as conn:
+        import_export(conn, export, export.name, db.MEDIA_DIR)
+
+
+def test_update_after_a_crash_between_writes_keeps_ids_and_vectors_paired(archive, tmp_path):
+    _import(write_chatgpt_export(tmp_path / "export.zip", ExportSpec(conversations=6, messages_per_conversation=4)))
+    index = semantic.get_index(archive)
+    with db.get_db() as conn:
+        assert index.update(conn) > 0
+    build = index._load()
+    stored = len(build.ids)
+
+    # A batch whose vectors were written but not its ids, then a partly written id.
+    with (build.path / "vectors.f16").open("ab") as vectors_file:
+        vectors_file.write(np.ones((3, build.model.dimensions), np.float16).tobytes())
+    with (build.path / "ids.i64").open("ab") as ids_file:
+        ids_file.write(b"\x01\x02\x03")
+
+    _import(write_simple_json_export(tmp_path / "messages.json", messages=10))
+    with db.get_db() as conn:
+        index.update(conn)
+        build = index._load()
+        ids = np.asarray(build.ids)
+        assert len(ids) > stored
+        assert (np.diff(ids) > 0).all()
+        texts = dict(conn.execute("SELECT id, content_text(content) FROM messages"))
+
+    assert ids.tolist() == sorted(texts)
+    expected = build.model.embed([texts[message_id] for message_id in ids.tolist()]).astype(np.float16)
+    assert np.array_equal(np.asarray(build.vectors), expected)
@@ -2,15 +2,34 @@ import { useEffect, useState } from 'react'
 import ConversationDetail from './components/ConversationDetail'
 import ConversationList from './components/ConversationList'
 import SearchPanel from './components/SearchPanel'
-import { ConversationDetail as ConversationDetailType, ConversationSummary, SearchResult } from './components/types'
+import {
+  ConversationDetail as ConversationDetailType,
+  ConversationPage,
+  ConversationSummary,
+  IngestJob,
+  SearchMode,
+  SearchOrder,
+  SearchPage,
+} from './components/types'
 
 const API_BASE = 'http://localhost:8000/api'
+const JOB_POLL_INTERVAL_MS = 1000
+const FINISHED_JOB_STATUSES = ['completed', 'failed', 'cancelled']
+
+// The API's error message, or the status code when the body has none.
+async function errorDetail(response: Response): Promise<string> {
+  const data = await response.json().catch(() => null)
+  return typeof data?.detail === 'string' ? data.detail : `Request failed with status ${response.status}`
+}
 
 export default function App() {
   const [conversations, setConversations] = useState<ConversationSummary[]>([])
+  const [nextConversationsCursor, setNextConversationsCursor] = useState<string | null>(null)
   const [selectedConversationId, setSelectedConversationId] = useState<number | null>(null)
   const [selectedConversation, setSelectedConversation] = useState<ConversationDetailType | null>(null)
   const [highlightedMessageId, setHighlightedMessageId] = useState<number | null>(null)
+  const [uploadJob, setUploadJob] = useState<IngestJob | null>(null)
+  const [uploadError, setUploadError] = useState<string | null>(null)
 
   useEffect(() => {
     loadConversations().catch(console.error)
@@ -23,21 +42,38 @@ export default function App() {
 
   async function loadConversations() {
     const response = await fetch(`${API_BASE}/conversations`)
-    const data: ConversationSummary[] = await response.json()
-    setConversations(data)
-    if (data.length > 0 && selectedConversationId === null) {
-      setSelectedConversationId(data[0].id)
+    const data: ConversationPage = await response.json()
+    setConversations(data.items)
+    setNextConversationsCursor(data.next_after)
+    if (data.items.length > 0 && selectedConversationId === null) {
+      setSelectedConversationId(data.items[0].id)
     }
   }
 
+  async function loadMoreConversations() {
+    if (!nextConversationsCursor) return
+    const response = await fetch(`${API_BASE}/conversations?after=${encodeURIComponent(nextConversationsCursor)}`)
+    const data: ConversationPage = await response.json()
+    setConversations((current) => [...current, ...data.items])
+    setNextConversationsCursor(data.next_after)
+  }
+
   async function loadConversation(id: number) {
-    const response = await fetch(`${API_BASE}/conversations/${id}`)
+    const response = await fetch(`${API_BASE}/conversations/${id}?include_messages=false`)
     const data: ConversationDetailType = await response.json()
     setSelectedConversation(data)
   }
 
-  async function handleSearch(query: string): Promise<SearchResult[]> {
-    const response = await fetch(`${API_BASE}/search?query=${encodeURIComponent(query)}`)
+  async function handleSearch(
+    query: string,
+    mode: SearchMode,
+    order: SearchOrder,
+    after: string | null,
+  ): Promise<SearchPage> {
+    const params = new URLSearchParams({ query, mode, order })
+    if (after) params.set('after', after)
+    const response = await fetch(`${API_BASE}/search?${params}`)
+    if (!response.ok) return { items: [], next_after: null }
     return response.json()
   }
 
@@ -52,10 +88,29 @@ export default function App() {
     const formData = new FormData()
     Array.from(event.target.files).forEach((file) => formData.append('files', file))
 
-    await fetch(`${API_BASE}/upload`, {
+    setUploadError(null)
+    const response = await fetch(`${API_BASE}/upload`, {
       method: 'POST',
       body: formData,
     })
+    if (!response.ok) {
+      setUploadJob(null)
+      setUploadError(await errorDetail(response))
+      return
+    }
+    let job: IngestJob = await response.json()
+    setUploadJob(job)
+
+    while (!FINISHED_JOB_STATUSES.includes(job.status)) {
+      await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS))
+      const jobResponse = await fetch(`${API_BASE}/jobs/${job.id}`)
+      if (!jobResponse.ok) {
+        setUploadError(await errorDetail(jobResponse))
+        return
+      }
+      job = await jobResponse.json()
+      setUploadJob(job)
+    }
 
     await loadConversations()
   }
@@ -66,11 +121,20 @@ export default function App() {
         <div className="panel upload-panel">
           <h1>AI Chat Archive</h1>
           <input type="file" accept="application/json,.zip,application/zip" multiple onChange={handleUpload} />
-          <input type="file" accept="application/json" multiple onChange={handleUpload} />
+          {uploadJob && (
+            <p className="upload-status">
+              {uploadJob.status}: {uploadJob.conversations} new, {uploadJob.updated} updated,{' '}
+              {uploadJob.unchanged} unchanged conversations, {uploadJob.messages} messages
+              {uploadJob.errors.length > 0 && ` (${uploadJob.errors.join('; ')})`}
+            </p>
+          )}
+          {uploadError && <p className="upload-status">{uploadError}</p>}
         </div>
         <ConversationList
           conversations={conversations}
           selectedConversationId={selectedConversationId}
+          hasMore={nextConversationsCursor !== null}
+          onLoadMore={() => loadMoreConversations().catch(console.error)}
           onSelect={(id) => {
             setSelectedConversationId(id)
             setHighlightedMessageId(null)
@@ -80,7 +144,6 @@ export default function App() {
       <main>
         <SearchPanel onSearch={handleSearch} onResultClick={handleResultClick} />
         <ConversationDetail conversation={selectedConversation} highlightedMessageId={highlightedMessageId} apiBase={API_BASE} />
-        <ConversationDetail conversation={selectedConversation} highlightedMessageId={highlightedMessageId} />
       </main>
     </div>
   )
@@ -1,7 +1,5 @@
 import { useEffect, useState } from 'react'
-import { Attachment, ConversationDetail as ConversationDetailType } from './types'
-import { useEffect } from 'react'
-import { ConversationDetail as ConversationDetailType } from './types'
+import { Attachment, ConversationDetail as ConversationDetailType, Message, MessageWindow } from './types'
 
 type Props = {
   conversation: ConversationDetailType | null
@@ -10,13 +8,41 @@ type Props = {
 }
 
 const BACKEND_BASE = 'http://localhost:8000'
+const MESSAGE_WINDOW_SIZE = 100
+
+function messageCursor(message: Message) {
+  return encodeURIComponent(`${message.timestamp_ms},${message.id}`)
+}
 
 export default function ConversationDetail({ conversation, highlightedMessageId, apiBase }: Props) {
   const [attachments, setAttachments] = useState<Attachment[]>([])
+  const [messages, setMessages] = useState<Message[]>([])
+  const [hasBefore, setHasBefore] = useState(false)
+  const [hasAfter, setHasAfter] = useState(false)
 
-}
+  async function fetchWindow(query: string): Promise<MessageWindow> {
+    const response = await fetch(
+      `${apiBase}/conversations/${conversation?.id}/messages?limit=${MESSAGE_WINDOW_SIZE}${query}`,
+    )
+    return response.json()
+  }
+
+  useEffect(() => {
+    if (!conversation) {
+      setMessages([])
+      return
+    }
+
+    const query = highlightedMessageId ? `&around=${highlightedMessageId}` : ''
+    fetchWindow(query)
+      .then((page) => {
+        setMessages(page.items)
+        setHasBefore(page.has_before)
+        setHasAfter(page.has_after)
+      })
+      .catch(() => setMessages([]))
+  }, [conversation?.id, highlightedMessageId, apiBase])
 
-export default function ConversationDetail({ conversation, highlightedMessageId }: Props) {
   useEffect(() => {
     if (!highlightedMessageId) return
 
@@ -24,7 +50,21 @@ export default function ConversationDetail({ conversation, highlightedMessageId
     if (element) {
       element.scrollIntoView({ behavior: 'smooth', block: 'center' })
     }
-  }, [highlightedMessageId, conversation?.id])
+  }, [highlightedMessageId, messages])
+
+  async function loadEarlier() {
+    if (messages.length === 0) return
+    const page = await fetchWindow(`&before=${messageCursor(messages[0])}`)
+    setMessages((current) => [...page.items, ...current])
+    setHasBefore(page.has_before)
+  }
+
+  async function loadLater() {
+    if (messages.length === 0) return
+    const page = await fetchWindow(`&after=${messageCursor(messages[messages.length - 1])}`)
+    setMessages((current) => [...current, ...page.items])
+    setHasAfter(page.has_after)
+  }
 
   useEffect(() => {
     if (!conversation) {
@@ -45,8 +85,10 @@ export default function ConversationDetail({ conversation, highlightedMessageId
   return (
     <div className="panel right-pane">
       <h2>{conversation.title}</h2>
+      <small>{conversation.message_count} messages</small>
       <div className="messages">
-        {conversation.messages.map((message) => (
+        {hasBefore && <button onClick={() => loadEarlier().catch(console.error)}>Load earlier messages</button>}
+        {messages.map((message) => (
           <article
             id={`message-${message.id}`}
             key={message.id}
@@ -59,6 +101,7 @@ export default function ConversationDetail({ conversation, highlightedMessageId
             <p>{message.content}</p>
           </article>
         ))}
+        {hasAfter && <button onClick={() => loadLater().catch(console.error)}>Load later messages</button>}
       </div>
 
       <section className="attachments-panel">
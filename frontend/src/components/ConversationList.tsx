@@ -3,10 +3,12 @@ import { ConversationSummary } from './types'
 type Props = {
   conversations: ConversationSummary[]
   selectedConversationId: number | null
+  hasMore: boolean
+  onLoadMore: () => void
   onSelect: (id: number) => void
 }
 
-export default function ConversationList({ conversations, selectedConversationId, onSelect }: Props) {
+export default function ConversationList({ conversations, selectedConversationId, hasMore, onLoadMore, onSelect }: Props) {
   return (
     <div className="panel left-pane">
       <h2>Conversations</h2>
@@ -18,11 +20,18 @@ export default function ConversationList({ conversations, selectedConversationId
               onClick={() => onSelect(conversation.id)}
             >
               <strong>{conversation.title}</strong>
-              <span>{conversation.source}</span>
+              <span>
+                {conversation.source} · {conversation.message_count} messages
+              </span>
             </button>
           </li>
         ))}
       </ul>
+      {hasMore && (
+        <button className="load-more" onClick={onLoadMore}>
+          Load more
+        </button>
+      )}
     </div>
   )
 }
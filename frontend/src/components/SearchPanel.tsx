@@ -1,14 +1,31 @@
-import { FormEvent, useMemo, useState } from 'react'
-import { SearchResult } from './types'
+import { FormEvent, ReactNode, useMemo, useState } from 'react'
+import { SearchMode, SearchOrder, SearchPage, SearchResult } from './types'
+
+function renderSnippet(result: SearchResult) {
+  // Offsets are in code points, so index an array of characters rather than the UTF-16 string.
+  const chars = Array.from(result.snippet)
+  const nodes: ReactNode[] = []
+  let position = 0
+  result.highlights.forEach(([start, end], index) => {
+    nodes.push(chars.slice(position, start).join(''))
+    nodes.push(<mark key={index}>{chars.slice(start, end).join('')}</mark>)
+    position = end
+  })
+  nodes.push(chars.slice(position).join(''))
+  return nodes
+}
 
 type Props = {
-  onSearch: (query: string) => Promise<SearchResult[]>
+  onSearch: (query: string, mode: SearchMode, order: SearchOrder, after: string | null) => Promise<SearchPage>
   onResultClick: (conversationId: number, messageId: number) => void
 }
 
 export default function SearchPanel({ onSearch, onResultClick }: Props) {
   const [query, setQuery] = useState('')
+  const [mode, setMode] = useState<SearchMode>('keyword')
+  const [order, setOrder] = useState<SearchOrder>('relevance')
   const [results, setResults] = useState<SearchResult[]>([])
+  const [nextAfter, setNextAfter] = useState<string | null>(null)
   const [isLoading, setIsLoading] = useState(false)
 
   const grouped = useMemo(() => {
@@ -24,13 +41,27 @@ export default function SearchPanel({ onSearch, onResultClick }: Props) {
     event.preventDefault()
     if (!query.trim()) {
       setResults([])
+      setNextAfter(null)
       return
     }
 
     setIsLoading(true)
     try {
-      const data = await onSearch(query.trim())
-      setResults(data)
+      const page = await onSearch(query.trim(), mode, order, null)
+      setResults(page.items)
+      setNextAfter(page.next_after)
+    } finally {
+      setIsLoading(false)
+    }
+  }
+
+  async function loadMore() {
+    if (!nextAfter) return
+    setIsLoading(true)
+    try {
+      const page = await onSearch(query.trim(), mode, order, nextAfter)
+      setResults((current) => [...current, ...page.items])
+      setNextAfter(page.next_after)
     } finally {
       setIsLoading(false)
     }
@@ -45,26 +76,43 @@ export default function SearchPanel({ onSearch, onResultClick }: Props) {
           onChange={(event) => setQuery(event.target.value)}
           placeholder="Search messages"
         />
+        <select value={mode} onChange={(event) => setMode(event.target.value as SearchMode)}>
+          <option value="keyword">Keywords</option>
+          <option value="semantic">Similar meaning</option>
+        </select>
+        {mode === 'keyword' && (
+          <select value={order} onChange={(event) => setOrder(event.target.value as SearchOrder)}>
+            <option value="relevance">Best match</option>
+            <option value="recency">Newest first</option>
+          </select>
+        )}
         <button type="submit">Search</button>
       </form>
-      {isLoading && <p>Searching...</p>}
-      {!isLoading && results.length > 0 && (
+      {isLoading && results.length === 0 && <p>Searching...</p>}
+      {results.length > 0 && (
         <div className="search-results">
           {Object.entries(grouped).map(([conversationId, items]) => (
             <div key={conversationId}>
-              <h4>Conversation {conversationId}</h4>
+              <h4>{items[0].conversation_title}</h4>
               <ul>
                 {items.map((item) => (
                   <li key={item.message_id}>
                     <button onClick={() => onResultClick(item.conversation_id, item.message_id)}>
-                      <small>{item.timestamp}</small>
-                      <p>{item.snippet}</p>
+                      <small>
+                        {item.role} · {item.timestamp}
+                      </small>
+                      <p>{renderSnippet(item)}</p>
                     </button>
                   </li>
                 ))}
               </ul>
             </div>
           ))}
+          {nextAfter && (
+            <button type="button" onClick={loadMore} disabled={isLoading}>
+              {isLoading ? 'Loading...' : 'More results'}
+            </button>
+          )}
         </div>
       )}
     </section>
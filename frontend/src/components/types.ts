@@ -3,6 +3,13 @@ export type ConversationSummary = {
   title: string
   source: string
   created_at: string
+  created_at_ms: number
+  message_count: number
+}
+
+export type ConversationPage = {
+  items: ConversationSummary[]
+  next_after: string | null
 }
 
 export type Message = {
@@ -11,6 +18,7 @@ export type Message = {
   role: string
   content: string
   timestamp: string
+  timestamp_ms: number
 }
 
 export type ConversationDetail = {
@@ -19,16 +27,36 @@ export type ConversationDetail = {
   source: string
   created_at: string
   updated_at: string
+  archive_sha256: string | null
+  message_count: number
   messages: Message[]
 }
 
+export type MessageWindow = {
+  items: Message[]
+  has_before: boolean
+  has_after: boolean
+}
+
+export type SearchMode = 'keyword' | 'semantic'
+
+export type SearchOrder = 'relevance' | 'recency'
+
 export type SearchResult = {
   conversation_id: number
+  conversation_title: string
   message_id: number
+  role: string
   snippet: string
+  highlights: [number, number][]
   timestamp: string
 }
 
+export type SearchPage = {
+  items: SearchResult[]
+  next_after: string | null
+}
+
 export type Attachment = {
   id: number
   conversation_id: number
@@ -39,3 +67,18 @@ export type Attachment = {
   local_path: string
   created_at: string
 }
+
+export type IngestJob = {
+  id: string
+  files: string[]
+  status: string
+  conversations: number
+  updated: number
+  unchanged: number
+  messages: number
+  bytes_read: number
+  total_bytes: number
+  errors: string[]
+  created_at: string
+  finished_at: string | null
+}